@@ -1,4 +1,3 @@
-import asyncio
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.filters import StateFilter
@@ -9,6 +8,7 @@ from typing import List, Dict, Any
 
 from database import Database, User, ReferralProgram, ReferralEarning, ServiceRule
 from remnawave_api import RemnaWaveAPI
+from panel_users_store import PanelUsersSnapshot, PanelUsersStore
 from keyboards import *
 from translations import t
 from utils import *
@@ -49,7 +49,7 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
-admin_router = Router()
+admin_router = Router(name='admin')
 
 async def check_admin_access(callback: CallbackQuery, user: User) -> bool:
     if not user.is_admin:
@@ -75,7 +75,7 @@ async def admin_stats_callback(callback: CallbackQuery, user: User, db: Database
     try:
         db_stats = await db.get_stats()
         
-        referral_stats = await get_referral_stats(db)
+        referral_stats = await db.get_referral_stats()
         
         lucky_stats = await db.get_lucky_game_admin_stats()
         
@@ -171,41 +171,6 @@ async def admin_stats_callback(callback: CallbackQuery, user: User, db: Database
             reply_markup=back_keyboard("admin_panel", user.language)
         )
 
-async def get_referral_stats(db: Database) -> Dict[str, Any]:
-    try:
-        async with db.session_factory() as session:
-            from sqlalchemy import select, func, and_
-            from database import ReferralProgram, ReferralEarning
-            
-            total_paid = await session.execute(
-                select(func.sum(ReferralEarning.amount))
-            )
-            total_paid = total_paid.scalar() or 0.0
-            
-            active_referrers = await session.execute(
-                select(func.count(func.distinct(ReferralEarning.referrer_id)))
-            )
-            active_referrers = active_referrers.scalar() or 0
-            
-            total_referrals = await session.execute(
-                select(func.count(ReferralProgram.id)).where(
-                    and_(
-                        ReferralProgram.referred_id < 900000000,
-                        ReferralProgram.referred_id > 0
-                    )
-                )
-            )
-            total_referrals = total_referrals.scalar() or 0
-            
-            return {
-                'total_paid': total_paid,
-                'active_referrers': active_referrers,
-                'total_referrals': total_referrals
-            }
-    except Exception as e:
-        logger.error(f"Error getting referral stats: {e}")
-        return {'total_paid': 0.0, 'active_referrers': 0, 'total_referrals': 0}
-
 async def get_recent_topups(db: Database) -> List[Dict[str, Any]]:
     try:
         async with db.session_factory() as session:
@@ -806,43 +771,179 @@ async def admin_users_callback(callback: CallbackQuery, user: User, **kwargs):
         reply_markup=admin_users_keyboard(user.language)
     )
 
-@admin_router.callback_query(F.data == "list_users")
-async def list_users_callback(callback: CallbackQuery, user: User, db: Database, **kwargs):
-    if not await check_admin_access(callback, user):
-        return
-    
-    try:
-        users = await db.get_all_users()
-        
-        if not users:
-            await callback.message.edit_text(
-                "❌ Пользователи не найдены",
-                reply_markup=back_keyboard("admin_users", user.language)
-            )
-            return
-        
-        text = t('user_list', user.language) + "\n\n"
-        
-        for u in users[:20]:
+ADMIN_USERS_PAGE_SIZE = 20
+
+# Значения, которые перебирают кнопки фильтров списка пользователей
+ADMIN_USERS_FILTER_CYCLES = {
+    'balance': [None, 'positive', 'zero', 'rich'],
+    'language': [None, 'ru', 'en'],
+    'is_admin': [None, True],
+    'created_days': [None, 1, 7, 30],
+    'has_active_subscription': [None, True, False],
+}
+
+def users_page_query(filters: Dict[str, Any]) -> Dict[str, Any]:
+    """Переводит фильтры из FSM в аргументы Database.get_users_page"""
+    query = {
+        'language': filters.get('language'),
+        'is_admin': filters.get('is_admin'),
+        'has_active_subscription': filters.get('has_active_subscription'),
+        'username_prefix': filters.get('username_prefix'),
+    }
+
+    balance = filters.get('balance')
+    if balance == 'positive':
+        query['min_balance'] = 0.01
+    elif balance == 'zero':
+        query['max_balance'] = 0
+    elif balance == 'rich':
+        query['min_balance'] = 100
+
+    if filters.get('created_days'):
+        query['created_after'] = datetime.utcnow() - timedelta(days=filters['created_days'])
+
+    return query
+
+async def show_users_page(callback: CallbackQuery, user: User, db: Database, state: FSMContext,
+                          after_id: int = 0, before_id: int = None, message: Message = None):
+    data = await state.get_data()
+    filters = data.get('admin_users_filter', {})
+
+    users, has_more = await db.get_users_page(
+        after_id=after_id, before_id=before_id, limit=ADMIN_USERS_PAGE_SIZE,
+        **users_page_query(filters)
+    )
+
+    if not users:
+        text = "❌ Пользователи не найдены"
+        if any(value is not None for value in filters.values()):
+            text += "\n\nПопробуйте изменить фильтры"
+        keyboard = admin_users_list_keyboard(0, 0, False, False, user.language)
+    else:
+        text = t('user_list', user.language) + "\n"
+        if filters.get('username_prefix'):
+            text += f"🔎 Username начинается с: {filters['username_prefix']}\n"
+        text += "\n"
+
+        for u in users:
             username = u.username or "N/A"
             text += t('user_item', user.language,
                 id=u.telegram_id,
                 username=username,
                 balance=u.balance
             ) + "\n"
-        
-        if len(users) > 20:
-            text += f"\n... и еще {len(users) - 20} пользователей"
-        
-        await callback.message.edit_text(
-            text,
-            reply_markup=back_keyboard("admin_users", user.language)
-        )
-        
+
+        if before_id is not None:
+            has_prev, has_next = has_more, True
+        else:
+            has_prev, has_next = after_id > 0, has_more
+        keyboard = admin_users_list_keyboard(users[0].id, users[-1].id, has_prev, has_next, user.language)
+
+    if message:
+        await message.answer(text, reply_markup=keyboard)
+    else:
+        await callback.message.edit_text(text, reply_markup=keyboard)
+
+@admin_router.callback_query(F.data == "list_users")
+async def list_users_callback(callback: CallbackQuery, user: User, db: Database, state: FSMContext, **kwargs):
+    if not await check_admin_access(callback, user):
+        return
+    
+    try:
+        await show_users_page(callback, user, db, state)
     except Exception as e:
         logger.error(f"Error listing users: {e}")
         await callback.answer(t('error_occurred', user.language))
 
+@admin_router.callback_query(F.data.startswith("bot_users_prev_") | F.data.startswith("bot_users_next_"))
+async def bot_users_page_callback(callback: CallbackQuery, user: User, db: Database, state: FSMContext, **kwargs):
+    if not await check_admin_access(callback, user):
+        return
+    
+    try:
+        direction, user_row_id = callback.data.replace("bot_users_", "").split("_")
+        if direction == "prev":
+            await show_users_page(callback, user, db, state, before_id=int(user_row_id))
+        else:
+            await show_users_page(callback, user, db, state, after_id=int(user_row_id))
+    except Exception as e:
+        logger.error(f"Error in users pagination: {e}")
+        await callback.answer("❌ Ошибка навигации", show_alert=True)
+
+@admin_router.callback_query(F.data == "users_filters")
+async def users_filters_callback(callback: CallbackQuery, user: User, state: FSMContext, **kwargs):
+    if not await check_admin_access(callback, user):
+        return
+    
+    data = await state.get_data()
+    filters = data.get('admin_users_filter', {})
+    
+    text = "🔍 Фильтры списка пользователей\n\n"
+    text += "Нажмите на фильтр, чтобы переключить значение"
+    if filters.get('username_prefix'):
+        text += f"\n\n🔎 Username начинается с: {filters['username_prefix']}"
+    
+    await callback.message.edit_text(
+        text,
+        reply_markup=admin_users_filters_keyboard(filters, user.language)
+    )
+
+@admin_router.callback_query(F.data.startswith("users_filter_"))
+async def users_filter_toggle_callback(callback: CallbackQuery, user: User, state: FSMContext, **kwargs):
+    if not await check_admin_access(callback, user):
+        return
+    
+    field = callback.data.replace("users_filter_", "")
+    field = {'admin': 'is_admin', 'created': 'created_days', 'active': 'has_active_subscription'}.get(field, field)
+    
+    data = await state.get_data()
+    filters = dict(data.get('admin_users_filter', {}))
+    
+    if field == "reset":
+        filters = {}
+    elif field in ADMIN_USERS_FILTER_CYCLES:
+        values = ADMIN_USERS_FILTER_CYCLES[field]
+        current = filters.get(field)
+        position = values.index(current) if current in values else 0
+        filters[field] = values[(position + 1) % len(values)]
+    else:
+        await callback.answer()
+        return
+    
+    await state.update_data(admin_users_filter=filters)
+    await users_filters_callback(callback, user, state)
+
+@admin_router.callback_query(F.data == "search_user")
+async def search_user_by_username_callback(callback: CallbackQuery, user: User, state: FSMContext, **kwargs):
+    if not await check_admin_access(callback, user):
+        return
+    
+    await callback.message.edit_text(
+        "🔎 Поиск пользователя по username\n\n"
+        "Введите начало username (без учета регистра).\n"
+        "Отправьте `-`, чтобы сбросить поиск.",
+        reply_markup=cancel_keyboard(user.language),
+        parse_mode='Markdown'
+    )
+    await state.set_state(BotStates.admin_search_user_username)
+
+@admin_router.message(StateFilter(BotStates.admin_search_user_username))
+async def handle_search_user_username(message: Message, state: FSMContext, user: User, db: Database, **kwargs):
+    prefix = (message.text or "").strip().lstrip('@')
+    
+    data = await state.get_data()
+    filters = dict(data.get('admin_users_filter', {}))
+    filters['username_prefix'] = None if prefix in ("", "-") else prefix[:64]
+    
+    await state.set_state(None)
+    await state.update_data(admin_users_filter=filters)
+    
+    try:
+        await show_users_page(None, user, db, state, message=message)
+    except Exception as e:
+        logger.error(f"Error searching users by username: {e}")
+        await message.answer(t('error_occurred', user.language))
+
 @admin_router.callback_query(F.data == "admin_balance")
 async def admin_balance_callback(callback: CallbackQuery, user: User, **kwargs):
     if not await check_admin_access(callback, user):
@@ -896,22 +997,21 @@ async def handle_balance_amount(message: Message, state: FSMContext, user: User,
     target_user_id = data['target_user_id']
     
     try:
-        success = await db.add_balance(target_user_id, amount)
+        result = await db.post_balance_change(
+            target_user_id,
+            amount,
+            'admin_topup',
+            idempotency_key=f"admin_topup:{message.chat.id}:{message.message_id}",
+            description=f'Пополнение администратором (ID: {user.telegram_id})'
+        )
+        success = result['success']
         
         if success:
-            payment = await db.create_payment(
-                user_id=target_user_id,
-                amount=amount,
-                payment_type='admin_topup', 
-                description=f'Пополнение администратором (ID: {user.telegram_id})',
-                status='completed'
-            )
-            
             bot = kwargs.get('bot')
             await process_referral_rewards(
                 target_user_id, 
                 amount, 
-                payment.id, 
+                result['payment_id'], 
                 db, 
                 bot, 
                 payment_type='admin_topup'
@@ -1069,12 +1169,15 @@ async def approve_payment(callback: CallbackQuery, user: User, db: Database, **k
             await callback.answer("❌ Платеж уже обработан")
             return
         
-        success = await db.add_balance(payment.user_id, payment.amount)
+        result = await db.complete_payment(payment.id)
+        
+        if result['status'] == 'duplicate':
+            await callback.answer("❌ Платеж уже обработан")
+            return
+        
+        success = result['success']
         
         if success:
-            payment.status = 'completed'
-            await db.update_payment(payment)
-            
             bot = kwargs.get('bot')
             await process_referral_rewards(
                 payment.user_id, 
@@ -2022,7 +2125,10 @@ async def monitor_status_callback(callback: CallbackQuery, user: User, **kwargs)
         
         status_text += f"⚙️ **Настройки:**\n"
         status_text += f"• Включен: {'✅' if status['monitor_enabled'] else '❌'}\n"
-        status_text += f"• Интервал проверки: {status['check_interval']} сек\n"
+        if status.get('scheduled'):
+            status_text += f"• Проверка: точно в срок (планировщик)\n"
+        else:
+            status_text += f"• Интервал проверки: {status['check_interval']} сек\n"
         status_text += f"• Ежедневная проверка: {status['daily_check_hour']}:00\n"
         status_text += f"• Предупреждение за: {status['warning_days']} дн.\n\n"
         
@@ -2422,58 +2528,91 @@ async def cancel_monitor_test(callback: CallbackQuery, state: FSMContext, user:
     )
 
 @admin_router.message(StateFilter(BotStates.admin_broadcast_text))
-async def handle_broadcast_message(message: Message, state: FSMContext, user: User, db: Database, **kwargs):
-    message_text = message.text.strip()
+async def handle_broadcast_message(message: Message, state: FSMContext, user: User, **kwargs):
+    message_text = message.text.strip() if message.text else ""
     
     if len(message_text) < 1:
         await message.answer("❌ Сообщение не может быть пустым")
         return
     
+    await state.update_data(broadcast_text=message_text)
+    await state.set_state(None)
+    
+    await message.answer(
+        "👥 Выберите получателей рассылки:",
+        reply_markup=broadcast_audience_keyboard(user.language)
+    )
+
+@admin_router.callback_query(F.data.startswith("broadcast_audience_"))
+async def broadcast_audience_callback(callback: CallbackQuery, state: FSMContext, user: User, **kwargs):
+    if not await check_admin_access(callback, user):
+        return
+    
+    audience = callback.data.replace("broadcast_audience_", "")
+    data = await state.get_data()
+    message_text = data.get('broadcast_text')
+    await state.clear()
+    
+    if not message_text:
+        await callback.answer("❌ Текст рассылки не найден, начните заново", show_alert=True)
+        return
+    
+    broadcast_service = kwargs.get('broadcast_service')
+    if not broadcast_service:
+        await callback.answer("❌ Сервис рассылок недоступен", show_alert=True)
+        return
+    
     try:
-        users = await db.get_all_users()
-        
-        if not users:
-            await message.answer("❌ Пользователи не найдены")
-            await state.clear()
-            return
-        
-        bot = kwargs.get('bot')
-        if not bot:
-            await message.answer("❌ Ошибка отправки сообщения")
-            await state.clear()
-            return
-        
-        sent_count = 0
-        error_count = 0
-        
-        progress_msg = await message.answer(f"📤 Отправка сообщения {len(users)} пользователям...")
-        
-        for target_user in users:
-            try:
-                await bot.send_message(target_user.telegram_id, message_text)
-                sent_count += 1
-            except Exception as e:
-                logger.warning(f"Failed to send broadcast to {target_user.telegram_id}: {e}")
-                error_count += 1
-            
-            await asyncio.sleep(0.05)
+        await callback.message.edit_text("📤 Подготовка рассылки...")
+        
+        job = await broadcast_service.start_broadcast(
+            admin_id=user.telegram_id,
+            message_text=message_text,
+            audience=audience,
+            progress_chat_id=callback.message.chat.id,
+            progress_message_id=callback.message.message_id
+        )
         
-        await progress_msg.edit_text(
-            t('broadcast_sent', user.language) + "\n" + 
-            t('broadcast_stats', user.language, sent=sent_count, errors=error_count),
-            reply_markup=admin_menu_keyboard(user.language)
+        await callback.message.edit_text(
+            broadcast_service.format_progress(job),
+            reply_markup=broadcast_control_keyboard(job.id, job.status, user.language)
         )
+        await callback.answer("📢 Рассылка запущена")
         
-        log_user_action(user.telegram_id, "broadcast_sent", f"Sent: {sent_count}, Errors: {error_count}")
+        log_user_action(user.telegram_id, "broadcast_started", f"Job: {job.id}, audience: {audience}, recipients: {job.total_count}")
         
     except Exception as e:
-        logger.error(f"Error sending broadcast: {e}")
-        await message.answer(
+        logger.error(f"Error starting broadcast: {e}")
+        await callback.message.edit_text(
             t('error_occurred', user.language),
             reply_markup=admin_menu_keyboard(user.language)
         )
+
+@admin_router.callback_query(F.data.regexp(r"^broadcast_(pause|resume|cancel)_\d+$"))
+async def broadcast_control_callback(callback: CallbackQuery, user: User, **kwargs):
+    if not await check_admin_access(callback, user):
+        return
     
-    await state.clear()
+    broadcast_service = kwargs.get('broadcast_service')
+    if not broadcast_service:
+        await callback.answer("❌ Сервис рассылок недоступен", show_alert=True)
+        return
+    
+    _, action, job_id = callback.data.split("_")
+    job_id = int(job_id)
+    
+    if action == "pause":
+        success = await broadcast_service.pause(job_id)
+        answer = "⏸ Рассылка будет приостановлена" if success else "❌ Не удалось приостановить рассылку"
+    elif action == "resume":
+        success = await broadcast_service.resume(job_id)
+        answer = "▶️ Рассылка продолжена" if success else "❌ Не удалось продолжить рассылку"
+    else:
+        success = await broadcast_service.cancel(job_id)
+        answer = "⏹ Рассылка будет отменена" if success else "❌ Не удалось отменить рассылку"
+    
+    log_user_action(user.telegram_id, f"broadcast_{action}", f"Job: {job_id}, success: {success}")
+    await callback.answer(answer, show_alert=not success)
 
 @admin_router.callback_query(F.data == "admin_system")
 async def admin_system_callback(callback: CallbackQuery, user: User, **kwargs):
@@ -2659,6 +2798,56 @@ async def debug_api_comprehensive_callback(callback: CallbackQuery, user: User,
         logger.error(f"Failed to send diagnostic results: {e}")
         await callback.answer("❌ Ошибка отправки результатов диагностики", show_alert=True)
 
+@admin_router.callback_query(F.data.in_({"api_metrics", "api_metrics_reset"}))
+async def api_metrics_callback(callback: CallbackQuery, user: User, api: RemnaWaveAPI = None, **kwargs):
+    if not await check_admin_access(callback, user):
+        return
+    
+    if not api:
+        await callback.answer("❌ API недоступен", show_alert=True)
+        return
+    
+    if callback.data == "api_metrics_reset":
+        api.metrics.reset()
+    
+    metrics = api.get_metrics(limit=10)
+    
+    text = "📈 Метрики запросов к RemnaWave API\n\n"
+    text += f"🕐 С {format_datetime(metrics['since'], user.language)}\n"
+    text += f"📊 Запросов: {metrics['requests']}, ошибок: {metrics['errors']}\n"
+    text += f"⏱ Суммарное время: {metrics['total_time']:.1f} с\n"
+    text += f"🔗 Объединено GET-запросов: {metrics['coalesced']}\n"
+    
+    breaker = metrics['breaker']
+    breaker_labels = {'closed': '🟢 замкнут', 'open': '🔴 разомкнут', 'half_open': '🟡 проверка'}
+    text += f"🛡 Circuit breaker: {breaker_labels.get(breaker['state'], breaker['state'])}"
+    text += f" (ошибок подряд: {breaker['consecutive_failures']}, отклонено: {breaker['rejected']})\n\n"
+    
+    if not metrics['endpoints']:
+        text += "Запросов пока не было"
+    
+    for row in metrics['endpoints']:
+        text += f"🔹 {row['endpoint']}\n"
+        text += f"   {row['count']} запр. | Σ {row['total_time']:.1f} с | ср. {row['avg_time'] * 1000:.0f} мс | "
+        text += f"p95 ≤ {row['p95_time'] * 1000:.0f} мс | макс. {row['max_time'] * 1000:.0f} мс\n"
+        if row['errors']:
+            text += f"   ❌ Ошибок: {row['errors']} ({', '.join(f'{k}: {v}' for k, v in row['statuses'].items())})\n"
+    
+    if len(text) > 4000:
+        text = text[:3900] + "\n\n... (текст обрезан)"
+    
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data="api_metrics"),
+         InlineKeyboardButton(text="🗑 Сбросить", callback_data="api_metrics_reset")],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_system")]
+    ])
+    
+    try:
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    except Exception as e:
+        logger.debug(f"API metrics message not updated: {e}")
+    await callback.answer()
+
 async def analyze_nodes_response(json_data, diagnostic_text):
     try:
         nodes_list = []
@@ -3604,6 +3793,7 @@ async def confirm_bulk_reset_traffic_callback(callback: CallbackQuery, user: Use
             result = await api.bulk_reset_all_traffic()
             
             if result:
+                invalidate_panel_users(kwargs.get('panel_users_store'))
                 await callback.message.edit_text(
                     "✅ Трафик сброшен для всех пользователей!",
                     reply_markup=bulk_operations_keyboard(user.language)
@@ -3684,10 +3874,23 @@ async def list_all_system_users_callback(callback: CallbackQuery, user: User, ap
         await callback.answer()
         return
     
-    await show_system_users_list_paginated(callback, user, api, state, page=0)
+    await show_system_users_list_paginated(callback, user, api, state, page=0,
+                                           store=kwargs.get('panel_users_store'))
+
+async def get_panel_users_snapshot(api: RemnaWaveAPI, store: PanelUsersStore = None,
+                                   force_refresh: bool = False) -> PanelUsersSnapshot:
+    if store:
+        return await store.get_snapshot(force_refresh=force_refresh)
+    return PanelUsersSnapshot([u async for u in api.iter_system_users(with_urls=False)])
+
+def invalidate_panel_users(store: PanelUsersStore = None):
+    """После изменений в панели список и счетчики пользователей перечитываются"""
+    if store:
+        store.invalidate()
 
 async def show_system_users_list_paginated(callback: CallbackQuery, user: User, api: RemnaWaveAPI = None, 
-                                           state: FSMContext = None, page: int = 0):
+                                           state: FSMContext = None, page: int = 0,
+                                           store: PanelUsersStore = None, force_refresh: bool = False):
     try:
         if not api:
             await callback.message.edit_text(
@@ -3698,34 +3901,27 @@ async def show_system_users_list_paginated(callback: CallbackQuery, user: User,
         
         await callback.answer("📋 Загружаю список пользователей...")
         
-        all_users = await api.get_all_system_users_full()
-        if not all_users:
+        snapshot = await get_panel_users_snapshot(api, store, force_refresh)
+        if not snapshot or not snapshot.users:
             await callback.message.edit_text(
                 "❌ Пользователи не найдены",
                 reply_markup=system_users_keyboard(user.language)
             )
             return
         
-        all_users.sort(key=lambda x: (
-            0 if x.get('status') == 'ACTIVE' else 1,
-            x.get('createdAt', ''),
-        ), reverse=True)
-        
         users_per_page = 8
-        total_pages = (len(all_users) + users_per_page - 1) // users_per_page
+        page_users, total_pages = snapshot.page(snapshot.users, page, users_per_page)
         start_idx = page * users_per_page
-        end_idx = min(start_idx + users_per_page, len(all_users))
-        page_users = all_users[start_idx:end_idx]
         
-        active_count = len([u for u in all_users if u.get('status') == 'ACTIVE'])
-        disabled_count = len(all_users) - active_count
-        with_telegram = len([u for u in all_users if u.get('telegramId')])
+        active_count = snapshot.counters['active']
+        disabled_count = snapshot.counters['total'] - active_count
+        with_telegram = snapshot.counters['with_telegram']
         
         text = f"👥 Пользователи системы RemnaWave\n"
         text += f"📄 Страница {page + 1} из {total_pages}\n\n"
         
         text += f"📊 Статистика:\n"
-        text += f"├ Всего: {len(all_users)}\n"
+        text += f"├ Всего: {snapshot.counters['total']}\n"
         text += f"├ ✅ Активных: {active_count}\n"
         text += f"├ ❌ Отключенных: {disabled_count}\n"
         text += f"└ 📱 С Telegram: {with_telegram}\n\n"
@@ -3858,17 +4054,22 @@ async def users_page_callback(callback: CallbackQuery, user: User, api: RemnaWav
     
     try:
         page = int(callback.data.split("_")[-1])
-        await show_system_users_list_paginated(callback, user, api, state, page)
+        await show_system_users_list_paginated(callback, user, api, state, page,
+                                               store=kwargs.get('panel_users_store'))
     except Exception as e:
         logger.error(f"Error in pagination: {e}")
         await callback.answer("❌ Ошибка навигации", show_alert=True)
 
 @admin_router.callback_query(F.data.startswith("refresh_system_users_"))
-async def refresh_system_users_callback(callback: CallbackQuery, user: User, api: RemnaWaveAPI = None, **kwargs):
+@admin_router.callback_query(F.data.startswith("refresh_users_page_"))
+async def refresh_system_users_callback(callback: CallbackQuery, user: User, api: RemnaWaveAPI = None, state: FSMContext = None, **kwargs):
     if not await check_admin_access(callback, user):
         return
     
-    await show_system_users_list(callback, user, api, force_refresh=True)
+    suffix = callback.data.split("_")[-1]
+    page = int(suffix) if suffix.isdigit() else 0
+    await show_system_users_list_paginated(callback, user, api, state, page,
+                                           store=kwargs.get('panel_users_store'), force_refresh=True)
 
 def system_stats_keyboard(language: str, timestamp: int = None) -> InlineKeyboardMarkup:
     refresh_callback = f"refresh_system_stats_{timestamp}" if timestamp else "refresh_system_stats"
@@ -3946,6 +4147,16 @@ async def users_statistics_callback(callback: CallbackQuery, user: User, api: Re
         if users_count is not None:
             text += f"👥 Всего пользователей: {users_count}\n"
         
+        store = kwargs.get('panel_users_store')
+        snapshot = await store.get_snapshot() if store else None
+        if snapshot:
+            counters = snapshot.counters
+            text += f"├ 🟢 ACTIVE: {counters['active']}\n"
+            text += f"├ 🔴 DISABLED: {counters['disabled']}\n"
+            text += f"├ 🟡 LIMITED: {counters['limited']}\n"
+            text += f"├ ⏰ EXPIRED: {counters['expired']}\n"
+            text += f"└ 📱 С Telegram: {counters['with_telegram']}\n"
+        
         if system_stats:
             if 'users' in system_stats:
                 text += f"• Активных пользователей: {system_stats['users']}\n"
@@ -4194,6 +4405,7 @@ async def handle_edit_user_expiry(message: Message, state: FSMContext, user: Use
         result = await api.update_user(user_uuid, {'expireAt': expiry_str, 'status': 'ACTIVE'})
         
         if result:
+            invalidate_panel_users(kwargs.get('panel_users_store'))
             await message.answer(
                 f"✅ Срок действия обновлен!\n\n"
                 f"Новая дата истечения: {new_expiry.strftime('%Y-%m-%d %H:%M')}",
@@ -4245,6 +4457,7 @@ async def handle_edit_user_expiry(message: Message, state: FSMContext, user: Use
         result = await api.update_user(user_uuid, {'expireAt': expiry_str, 'status': 'ACTIVE'})
         
         if result:
+            invalidate_panel_users(kwargs.get('panel_users_store'))
             await message.answer(
                 f"✅ Срок действия обновлен!\n\n"
                 f"Новая дата истечения: {new_expiry.strftime('%Y-%m-%d %H:%M')}",
@@ -4300,6 +4513,7 @@ async def handle_edit_user_traffic(message: Message, state: FSMContext, user: Us
         result = await api.update_user_traffic_limit(user_uuid, traffic_gb)
         
         if result:
+            invalidate_panel_users(kwargs.get('panel_users_store'))
             traffic_text = f"{traffic_gb} ГБ" if traffic_gb > 0 else "Безлимитный"
             await message.answer(
                 f"✅ Лимит трафика обновлен!\n\n"
@@ -4374,93 +4588,45 @@ def sync_remnawave_keyboard(language: str = 'ru') -> InlineKeyboardMarkup:
     ]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-@admin_router.callback_query(F.data == "sync_users_remnawave")
-async def sync_users_remnawave_callback(callback: CallbackQuery, user: User, api: RemnaWaveAPI = None, db: Database = None, **kwargs):
-    if not await check_admin_access(callback, user):
+async def start_remnawave_sync(callback: CallbackQuery, user: User, mode: str, sync_service, start_text: str):
+    if not sync_service:
+        await callback.answer("❌ Сервис синхронизации недоступен", show_alert=True)
         return
     
-    if not api or not db:
-        await callback.answer("❌ API или база данных недоступны", show_alert=True)
+    if sync_service.is_busy:
+        await callback.answer("⏳ Синхронизация уже выполняется, дождитесь отчета", show_alert=True)
         return
     
-    try:
-        await callback.answer("🔄 Запускаю синхронизацию пользователей...")
-        
-        progress_msg = await callback.message.edit_text("⏳ Синхронизация пользователей...\n\n0% выполнено")
-        
-        remna_users = await api.get_all_system_users_full()
-        if not remna_users:
-            await progress_msg.edit_text(
-                "❌ Не удалось получить пользователей из RemnaWave",
-                reply_markup=back_keyboard("sync_remnawave", user.language)
-            )
-            return
-        
-        total_users = len(remna_users)
-        synced = 0
-        created = 0
-        updated = 0
-        errors = 0
-        
-        for i, remna_user in enumerate(remna_users):
-            try:
-                if i % 10 == 0:
-                    progress = (i / total_users) * 100
-                    await progress_msg.edit_text(
-                        f"⏳ Синхронизация пользователей...\n\n"
-                        f"{progress:.1f}% выполнено\n"
-                        f"Обработано: {i}/{total_users}"
-                    )
-                
-                telegram_id = remna_user.get('telegramId')
-                if not telegram_id:
-                    continue
-                
-                bot_user = await db.get_user_by_telegram_id(telegram_id)
-                
-                if not bot_user:
-                    bot_user = await db.create_user(
-                        telegram_id=telegram_id,
-                        username=remna_user.get('username'),
-                        language='ru',
-                        is_admin=telegram_id in (kwargs.get('config', {}).ADMIN_IDS if 'config' in kwargs else [])
-                    )
-                    created += 1
-                
-                if not bot_user.remnawave_uuid:
-                    bot_user.remnawave_uuid = remna_user.get('uuid')
-                    await db.update_user(bot_user)
-                    updated += 1
-                
-                synced += 1
-                
-            except Exception as e:
-                logger.error(f"Error syncing user {remna_user.get('username')}: {e}")
-                errors += 1
-        
-        result_text = (
-            f"✅ Синхронизация пользователей завершена!\n\n"
-            f"📊 Результаты:\n"
-            f"• Всего пользователей в RemnaWave: {total_users}\n"
-            f"• Синхронизировано: {synced}\n"
-            f"• Создано новых: {created}\n"
-            f"• Обновлено: {updated}\n"
-            f"• Ошибок: {errors}"
-        )
-        
+    await callback.answer(start_text)
+    
+    progress_msg = await callback.message.edit_text(
+        f"⏳ {sync_service.MODES[mode]['title']}\n\n"
+        "Подготовка..."
+    )
+    
+    job = sync_service.start_sync(
+        mode,
+        chat_id=progress_msg.chat.id,
+        message_id=progress_msg.message_id,
+        reply_markup=sync_remnawave_keyboard(user.language)
+    )
+    
+    if not job:
         await progress_msg.edit_text(
-            result_text,
-            reply_markup=sync_remnawave_keyboard(user.language)
-        )
-        
-        log_user_action(user.telegram_id, "users_synced", f"Total: {total_users}, Synced: {synced}")
-        
-    except Exception as e:
-        logger.error(f"Error in user sync: {e}")
-        await callback.message.edit_text(
-            f"❌ Ошибка синхронизации: {str(e)}",
+            "⏳ Синхронизация уже выполняется, дождитесь отчета",
             reply_markup=sync_remnawave_keyboard(user.language)
         )
+        return
+    
+    log_user_action(user.telegram_id, f"sync_{mode}_started", "")
+
+@admin_router.callback_query(F.data == "sync_users_remnawave")
+async def sync_users_remnawave_callback(callback: CallbackQuery, user: User, **kwargs):
+    if not await check_admin_access(callback, user):
+        return
+    
+    await start_remnawave_sync(callback, user, 'users', kwargs.get('sync_service'),
+                               "🔄 Запускаю синхронизацию пользователей...")
 
 @admin_router.callback_query(F.data == "sync_subscriptions_remnawave")
 async def sync_subscriptions_remnawave_callback(callback: CallbackQuery, user: User, api: RemnaWaveAPI = None, db: Database = None, **kwargs):
@@ -4530,7 +4696,7 @@ async def sync_subscriptions_remnawave_callback(callback: CallbackQuery, user: U
                 
                 if not bot_user.remnawave_uuid and remna_user.get('uuid'):
                     bot_user.remnawave_uuid = remna_user['uuid']
-                    await db.update_user(bot_user)
+                    await db.update_user_fields(telegram_id, remnawave_uuid=bot_user.remnawave_uuid)
                     updated_users += 1
                     logger.debug(f"Updated RemnaWave UUID for user {telegram_id}")
                 
@@ -4731,6 +4897,8 @@ async def sync_subscriptions_remnawave_callback(callback: CallbackQuery, user: U
             reply_markup=sync_remnawave_keyboard(user.language)
         )
         
+        invalidate_panel_users(kwargs.get('panel_users_store'))
+        
         log_user_action(user.telegram_id, "improved_sync_completed", 
                        f"Created: {created_subs}, Updated: {updated_subs}, Users: {created_users}")
         
@@ -4758,6 +4926,7 @@ async def reset_user_traffic_callback(callback: CallbackQuery, user: User, api:
         result = await api.reset_user_traffic(user_uuid)
         
         if result:
+            invalidate_panel_users(kwargs.get('panel_users_store'))
             await callback.answer("✅ Трафик пользователя успешно сброшен", show_alert=True)
             log_user_action(user.telegram_id, "reset_user_traffic", f"UUID: {user_uuid}")
             
@@ -4794,6 +4963,7 @@ async def disable_user_callback(callback: CallbackQuery, user: User, api: RemnaW
         result = await api.disable_user(user_uuid)
         
         if result:
+            invalidate_panel_users(kwargs.get('panel_users_store'))
             await callback.answer("✅ Пользователь успешно отключен", show_alert=True)
             log_user_action(user.telegram_id, "disable_user", f"UUID: {user_uuid}")
         else:
@@ -4820,6 +4990,7 @@ async def enable_user_callback(callback: CallbackQuery, user: User, api: RemnaWa
         result = await api.enable_user(user_uuid)
         
         if result:
+            invalidate_panel_users(kwargs.get('panel_users_store'))
             await callback.answer("✅ Пользователь успешно включен", show_alert=True)
             log_user_action(user.telegram_id, "enable_user", f"UUID: {user_uuid}")
         else:
@@ -4879,7 +5050,14 @@ async def sync_status_remnawave_callback(callback: CallbackQuery, user: User, ap
         text += f"• Всего в боте: {total_bot_subs}\n"
         text += f"• Синхронизировано: {synced_subs}\n"
         text += f"• Не синхронизировано: {total_bot_subs - synced_subs}\n\n"
-        
+
+        sync_service = kwargs.get('sync_service')
+        if sync_service and sync_service.delta_interval > 0:
+            watermark = await db.get_sync_watermark(sync_service.WATERMARK_NAME)
+            text += "Инкрементальная синхронизация:\n"
+            text += f"• Период: {sync_service.delta_interval} сек.\n"
+            text += f"• Изменения учтены до: {format_datetime(watermark, user.language) + ' UTC' if watermark else 'еще не выполнялась'}\n\n"
+
         if bot_without_uuid > 0 or remna_without_tg > 0 or (total_bot_subs - synced_subs) > 0:
             text += "⚠️ Рекомендации:\n"
             if bot_without_uuid > 0:
@@ -4918,8 +5096,9 @@ async def filter_users_active_callback(callback: CallbackQuery, user: User, api:
     try:
         await callback.answer("🔍 Фильтрую активных пользователей...")
         
-        all_users = await api.get_all_system_users_full()
-        active_users = [u for u in all_users if u.get('status') == 'ACTIVE']
+        snapshot = await get_panel_users_snapshot(api, kwargs.get('panel_users_store'))
+        active_users = snapshot.by_status.get('ACTIVE', [])[:10]
+        active_count = snapshot.counters['active']
         
         if not active_users:
             await callback.message.edit_text(
@@ -4928,9 +5107,9 @@ async def filter_users_active_callback(callback: CallbackQuery, user: User, api:
             )
             return
         
-        text = f"✅ Активные пользователи ({len(active_users)})\n\n"
+        text = f"✅ Активные пользователи ({active_count})\n\n"
         
-        for i, sys_user in enumerate(active_users[:10], 1):
+        for i, sys_user in enumerate(active_users, 1):
             username = sys_user.get('username', 'N/A')
             username = username.replace('*', '').replace('_', '').replace('[', '').replace(']', '').replace('`', '')
             
@@ -4947,8 +5126,8 @@ async def filter_users_active_callback(callback: CallbackQuery, user: User, api:
                 text += f"   ⏰ До {expire_date}\n"
             text += "\n"
         
-        if len(active_users) > 10:
-            text += f"... и еще {len(active_users) - 10} активных пользователей"
+        if active_count > 10:
+            text += f"... и еще {active_count - 10} активных пользователей"
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="❌ Сбросить фильтр", callback_data="list_all_system_users")],
@@ -4977,8 +5156,9 @@ async def filter_users_telegram_callback(callback: CallbackQuery, user: User, ap
     try:
         await callback.answer("🔍 Фильтрую пользователей с Telegram...")
         
-        all_users = await api.get_all_system_users_full()
-        tg_users = [u for u in all_users if u.get('telegramId')]
+        snapshot = await get_panel_users_snapshot(api, kwargs.get('panel_users_store'))
+        tg_users = snapshot.with_telegram[:10]
+        tg_count = snapshot.counters['with_telegram']
         
         if not tg_users:
             await callback.message.edit_text(
@@ -4987,9 +5167,9 @@ async def filter_users_telegram_callback(callback: CallbackQuery, user: User, ap
             )
             return
         
-        text = f"📱 **Пользователи с Telegram ID** ({len(tg_users)})\n\n"
+        text = f"📱 **Пользователи с Telegram ID** ({tg_count})\n\n"
         
-        for i, sys_user in enumerate(tg_users[:10], 1):
+        for i, sys_user in enumerate(tg_users, 1):
             username = sys_user.get('username', 'N/A')
             telegram_id = sys_user.get('telegramId')
             status = sys_user.get('status', 'UNKNOWN')
@@ -5006,8 +5186,8 @@ async def filter_users_telegram_callback(callback: CallbackQuery, user: User, ap
                 text += f"   ⏰ До {expire_date}\n"
             text += "\n"
         
-        if len(tg_users) > 10:
-            text += f"_... и еще {len(tg_users) - 10} пользователей с Telegram_"
+        if tg_count > 10:
+            text += f"_... и еще {tg_count - 10} пользователей с Telegram_"
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="❌ Сбросить фильтр", callback_data="list_all_system_users")],
@@ -5131,253 +5311,12 @@ async def nodes_page_callback(callback: CallbackQuery, user: User, api: RemnaWav
         await callback.answer("❌ Ошибка навигации", show_alert=True)
 
 @admin_router.callback_query(F.data == "sync_full_remnawave")
-async def sync_full_remnawave_callback(callback: CallbackQuery, user: User, api: RemnaWaveAPI = None, db: Database = None, **kwargs):
+async def sync_full_remnawave_callback(callback: CallbackQuery, user: User, **kwargs):
     if not await check_admin_access(callback, user):
         return
     
-    if not api or not db:
-        await callback.answer("❌ API или база данных недоступны", show_alert=True)
-        return
-    
-    try:
-        await callback.answer("🔄 Запускаю полную синхронизацию...")
-        
-        progress_msg = await callback.message.edit_text(
-            "⏳ Полная синхронизация RemnaWave\n\n"
-            "Этап 1/5: Получение данных..."
-        )
-        
-        remna_users = await api.get_all_system_users_full()
-        users_with_tg = [u for u in remna_users if u.get('telegramId')]
-        
-        logger.info(f"Starting full sync for {len(users_with_tg)} users with Telegram ID")
-        
-        users_created = 0
-        users_updated = 0
-        subs_created = 0
-        subs_updated = 0
-        plans_created = 0
-        statuses_updated = 0
-        errors = 0
-        
-        await progress_msg.edit_text(
-            "⏳ Полная синхронизация RemnaWave\n\n"
-            "Этап 1/5: Синхронизация пользователей..."
-        )
-        
-        for remna_user in users_with_tg:
-            try:
-                telegram_id = remna_user['telegramId']
-                bot_user = await db.get_user_by_telegram_id(telegram_id)
-                
-                if not bot_user:
-                    is_admin = telegram_id in (kwargs.get('config', {}).ADMIN_IDS if 'config' in kwargs else [])
-                    bot_user = await db.create_user(
-                        telegram_id=telegram_id,
-                        username=remna_user.get('username'),
-                        first_name=remna_user.get('username'),
-                        language='ru',
-                        is_admin=is_admin
-                    )
-                    users_created += 1
-                    logger.info(f"Created user {telegram_id}")
-                
-                if not bot_user.remnawave_uuid and remna_user.get('uuid'):
-                    bot_user.remnawave_uuid = remna_user['uuid']
-                    await db.update_user(bot_user)
-                    users_updated += 1
-                
-            except Exception as e:
-                logger.error(f"Error syncing user {telegram_id}: {e}")
-                errors += 1
-        
-        await progress_msg.edit_text(
-            "⏳ Полная синхронизация RemnaWave\n\n"
-            "Этап 2/5: Создание планов подписок..."
-        )
-        
-        unique_squads = set()
-        for remna_user in users_with_tg:
-            active_squads = remna_user.get('activeInternalSquads', [])
-            internal_squads = remna_user.get('internalSquads', [])
-            
-            for squad_list in [active_squads, internal_squads]:
-                for squad in squad_list:
-                    if isinstance(squad, dict):
-                        squad_uuid = squad.get('uuid') or squad.get('id')
-                    else:
-                        squad_uuid = str(squad)
-                    
-                    if squad_uuid:
-                        unique_squads.add(squad_uuid)
-        
-        logger.info(f"Found {len(unique_squads)} unique squads")
-        
-        existing_plans = await db.get_all_subscriptions(include_inactive=True, exclude_trial=False)
-        existing_squad_uuids = {plan.squad_uuid for plan in existing_plans if plan.squad_uuid}
-        
-        for squad_uuid in unique_squads:
-            if squad_uuid not in existing_squad_uuids:
-                try:
-                    plan_name = f"Auto_Squad_{squad_uuid[:8]}"
-                    new_plan = await db.create_subscription(
-                        name=plan_name,
-                        description=f"Автоматически созданный план для squad {squad_uuid}",
-                        price=0,
-                        duration_days=30,
-                        traffic_limit_gb=0,
-                        squad_uuid=squad_uuid
-                    )
-                    plans_created += 1
-                    logger.info(f"Created subscription plan for squad {squad_uuid}")
-                except Exception as e:
-                    logger.error(f"Error creating plan for squad {squad_uuid}: {e}")
-                    errors += 1
-        
-        await progress_msg.edit_text(
-            "⏳ Полная синхронизация RemnaWave\n\n"
-            "Этап 3/5: Синхронизация подписок..."
-        )
-        
-        for remna_user in users_with_tg:
-            try:
-                telegram_id = remna_user['telegramId']
-                short_uuid = remna_user.get('shortUuid')
-                
-                if not short_uuid:
-                    continue
-                
-                existing_sub = await db.get_user_subscription_by_short_uuid(telegram_id, short_uuid)
-                
-                if existing_sub:
-                    if remna_user.get('expireAt'):
-                        try:
-                            expire_dt = datetime.fromisoformat(remna_user['expireAt'].replace('Z', '+00:00'))
-                            existing_sub.expires_at = expire_dt.replace(tzinfo=None)
-                        except:
-                            pass
-                    
-                    existing_sub.is_active = remna_user.get('status') == 'ACTIVE'
-                    await db.update_user_subscription(existing_sub)
-                    subs_updated += 1
-                    
-                else:
-                    if remna_user.get('status') == 'ACTIVE' or remna_user.get('expireAt'):
-                        squad_uuid = None
-                        active_squads = remna_user.get('activeInternalSquads', [])
-                        
-                        if active_squads:
-                            first_squad = active_squads[0]
-                            if isinstance(first_squad, dict):
-                                squad_uuid = first_squad.get('uuid') or first_squad.get('id')
-                            else:
-                                squad_uuid = str(first_squad)
-                        
-                        subscription_plan = None
-                        all_plans = await db.get_all_subscriptions(include_inactive=True, exclude_trial=False)
-                        
-                        for plan in all_plans:
-                            if plan.squad_uuid == squad_uuid:
-                                subscription_plan = plan
-                                break
-                        
-                        if subscription_plan:
-                            expire_dt = None
-                            if remna_user.get('expireAt'):
-                                try:
-                                    expire_dt = datetime.fromisoformat(remna_user['expireAt'].replace('Z', '+00:00'))
-                                    expire_dt = expire_dt.replace(tzinfo=None)
-                                except:
-                                    expire_dt = datetime.now() + timedelta(days=30)
-                            else:
-                                expire_dt = datetime.now() + timedelta(days=30)
-                            
-                            user_sub = await db.create_user_subscription(
-                                user_id=telegram_id,
-                                subscription_id=subscription_plan.id,
-                                short_uuid=short_uuid,
-                                expires_at=expire_dt,
-                                is_active=remna_user.get('status') == 'ACTIVE'
-                            )
-                            
-                            if user_sub:
-                                subs_created += 1
-                                logger.info(f"Created subscription for user {telegram_id}")
-                
-            except Exception as e:
-                logger.error(f"Error syncing subscription for user {telegram_id}: {e}")
-                errors += 1
-        
-        await progress_msg.edit_text(
-            "⏳ Полная синхронизация RemnaWave\n\n"
-            "Этап 4/5: Обновление статусов..."
-        )
-        
-        all_bot_users = await db.get_all_users()
-        for bot_user in all_bot_users:
-            user_subs = await db.get_user_subscriptions(bot_user.telegram_id)
-            
-            for user_sub in user_subs:
-                if user_sub.expires_at < datetime.now() and user_sub.is_active:
-                    user_sub.is_active = False
-                    await db.update_user_subscription(user_sub)
-                    statuses_updated += 1
-                    
-                    if bot_user.remnawave_uuid:
-                        try:
-                            await api.update_user(bot_user.remnawave_uuid, {'status': 'EXPIRED'})
-                        except:
-                            pass
-        
-        await progress_msg.edit_text(
-            "⏳ Полная синхронизация RemnaWave\n\n"
-            "Этап 5/5: Подсчет результатов..."
-        )
-        
-        total_bot_users = len(await db.get_all_users())
-        total_subscriptions = 0
-        active_subscriptions = 0
-        
-        for bot_user in all_bot_users:
-            user_subs = await db.get_user_subscriptions(bot_user.telegram_id)
-            total_subscriptions += len(user_subs)
-            active_subscriptions += len([s for s in user_subs if s.is_active])
-        
-        result_text = (
-            "✅ Полная синхронизация завершена!\n\n"
-            "📊 Результаты операции:\n\n"
-            "👥 Пользователи:\n"
-            f"• Создано: {users_created}\n"
-            f"• Обновлено: {users_updated}\n\n"
-            "📋 Планы подписок:\n"
-            f"• Создано новых планов: {plans_created}\n\n"
-            "🎫 Подписки:\n"
-            f"• Создано: {subs_created}\n"
-            f"• Обновлено: {subs_updated}\n\n"
-            "🔄 Статусы:\n"
-            f"• Обновлено: {statuses_updated}\n"
-            f"• Ошибок: {errors}\n\n"
-            "📈 Текущее состояние:\n"
-            f"• Пользователей в боте: {total_bot_users}\n"
-            f"• Всего подписок: {total_subscriptions}\n"
-            f"• Активных подписок: {active_subscriptions}\n\n"
-            f"🕐 Завершено: {format_datetime(datetime.now(), user.language)}"
-        )
-        
-        await progress_msg.edit_text(
-            result_text,
-            reply_markup=sync_remnawave_keyboard(user.language)
-        )
-        
-        log_user_action(user.telegram_id, "full_sync_improved_completed", 
-                       f"Users: {users_created}/{users_updated}, Subs: {subs_created}/{subs_updated}, Plans: {plans_created}")
-        
-    except Exception as e:
-        logger.error(f"Error in improved full sync: {e}", exc_info=True)
-        await callback.message.edit_text(
-            f"❌ Ошибка полной синхронизации\n\nДетали: {str(e)[:200]}",
-            reply_markup=sync_remnawave_keyboard(user.language)
-        )
+    await start_remnawave_sync(callback, user, 'full', kwargs.get('sync_service'),
+                               "🔄 Запускаю полную синхронизацию...")
 
 @admin_router.callback_query(F.data == "sync_single_user")
 async def sync_single_user_callback(callback: CallbackQuery, user: User, state: FSMContext, **kwargs):
@@ -5454,7 +5393,7 @@ async def handle_sync_single_user(message: Message, state: FSMContext, user: Use
         
         if not bot_user.remnawave_uuid and remna_user.get('uuid'):
             bot_user.remnawave_uuid = remna_user['uuid']
-            await db.update_user(bot_user)
+            await db.update_user_fields(bot_user.telegram_id, remnawave_uuid=bot_user.remnawave_uuid)
             result_details.append("✅ Обновлен RemnaWave UUID")
         
         short_uuid = remna_user.get('shortUuid')
@@ -5593,330 +5532,12 @@ async def handle_sync_single_user(message: Message, state: FSMContext, user: Use
     await state.clear()
 
 @admin_router.callback_query(F.data == "import_all_by_telegram")
-async def import_all_by_telegram_callback(callback: CallbackQuery, user: User, api: RemnaWaveAPI = None, db: Database = None, **kwargs):
+async def import_all_by_telegram_callback(callback: CallbackQuery, user: User, **kwargs):
     if not await check_admin_access(callback, user):
         return
     
-    if not api or not db:
-        await callback.answer("❌ API или база данных недоступны", show_alert=True)
-        return
-    
-    try:
-        await callback.answer("🔄 Запускаю массовый импорт всех подписок...")
-        
-        progress_msg = await callback.message.edit_text(
-            "⏳ Массовый импорт подписок по Telegram ID\n\n"
-            "Этап 1/5: Получение всех записей из RemnaWave..."
-        )
-        
-        all_remna_records = await api.get_all_system_users_full()
-        
-        if not all_remna_records:
-            await progress_msg.edit_text(
-                "❌ Не удалось получить записи из RemnaWave",
-                reply_markup=sync_remnawave_keyboard(user.language)
-            )
-            return
-        
-        logger.info(f"Got {len(all_remna_records)} total records from RemnaWave")
-        
-        records_with_telegram = [r for r in all_remna_records if r.get('telegramId')]
-        
-        logger.info(f"Found {len(records_with_telegram)} records with Telegram ID")
-        
-        users_by_telegram = {}
-        for record in records_with_telegram:
-            tg_id = record['telegramId']
-            if tg_id not in users_by_telegram:
-                users_by_telegram[tg_id] = []
-            users_by_telegram[tg_id].append(record)
-        
-        logger.info(f"Found {len(users_by_telegram)} unique Telegram users with {len(records_with_telegram)} total subscriptions")
-        
-        bot_users_created = 0
-        bot_users_updated = 0
-        plans_created = 0
-        subscriptions_imported = 0
-        subscriptions_updated = 0
-        errors = 0
-        skipped_no_shortuid = 0
-        
-        await progress_msg.edit_text(
-            "⏳ Массовый импорт подписок по Telegram ID\n\n"
-            "Этап 1/5: Создание пользователей бота..."
-        )
-        
-        for telegram_id, user_records in users_by_telegram.items():
-            try:
-                logger.info(f"Processing Telegram user {telegram_id} with {len(user_records)} subscriptions")
-                
-                latest_record = max(user_records, key=lambda x: x.get('updatedAt', x.get('createdAt', '')))
-                
-                bot_user = await db.get_user_by_telegram_id(telegram_id)
-                
-                if not bot_user:
-                    is_admin = telegram_id in (kwargs.get('config', {}).ADMIN_IDS if 'config' in kwargs else [])
-                    
-                    best_username = None
-                    for record in user_records:
-                        username = record.get('username', '')
-                        if username and not username.startswith('user_'):
-                            best_username = username
-                            break
-                    
-                    if not best_username:
-                        best_username = latest_record.get('username', f"User_{telegram_id}")
-                    
-                    bot_user = await db.create_user(
-                        telegram_id=telegram_id,
-                        username=best_username,
-                        first_name=best_username,
-                        language='ru',
-                        is_admin=is_admin
-                    )
-                    bot_users_created += 1
-                    logger.info(f"Created bot user for TG {telegram_id} with username {best_username}")
-                
-                if latest_record.get('uuid') and bot_user.remnawave_uuid != latest_record['uuid']:
-                    bot_user.remnawave_uuid = latest_record['uuid']
-                    await db.update_user(bot_user)
-                    bot_users_updated += 1
-                
-            except Exception as e:
-                logger.error(f"Error processing Telegram user {telegram_id}: {e}")
-                errors += 1
-        
-        await progress_msg.edit_text(
-            "⏳ Массовый импорт подписок по Telegram ID\n\n"
-            "Этап 2/5: Анализ squad'ов..."
-        )
-        
-        all_squads = set()
-        squad_names = {}
-        
-        for i, record in enumerate(records_with_telegram):
-            logger.debug(f"Analyzing record {i+1}/{len(records_with_telegram)}: {record.get('username')}")
-            
-            active_squads = record.get('activeInternalSquads', [])
-            if active_squads and isinstance(active_squads, list):
-                for squad in active_squads:
-                    if isinstance(squad, dict):
-                        squad_uuid = squad.get('uuid')
-                        squad_name = squad.get('name', 'Unknown Squad')
-                        if squad_uuid:
-                            all_squads.add(squad_uuid)
-                            squad_names[squad_uuid] = squad_name
-                            logger.debug(f"Found squad: {squad_uuid} ({squad_name})")
-        
-        logger.info(f"Found {len(all_squads)} unique squad UUIDs: {list(all_squads)}")
-        
-        await progress_msg.edit_text(
-            "⏳ Массовый импорт подписок по Telegram ID\n\n"
-            "Этап 3/5: Создание планов подписок..."
-        )
-        
-        existing_plans = await db.get_all_subscriptions_admin()
-        existing_squad_uuids = {plan.squad_uuid for plan in existing_plans if plan.squad_uuid}
-        
-        logger.info(f"Existing squad UUIDs in DB: {existing_squad_uuids}")
-        
-        for squad_uuid in all_squads:
-            if squad_uuid not in existing_squad_uuids:
-                try:
-                    squad_name = squad_names.get(squad_uuid, "Unknown Squad")
-                    plan_name = f"Import_{squad_name[:15]}_{squad_uuid[:8]}"
-                    
-                    logger.info(f"Creating plan for squad {squad_uuid}: {plan_name}")
-                    
-                    new_plan = await db.create_subscription(
-                        name="Старая подписка",
-                        description=f"Импортированная подписка из RemnaWave (squad: {squad_name})",
-                        price=0,
-                        duration_days=30,
-                        traffic_limit_gb=0,
-                        squad_uuid=squad_uuid,
-                        is_imported=True
-                    )
-                    plans_created += 1
-                    logger.info(f"✅ Created plan for squad {squad_uuid}: {plan_name}")
-                    
-                except Exception as e:
-                    logger.error(f"❌ Error creating plan for squad {squad_uuid}: {e}")
-                    errors += 1
-            else:
-                logger.info(f"Plan for squad {squad_uuid} already exists")
-        
-        await progress_msg.edit_text(
-            "⏳ Массовый импорт подписок по Telegram ID\n\n"
-            "Этап 4/5: Импорт подписок..."
-        )
-        
-        for i, record in enumerate(records_with_telegram):
-            try:
-                telegram_id = record['telegramId']
-                short_uuid = record.get('shortUuid')
-                status = record.get('status', 'UNKNOWN')
-                expire_at = record.get('expireAt')
-                username = record.get('username')
-                
-                logger.info(f"=== IMPORTING SUBSCRIPTION {i+1}/{len(records_with_telegram)} ===")
-                logger.info(f"TG={telegram_id}, Username={username}, shortUuid={short_uuid}, status={status}")
-                
-                if not short_uuid:
-                    skipped_no_shortuid += 1
-                    logger.warning(f"❌ Skipping record: no shortUuid")
-                    continue
-                
-                existing_sub = await db.get_user_subscription_by_short_uuid(telegram_id, short_uuid)
-                
-                if existing_sub:
-                    existing_plan = await db.get_subscription_by_id(existing_sub.subscription_id)
-                    
-                    if existing_plan:
-                        logger.info(f"Updating existing subscription for TG {telegram_id}, shortUuid {short_uuid}")
-                        
-                        if expire_at:
-                            try:
-                                if expire_at.endswith('Z'):
-                                    expire_dt = datetime.fromisoformat(expire_at.replace('Z', '+00:00'))
-                                else:
-                                    expire_dt = datetime.fromisoformat(expire_at)
-                                existing_sub.expires_at = expire_dt.replace(tzinfo=None)
-                            except Exception as date_error:
-                                logger.error(f"Error parsing date: {date_error}")
-                        
-                        existing_sub.is_active = (status == 'ACTIVE')
-                        
-                        if record.get('trafficLimitBytes') is not None:
-                            traffic_gb = record['trafficLimitBytes'] // (1024 * 1024 * 1024) if record['trafficLimitBytes'] > 0 else 0
-                            existing_sub.traffic_limit_gb = traffic_gb
-                        
-                        await db.update_user_subscription(existing_sub)
-                        subscriptions_updated += 1
-                    else:
-                        logger.warning(f"Found orphaned subscription {existing_sub.id} for user {telegram_id}, deleting...")
-                        await db.delete_user_subscription(existing_sub.id)
-                        
-                        logger.info(f"Creating new subscription after cleaning orphaned one")
-                        existing_sub = None 
-                
-                if not existing_sub:
-                    logger.info(f"Creating new subscription for TG {telegram_id}, shortUuid {short_uuid}")
-                    
-                    squad_uuid = None
-                    active_squads = record.get('activeInternalSquads', [])
-                    
-                    if active_squads and isinstance(active_squads, list) and len(active_squads) > 0:
-                        first_squad = active_squads[0]
-                        if isinstance(first_squad, dict):
-                            squad_uuid = first_squad.get('uuid')
-                            logger.info(f"Extracted squad_uuid: {squad_uuid}")
-                    
-                    if not squad_uuid:
-                        logger.warning(f"❌ No squad_uuid found for record {username}")
-                        errors += 1
-                        continue
-                    
-                    all_plans = await db.get_all_subscriptions_admin()
-                    subscription_plan = None
-                    
-                    for plan in all_plans:
-                        if plan.squad_uuid == squad_uuid:
-                            subscription_plan = plan
-                            logger.info(f"✅ Found matching plan: {plan.name}")
-                            break
-                    
-                    if not subscription_plan:
-                        logger.error(f"❌ No subscription plan found for squad {squad_uuid}")
-                        errors += 1
-                        continue
-                    
-                    expire_dt_naive = datetime.now() + timedelta(days=30)  
-                    if expire_at:
-                        try:
-                            if expire_at.endswith('Z'):
-                                expire_dt = datetime.fromisoformat(expire_at.replace('Z', '+00:00'))
-                            else:
-                                expire_dt = datetime.fromisoformat(expire_at)
-                            expire_dt_naive = expire_dt.replace(tzinfo=None)
-                        except Exception as date_error:
-                            logger.error(f"Error parsing expiry date: {date_error}")
-                    
-                    traffic_gb = 0
-                    if record.get('trafficLimitBytes'):
-                        traffic_gb = record['trafficLimitBytes'] // (1024 * 1024 * 1024)
-                    
-                    user_subscription = await db.create_user_subscription(
-                        user_id=telegram_id,
-                        subscription_id=subscription_plan.id,
-                        short_uuid=short_uuid,
-                        expires_at=expire_dt_naive,
-                        is_active=(status == 'ACTIVE'),
-                        traffic_limit_gb=traffic_gb
-                    )
-                    
-                    if user_subscription:
-                        subscriptions_imported += 1
-                        logger.info(f"✅ Successfully imported subscription: TG={telegram_id}, shortUuid={short_uuid}")
-                    else:
-                        logger.error(f"❌ Failed to create subscription for TG {telegram_id}")
-                        errors += 1
-                
-            except Exception as e:
-                logger.error(f"❌ Error importing subscription for record {i+1}: {e}")
-                errors += 1
-        
-        await progress_msg.edit_text(
-            "⏳ Массовый импорт подписок по Telegram ID\n\n"
-            "Этап 5/5: Подсчет результатов..."
-        )
-        
-        final_bot_users = len(await db.get_all_users())
-        final_subscriptions = 0
-        final_active_subs = 0
-        
-        all_bot_users = await db.get_all_users()
-        for bot_user in all_bot_users:
-            user_subs = await db.get_user_subscriptions(bot_user.telegram_id)
-            final_subscriptions += len(user_subs)
-            final_active_subs += len([s for s in user_subs if s.is_active])
-        
-        result_text = (
-            "✅ Массовый импорт подписок завершен!\n\n"
-            "📊 Результаты импорта:\n\n"
-            "👥 Пользователи Telegram:\n"
-            f"• Уникальных пользователей: {len(users_by_telegram)}\n"
-            f"• Создано в боте: {bot_users_created}\n"
-            f"• Обновлено UUID: {bot_users_updated}\n\n"
-            "📋 Планы подписок:\n"
-            f"• Создано новых планов: {plans_created}\n\n"
-            "🎫 Подписки:\n"
-            f"• Всего записей обработано: {len(records_with_telegram)}\n"
-            f"• Импортировано новых: {subscriptions_imported}\n"
-            f"• Обновлено существующих: {subscriptions_updated}\n"
-            f"• Пропущено (нет shortUuid): {skipped_no_shortuid}\n"
-            f"• Ошибок: {errors}\n\n"
-            "📈 Итоговая статистика бота:\n"
-            f"• Пользователей в боте: {final_bot_users}\n"
-            f"• Всего подписок: {final_subscriptions}\n"
-            f"• Активных подписок: {final_active_subs}\n\n"
-            f"🕐 Завершено: {format_datetime(datetime.now(), user.language)}"
-        )
-        
-        await progress_msg.edit_text(
-            result_text,
-            reply_markup=sync_remnawave_keyboard(user.language)
-        )
-        
-        log_user_action(user.telegram_id, "bulk_import_completed", 
-                       f"Records: {len(records_with_telegram)}, Imported: {subscriptions_imported}, Updated: {subscriptions_updated}")
-        
-    except Exception as e:
-        logger.error(f"Error in bulk import: {e}", exc_info=True)
-        await callback.message.edit_text(
-            f"❌ Ошибка массового импорта\n\nДетали: {str(e)[:200]}",
-            reply_markup=sync_remnawave_keyboard(user.language)
-        )
+    await start_remnawave_sync(callback, user, 'import', kwargs.get('sync_service'),
+                               "🔄 Запускаю массовый импорт всех подписок...")
 
 @admin_router.message(StateFilter(BotStates.admin_debug_user_structure))
 async def handle_debug_user_structure(message: Message, state: FSMContext, user: User, api: RemnaWaveAPI = None, **kwargs):
@@ -7559,9 +7180,25 @@ async def autopay_status_callback(callback: CallbackQuery, user: User, **kwargs)
             text += "❌ **Статус:** Остановлен\n"
         
         text += f"⚙️ **Настройки:**\n"
-        text += f"• Интервал проверки: {status['check_interval']//60} мин\n"
+        if status.get('periodic_check', True):
+            text += f"• Интервал проверки: {status['check_interval']//60} мин\n"
+        else:
+            text += f"• Запуск: точно в срок (повтор без средств через {status['check_interval']//60} мин)\n"
         text += f"• API подключен: {'✅' if status['has_api'] else '❌'}\n"
-        text += f"• Бот подключен: {'✅' if status['has_bot'] else '❌'}\n\n"
+        text += f"• Бот подключен: {'✅' if status['has_bot'] else '❌'}\n"
+        text += f"• Параллельных продлений: {status.get('concurrency', 1)}\n\n"
+        
+        last_run = status.get('last_run')
+        if last_run:
+            text += f"⏱ **Последний прогон** ({format_datetime(last_run['started_at'], user.language)}):\n"
+            text += f"• Длительность: {last_run['duration']:.1f} с "
+            text += f"(выборка {last_run['fetch_time']:.1f} с, списание {last_run['charge_time']:.1f} с, "
+            text += f"продление {last_run['renew_time']:.1f} с)\n"
+            text += f"• Обработано: {last_run['processed']}, успешно: {last_run['successful']}, "
+            text += f"без средств: {last_run['insufficient_balance']}, ошибок: {last_run['failed']}\n"
+            if status.get('in_progress'):
+                text += "• Сейчас выполняется новый прогон\n"
+            text += "\n"
         
         text += f"📊 **Статистика:**\n"
         text += f"• Подписок с автоплатежом: {len(subscriptions_with_autopay)}\n"
@@ -7714,7 +7351,10 @@ async def autopay_statistics_callback(callback: CallbackQuery, user: User, **kwa
             service_status = await autopay_service.get_service_status()
             status_emoji = "✅" if service_status['is_running'] else "❌"
             text += f"🔧 **Статус сервиса:** {status_emoji}\n"
-            text += f"• Интервал проверки: {service_status['check_interval']//60} мин\n"
+            if service_status.get('periodic_check', True):
+                text += f"• Интервал проверки: {service_status['check_interval']//60} мин\n"
+            else:
+                text += f"• Запуск: точно в срок (планировщик)\n"
         else:
             text += f"🔧 **Статус сервиса:** ❌ Недоступен\n"
         
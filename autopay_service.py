@@ -1,7 +1,8 @@
 import asyncio
 import logging
+import time
 from datetime import datetime, timedelta
-from typing import List, Optional
+from typing import Dict, Optional
 from database import Database, UserSubscription, User, Subscription
 from remnawave_api import RemnaWaveAPI
 from referral_utils import process_referral_rewards
@@ -10,12 +11,20 @@ logger = logging.getLogger(__name__)
 
 class AutoPayService:
     
-    def __init__(self, db: Database, api: Optional[RemnaWaveAPI] = None, bot=None):
+    def __init__(self, db: Database, api: Optional[RemnaWaveAPI] = None, bot=None, concurrency: int = 10,
+                 periodic_check: bool = True):
         self.db = db
         self.api = api
         self.bot = bot
+        self.concurrency = max(1, concurrency)
+        # False - прогоны запускает DueEventScheduler точно в срок
+        self.periodic_check = periodic_check
         self.is_running = False
         self.check_task = None
+        self._run_lock = asyncio.Lock()
+        self._user_locks: Dict[int, asyncio.Lock] = {}
+        self.last_run: Optional[dict] = None
+        self.total_runs = 0
         
     async def start(self):
         if self.is_running:
@@ -25,7 +34,10 @@ class AutoPayService:
         self.is_running = True
         logger.info("🔄 Starting AutoPay service...")
         
-        self.check_task = asyncio.create_task(self._periodic_check())
+        if self.periodic_check:
+            self.check_task = asyncio.create_task(self._periodic_check())
+        else:
+            logger.info("AutoPay runs are triggered by the due-time scheduler")
         
     async def stop(self):
         if not self.is_running:
@@ -55,53 +67,72 @@ class AutoPayService:
                 await asyncio.sleep(300) 
                 
     async def process_autopayments(self) -> dict:
+        """Один прогон автоплатежей.
+
+        Пользователи и тарифы всех подписок к оплате выбираются пачкой,
+        списания проводятся одной транзакцией, а продление в панели и
+        уведомления идут параллельно (не больше concurrency одновременно)
+        под блокировкой пользователя: подписки одного пользователя
+        обрабатываются строго по очереди. Прогоны друг с другом не пересекаются.
+        """
+        async with self._run_lock:
+            return await self._process_autopayments()
+    
+    async def _process_autopayments(self) -> dict:
         logger.info("🔄 Processing autopayments...")
         
+        stats = {
+            'processed': 0,
+            'successful': 0,
+            'failed': 0,
+            'insufficient_balance': 0,
+            'errors': []
+        }
+        started_at = datetime.utcnow()
+        timings = {}
+        stage_started = time.monotonic()
+        run_started = stage_started
+        
         try:
             subscriptions_to_pay = await self.db.get_subscriptions_for_autopay()
             
             if not subscriptions_to_pay:
                 logger.info("No subscriptions ready for autopay")
-                return {
-                    'processed': 0,
-                    'successful': 0,
-                    'failed': 0,
-                    'insufficient_balance': 0,
-                    'errors': []
-                }
+                return stats
             
             logger.info(f"Found {len(subscriptions_to_pay)} subscriptions for autopay")
             
-            stats = {
-                'processed': 0,
-                'successful': 0,
-                'failed': 0,
-                'insufficient_balance': 0,
-                'errors': []
-            }
+            users = await self.db.get_users_by_telegram_ids({sub.user_id for sub in subscriptions_to_pay})
+            plans = await self.db.get_subscriptions_by_ids({sub.subscription_id for sub in subscriptions_to_pay})
+            timings['fetch'] = time.monotonic() - stage_started
             
+            stage_started = time.monotonic()
+            charges = []
+            pending = []
             for user_sub in subscriptions_to_pay:
-                try:
-                    result = await self._process_single_autopayment(user_sub)
-                    stats['processed'] += 1
-                    
-                    if result['success']:
-                        stats['successful'] += 1
-                        logger.info(f"✅ Autopay successful for user {user_sub.user_id}, subscription {user_sub.id}")
-                    elif result['reason'] == 'insufficient_balance':
-                        stats['insufficient_balance'] += 1
-                        logger.info(f"💳 Insufficient balance for user {user_sub.user_id}, subscription {user_sub.id}")
-                    else:
-                        stats['failed'] += 1
-                        stats['errors'].append(f"User {user_sub.user_id}: {result['reason']}")
-                        logger.warning(f"❌ Autopay failed for user {user_sub.user_id}: {result['reason']}")
-                        
-                except Exception as e:
-                    stats['processed'] += 1
-                    stats['failed'] += 1
-                    error_msg = f"User {user_sub.user_id}: {str(e)}"
-                    stats['errors'].append(error_msg)
-                    logger.error(f"Error processing autopay for user {user_sub.user_id}: {e}")
+                stats['processed'] += 1
+                prepared = self._prepare_autopayment(user_sub, users.get(user_sub.user_id),
+                                                     plans.get(user_sub.subscription_id))
+                if prepared['success']:
+                    charges.append(prepared)
+                elif prepared['reason'] == 'insufficient_balance':
+                    pending.append((prepared, {'status': 'insufficient_funds'}))
+                else:
+                    self._count_result(stats, user_sub, prepared)
+            
+            # Все списания прогона проводятся одной транзакцией, продление - после
+            posted = await self.db.post_balance_changes([charge['entry'] for charge in charges])
+            pending.extend(zip(charges, posted))
+            timings['charge'] = time.monotonic() - stage_started
+            
+            stage_started = time.monotonic()
+            semaphore = asyncio.Semaphore(self.concurrency)
+            results = await asyncio.gather(
+                *(self._process_charge(charge, ledger, semaphore) for charge, ledger in pending)
+            )
+            for (charge, _), result in zip(pending, results):
+                self._count_result(stats, charge['user_sub'], result)
+            timings['renew'] = time.monotonic() - stage_started
             
             logger.info(f"📊 Autopay processing complete: {stats['successful']} successful, "
                        f"{stats['failed']} failed, {stats['insufficient_balance']} insufficient balance")
@@ -110,45 +141,105 @@ class AutoPayService:
             
         except Exception as e:
             logger.error(f"Error in process_autopayments: {e}")
-            return {
-                'processed': 0,
-                'successful': 0,
-                'failed': 0,
-                'insufficient_balance': 0,
-                'errors': [str(e)]
+            stats['errors'].append(str(e))
+            return stats
+        
+        finally:
+            self._user_locks.clear()
+            self.total_runs += 1
+            self.last_run = {
+                'started_at': started_at,
+                'duration': time.monotonic() - run_started,
+                'fetch_time': timings.get('fetch', 0.0),
+                'charge_time': timings.get('charge', 0.0),
+                'renew_time': timings.get('renew', 0.0),
+                'processed': stats['processed'],
+                'successful': stats['successful'],
+                'failed': stats['failed'],
+                'insufficient_balance': stats['insufficient_balance']
             }
     
-    async def _process_single_autopayment(self, user_sub: UserSubscription) -> dict:
-        try:
-            user = await self.db.get_user_by_telegram_id(user_sub.user_id)
-            if not user:
-                return {'success': False, 'reason': 'User not found'}
-            
-            subscription = await self.db.get_subscription_by_id(user_sub.subscription_id)
-            if not subscription:
-                return {'success': False, 'reason': 'Subscription plan not found'}
-            
-            if subscription.is_trial:
-                logger.info(f"Skipping autopay for trial subscription: user {user_sub.user_id}")
-                return {'success': False, 'reason': 'Trial subscriptions are not eligible for autopay'}
-            
-            if not user_sub.is_active or not user_sub.auto_pay_enabled:
-                return {'success': False, 'reason': 'Subscription inactive or autopay disabled'}
-            
-            if user.balance < subscription.price:
-                await self._notify_insufficient_balance(user, subscription, user_sub)
-                return {'success': False, 'reason': 'insufficient_balance'}
-            
-            return await self._execute_autopayment(user, subscription, user_sub)
-            
-        except Exception as e:
-            logger.error(f"Error in _process_single_autopayment: {e}")
-            return {'success': False, 'reason': str(e)}
+    async def _process_charge(self, charge: dict, ledger: dict, semaphore: asyncio.Semaphore) -> dict:
+        user_sub = charge['user_sub']
+        lock = self._user_locks.setdefault(user_sub.user_id, asyncio.Lock())
+        
+        async with lock, semaphore:
+            try:
+                if ledger['status'] == 'insufficient_funds':
+                    await self._notify_insufficient_balance(charge['user'], charge['subscription'], user_sub)
+                    return {'success': False, 'reason': 'insufficient_balance'}
+                if ledger['success']:
+                    return await self._execute_autopayment(
+                        charge['user'], charge['subscription'], user_sub, charge['entry'], ledger
+                    )
+                return {'success': False, 'reason': f"Charge failed: {ledger['status']}"}
+            except Exception as e:
+                logger.error(f"Error processing autopay for user {user_sub.user_id}: {e}")
+                return {'success': False, 'reason': str(e)}
+    
+    @staticmethod
+    def _count_result(stats: dict, user_sub: UserSubscription, result: dict):
+        if result['success']:
+            stats['successful'] += 1
+            logger.info(f"✅ Autopay successful for user {user_sub.user_id}, subscription {user_sub.id}")
+        elif result['reason'] == 'insufficient_balance':
+            stats['insufficient_balance'] += 1
+            logger.info(f"💳 Insufficient balance for user {user_sub.user_id}, subscription {user_sub.id}")
+        else:
+            stats['failed'] += 1
+            stats['errors'].append(f"User {user_sub.user_id}: {result['reason']}")
+            logger.warning(f"❌ Autopay failed for user {user_sub.user_id}: {result['reason']}")
+    
+    @staticmethod
+    def _prepare_autopayment(user_sub: UserSubscription, user: Optional[User],
+                             subscription: Optional[Subscription]) -> dict:
+        """Проверяет подписку и готовит проводку списания за текущий период.
+
+        Ключ проводки привязан к текущей дате истечения, поэтому повторный
+        прогон после сбоя между списанием и продлением не спишет деньги
+        второй раз, а только доделает продление.
+        """
+        if not user:
+            return {'success': False, 'reason': 'User not found'}
+        
+        if not subscription:
+            return {'success': False, 'reason': 'Subscription plan not found'}
+        
+        if subscription.is_trial:
+            logger.info(f"Skipping autopay for trial subscription: user {user_sub.user_id}")
+            return {'success': False, 'reason': 'Trial subscriptions are not eligible for autopay'}
+        
+        if not user_sub.is_active or not user_sub.auto_pay_enabled:
+            return {'success': False, 'reason': 'Subscription inactive or autopay disabled'}
+        
+        prepared = {
+            'success': True,
+            'user': user,
+            'subscription': subscription,
+            'user_sub': user_sub,
+            'entry': {
+                'user_id': user_sub.user_id,
+                'amount': -subscription.price,
+                'kind': 'autopay',
+                'idempotency_key': f"autopay:{user_sub.id}:{user_sub.expires_at.isoformat()}",
+                'description': f'Автоплатеж: {subscription.name}'
+            }
+        }
+        
+        if user.balance < subscription.price:
+            prepared.update(success=False, reason='insufficient_balance')
+        
+        return prepared
     
-    async def _execute_autopayment(self, user: User, subscription: Subscription, user_sub: UserSubscription) -> dict:
+    async def _execute_autopayment(self, user: User, subscription: Subscription, user_sub: UserSubscription,
+                                   charge: dict, ledger: dict) -> dict:
+        refund_key = f"{charge['idempotency_key']}:refund"
+        
+        if ledger['status'] == 'duplicate' and await self.db.get_balance_transaction(refund_key):
+            return {'success': False, 'reason': 'Charge for this period was refunded earlier'}
+        
         try:
-            user.balance -= subscription.price
-            await self.db.update_user(user)
+            user.balance = ledger['balance']
             
             now = datetime.utcnow()
             if user_sub.expires_at > now:
@@ -176,20 +267,12 @@ class AutoPayService:
                 except Exception as e:
                     logger.warning(f"Failed to update RemnaWave expiry: {e}")
             
-            payment = await self.db.create_payment(
-                user_id=user_sub.user_id,
-                amount=-subscription.price,
-                payment_type='autopay',
-                description=f'Автоплатеж: {subscription.name}',
-                status='completed'
-            )
-            
             if self.bot:
                 try:
                     await process_referral_rewards(
                         user_sub.user_id,
                         subscription.price,
-                        payment.id,
+                        ledger['payment_id'],
                         self.db,
                         self.bot,
                         payment_type='autopay'
@@ -197,17 +280,22 @@ class AutoPayService:
                 except Exception as e:
                     logger.warning(f"Failed to process referral rewards for autopay: {e}")
             
-            await self._notify_successful_autopay(user, subscription, user_sub, new_expiry)
+            if ledger['status'] == 'posted':
+                await self._notify_successful_autopay(user, subscription, user_sub, new_expiry)
             
             return {'success': True, 'reason': 'Payment processed successfully'}
             
         except Exception as e:
             logger.error(f"Error executing autopayment: {e}")
-            try:
-                user.balance += subscription.price
-                await self.db.update_user(user)
-            except:
-                pass
+            refund = await self.db.post_balance_change(
+                user_sub.user_id,
+                subscription.price,
+                'autopay_refund',
+                idempotency_key=refund_key,
+                description=f'Возврат автоплатежа: {subscription.name}'
+            )
+            if not refund['success']:
+                logger.error(f"Failed to refund autopay {charge['idempotency_key']}: {refund['status']}")
             return {'success': False, 'reason': str(e)}
     
     async def _notify_successful_autopay(self, user: User, subscription: Subscription, 
@@ -280,5 +368,10 @@ class AutoPayService:
             'is_running': self.is_running,
             'check_interval': 1800, 
             'has_api': self.api is not None,
-            'has_bot': self.bot is not None
+            'has_bot': self.bot is not None,
+            'periodic_check': self.periodic_check,
+            'concurrency': self.concurrency,
+            'in_progress': self._run_lock.locked(),
+            'total_runs': self.total_runs,
+            'last_run': self.last_run
         }
@@ -0,0 +1,299 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Dict, Optional
+
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+
+from database import Database, BroadcastJob
+from keyboards import broadcast_control_keyboard
+
+logger = logging.getLogger(__name__)
+
+AUDIENCE_LABELS = {
+    'all': 'Все пользователи',
+    'active': 'С активной подпиской',
+    'inactive': 'Без активной подписки',
+    'lang_ru': 'Язык: русский',
+    'lang_en': 'Язык: английский',
+}
+
+STATUS_LABELS = {
+    'pending': '🕐 Ожидает запуска',
+    'running': '📤 Отправка',
+    'paused': '⏸ Приостановлена',
+    'completed': '✅ Завершена',
+    'cancelled': '⏹ Отменена',
+}
+
+
+class TokenBucket:
+    """Асинхронный token bucket: rate токенов в секунду, запас не больше capacity."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = max(rate, 0.1)
+        self.capacity = capacity or self.rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def block_for(self, seconds: float):
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BroadcastService:
+    """Фоновые рассылки с лимитом скорости и сохранением курсора в БД.
+
+    Получатели читаются из БД пачками по users.id; после каждой пачки курсор
+    (last_user_id) и счетчики сохраняются, так что после рестарта рассылка
+    продолжается с места остановки (повторно может уйти не больше одной пачки).
+    Каждый получатель встречается в задаче один раз, поэтому лимит Telegram на
+    чат касается только сообщения с прогрессом — оно обновляется не чаще
+    progress_interval секунд.
+    """
+
+    MAX_SEND_ATTEMPTS = 3
+
+    def __init__(self, db: Database, bot, rate_limit: float = 25.0, concurrency: int = 8,
+                 progress_interval: int = 5, page_size: int = 100):
+        self.db = db
+        self.bot = bot
+        self.bucket = TokenBucket(rate_limit)
+        self.concurrency = max(1, concurrency)
+        self.progress_interval = max(1, progress_interval)
+        self.page_size = page_size
+        self.is_running = False
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._requested_status: Dict[int, str] = {}
+
+    async def start(self):
+        if self.is_running:
+            logger.warning("Broadcast service is already running")
+            return
+
+        self.is_running = True
+        logger.info("📢 Starting broadcast service...")
+
+        unfinished = await self.db.get_broadcast_jobs_by_status(['running'])
+        for job in unfinished:
+            logger.info(f"📢 Resuming broadcast job {job.id} from user id {job.last_user_id}")
+            self._spawn(job.id)
+
+    async def stop(self):
+        if not self.is_running:
+            return
+
+        self.is_running = False
+        logger.info("⏹ Stopping broadcast service...")
+
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks.clear()
+
+    async def start_broadcast(self, admin_id: int, message_text: str, audience: str,
+                              progress_chat_id: int, progress_message_id: int) -> BroadcastJob:
+        total = await self.db.count_broadcast_recipients(audience)
+        job = await self.db.create_broadcast_job(admin_id, message_text, audience, total)
+
+        await self.db.update_broadcast_job(
+            job.id,
+            status='running',
+            progress_chat_id=progress_chat_id,
+            progress_message_id=progress_message_id
+        )
+        job.status = 'running'
+        job.progress_chat_id = progress_chat_id
+        job.progress_message_id = progress_message_id
+
+        logger.info(f"📢 Broadcast job {job.id} created by {admin_id}: audience={audience}, recipients={total}")
+        self._spawn(job.id)
+        return job
+
+    async def pause(self, job_id: int) -> bool:
+        return await self._request_status(job_id, 'paused')
+
+    async def cancel(self, job_id: int) -> bool:
+        return await self._request_status(job_id, 'cancelled')
+
+    async def resume(self, job_id: int) -> bool:
+        job = await self.db.get_broadcast_job(job_id)
+        if not job or job.status != 'paused':
+            return False
+
+        if not await self.db.update_broadcast_job(job_id, status='running'):
+            return False
+
+        self._spawn(job_id)
+        return True
+
+    async def _request_status(self, job_id: int, status: str) -> bool:
+        job = await self.db.get_broadcast_job(job_id)
+        if not job or job.status not in ('running', 'paused', 'pending'):
+            return False
+
+        task = self._tasks.get(job_id)
+        if task and not task.done():
+            # Задача сама сохранит статус после текущей пачки
+            self._requested_status[job_id] = status
+            return True
+
+        if not await self.db.update_broadcast_job(job_id, status=status):
+            return False
+        job.status = status
+        await self._report_progress(job)
+        return True
+
+    def _spawn(self, job_id: int):
+        task = self._tasks.get(job_id)
+        if task and not task.done():
+            return
+        self._requested_status.pop(job_id, None)
+        self._tasks[job_id] = asyncio.create_task(self._run_job(job_id))
+
+    async def _run_job(self, job_id: int):
+        try:
+            job = await self.db.get_broadcast_job(job_id)
+            if not job:
+                logger.error(f"Broadcast job {job_id} not found")
+                return
+
+            semaphore = asyncio.Semaphore(self.concurrency)
+            last_report = 0.0
+            final_status = 'completed'
+
+            async def send(chat_id: int) -> bool:
+                async with semaphore:
+                    return await self._send(chat_id, job.message_text)
+
+            while True:
+                requested = self._requested_status.pop(job_id, None)
+                if requested:
+                    final_status = requested
+                    break
+
+                recipients = await self.db.get_broadcast_recipients(job.audience, job.last_user_id, self.page_size)
+                if not recipients:
+                    break
+
+                results = await asyncio.gather(*(send(telegram_id) for _, telegram_id in recipients))
+                delivered = sum(1 for ok in results if ok)
+
+                job.sent_count += delivered
+                job.error_count += len(results) - delivered
+                job.last_user_id = recipients[-1][0]
+
+                await self.db.update_broadcast_job(
+                    job_id,
+                    last_user_id=job.last_user_id,
+                    sent_count=job.sent_count,
+                    error_count=job.error_count
+                )
+
+                if time.monotonic() - last_report >= self.progress_interval:
+                    await self._report_progress(job)
+                    last_report = time.monotonic()
+
+                if len(recipients) < self.page_size:
+                    break
+
+            job.status = final_status
+            values = {'status': final_status}
+            if final_status in ('completed', 'cancelled'):
+                values['finished_at'] = datetime.utcnow()
+            await self.db.update_broadcast_job(job_id, **values)
+            await self._report_progress(job)
+
+            logger.info(f"📢 Broadcast job {job_id} {final_status}: "
+                        f"{job.sent_count} sent, {job.error_count} errors")
+
+        except asyncio.CancelledError:
+            logger.info(f"Broadcast job {job_id} interrupted, will resume on next start")
+            raise
+        except Exception as e:
+            logger.error(f"Error in broadcast job {job_id}: {e}", exc_info=True)
+        finally:
+            self._tasks.pop(job_id, None)
+
+    async def _send(self, chat_id: int, text: str) -> bool:
+        for attempt in range(self.MAX_SEND_ATTEMPTS):
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id, text)
+                return True
+            except TelegramRetryAfter as e:
+                logger.warning(f"Broadcast flood control: retry after {e.retry_after}s (chat {chat_id})")
+                self.bucket.block_for(e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                logger.debug(f"Broadcast to {chat_id} rejected: {e}")
+                return False
+            except Exception as e:
+                logger.warning(f"Failed to send broadcast to {chat_id}: {e}")
+                return False
+        return False
+
+    async def _report_progress(self, job: BroadcastJob):
+        if not job.progress_chat_id or not job.progress_message_id:
+            return
+
+        try:
+            await self.bucket.acquire()
+            await self.bot.edit_message_text(
+                self.format_progress(job),
+                chat_id=job.progress_chat_id,
+                message_id=job.progress_message_id,
+                reply_markup=broadcast_control_keyboard(job.id, job.status)
+            )
+        except TelegramRetryAfter as e:
+            self.bucket.block_for(e.retry_after)
+        except TelegramBadRequest as e:
+            if 'message is not modified' not in str(e):
+                logger.warning(f"Could not update progress for broadcast {job.id}: {e}")
+        except Exception as e:
+            logger.warning(f"Could not update progress for broadcast {job.id}: {e}")
+
+    @staticmethod
+    def format_progress(job: BroadcastJob) -> str:
+        processed = job.sent_count + job.error_count
+        percent = (processed / job.total_count * 100) if job.total_count else 100.0
+
+        text = f"📢 Рассылка #{job.id}\n\n"
+        text += f"Статус: {STATUS_LABELS.get(job.status, job.status)}\n"
+        text += f"Аудитория: {AUDIENCE_LABELS.get(job.audience, job.audience)}\n\n"
+        text += f"📊 Обработано: {processed}/{job.total_count} ({min(percent, 100.0):.0f}%)\n"
+        text += f"✅ Отправлено: {job.sent_count}\n"
+        text += f"❌ Ошибок: {job.error_count}"
+        return text
+
+    async def get_service_status(self) -> dict:
+        return {
+            'is_running': self.is_running,
+            'active_jobs': [job_id for job_id, task in self._tasks.items() if not task.done()],
+            'rate_limit': self.bucket.rate,
+            'concurrency': self.concurrency
+        }
@@ -46,6 +46,53 @@ class Config:
     STARS_ENABLED: bool = True
     STARS_RATES: Dict[int, float] = None  
 
+    BROADCAST_RATE_LIMIT: float = 25.0
+    BROADCAST_CONCURRENCY: int = 8
+    BROADCAST_PROGRESS_INTERVAL: int = 5
+    USER_CACHE_TTL: int = 60
+    USER_CACHE_SIZE: int = 10000
+    STATS_CACHE_TTL: int = 60
+    SUBSCRIPTION_VIEW_CACHE_TTL: int = 30
+    PROMOCODE_CACHE_TTL: int = 60
+    PROMOCODE_NEGATIVE_CACHE_TTL: int = 10
+    SUBSCRIPTION_URL_CACHE_TTL: int = 3600
+    SUBSCRIPTION_URL_CACHE_SIZE: int = 10000
+    PANEL_USERS_CACHE_TTL: int = 300
+    REMNAWAVE_BULK_CONCURRENCY: int = 10
+    REMNAWAVE_MAX_RETRIES: int = 3
+    REMNAWAVE_POOL_SIZE: int = 100
+    REMNAWAVE_POOL_PER_HOST: int = 30
+    REMNAWAVE_KEEPALIVE_TIMEOUT: float = 30.0
+    REMNAWAVE_DNS_CACHE_TTL: int = 300
+    REMNAWAVE_CONNECT_TIMEOUT: float = 5.0
+    REMNAWAVE_READ_TIMEOUT: float = 25.0
+    REMNAWAVE_TOTAL_TIMEOUT: float = 30.0
+    REMNAWAVE_BREAKER_THRESHOLD: int = 5
+    REMNAWAVE_BREAKER_RECOVERY: float = 30.0
+    FSM_STORAGE: str = "sql"
+    FSM_REDIS_URL: str = "redis://localhost:6379/0"
+    FSM_STATE_TTL: int = 86400
+    SYNC_BATCH_SIZE: int = 500
+    SYNC_PROGRESS_INTERVAL: int = 5
+    SYNC_DELTA_INTERVAL: int = 300
+    RATE_LIMIT_BACKEND: str = "memory"
+    RATE_LIMIT_REDIS_URL: str = "redis://localhost:6379/0"
+    RATE_LIMIT_NAVIGATION_RATE: float = 2.0
+    RATE_LIMIT_NAVIGATION_BURST: float = 5.0
+    RATE_LIMIT_PAYMENT_RATE: float = 0.5
+    RATE_LIMIT_PAYMENT_BURST: float = 3.0
+    RATE_LIMIT_ADMIN_RATE: float = 5.0
+    RATE_LIMIT_ADMIN_BURST: float = 10.0
+    BOT_MODE: str = "polling"
+    TELEGRAM_WEBHOOK_URL: str = ""
+    TELEGRAM_WEBHOOK_PATH: str = "/telegram-webhook"
+    TELEGRAM_WEBHOOK_SECRET: str = ""
+    UPDATE_WORKERS: int = 8
+    UPDATE_QUEUE_SIZE: int = 1000
+    AUTOPAY_CONCURRENCY: int = 10
+    SCHEDULER_ENABLED: bool = True
+    DB_AUTO_MIGRATE: bool = True
+
 def load_config() -> Config:
     
     def parse_admin_ids(admin_ids_str: str) -> List[int]:
@@ -135,7 +182,53 @@ def load_config() -> Config:
         TRIBUTE_WEBHOOK_PORT=get_int('TRIBUTE_WEBHOOK_PORT', 8081),
         TRIBUTE_WEBHOOK_PATH=os.getenv('TRIBUTE_WEBHOOK_PATH', '/tribute-webhook'),
         TRIBUTE_DONATE_URL=os.getenv('TRIBUTE_DONATE_URL', ''),
-        TRIBUTE_DONATE_LINK=os.getenv('TRIBUTE_DONATE_LINK', '')
+        TRIBUTE_DONATE_LINK=os.getenv('TRIBUTE_DONATE_LINK', ''),
+        BROADCAST_RATE_LIMIT=get_float('BROADCAST_RATE_LIMIT', 25.0),
+        BROADCAST_CONCURRENCY=get_int('BROADCAST_CONCURRENCY', 8),
+        BROADCAST_PROGRESS_INTERVAL=get_int('BROADCAST_PROGRESS_INTERVAL', 5),
+        USER_CACHE_TTL=get_int('USER_CACHE_TTL', 60),
+        USER_CACHE_SIZE=get_int('USER_CACHE_SIZE', 10000),
+        STATS_CACHE_TTL=get_int('STATS_CACHE_TTL', 60),
+        SUBSCRIPTION_VIEW_CACHE_TTL=get_int('SUBSCRIPTION_VIEW_CACHE_TTL', 30),
+        PROMOCODE_CACHE_TTL=get_int('PROMOCODE_CACHE_TTL', 60),
+        PROMOCODE_NEGATIVE_CACHE_TTL=get_int('PROMOCODE_NEGATIVE_CACHE_TTL', 10),
+        SUBSCRIPTION_URL_CACHE_TTL=get_int('SUBSCRIPTION_URL_CACHE_TTL', 3600),
+        SUBSCRIPTION_URL_CACHE_SIZE=get_int('SUBSCRIPTION_URL_CACHE_SIZE', 10000),
+        PANEL_USERS_CACHE_TTL=get_int('PANEL_USERS_CACHE_TTL', 300),
+        REMNAWAVE_BULK_CONCURRENCY=get_int('REMNAWAVE_BULK_CONCURRENCY', 10),
+        REMNAWAVE_MAX_RETRIES=get_int('REMNAWAVE_MAX_RETRIES', 3),
+        REMNAWAVE_POOL_SIZE=get_int('REMNAWAVE_POOL_SIZE', 100),
+        REMNAWAVE_POOL_PER_HOST=get_int('REMNAWAVE_POOL_PER_HOST', 30),
+        REMNAWAVE_KEEPALIVE_TIMEOUT=get_float('REMNAWAVE_KEEPALIVE_TIMEOUT', 30.0),
+        REMNAWAVE_DNS_CACHE_TTL=get_int('REMNAWAVE_DNS_CACHE_TTL', 300),
+        REMNAWAVE_CONNECT_TIMEOUT=get_float('REMNAWAVE_CONNECT_TIMEOUT', 5.0),
+        REMNAWAVE_READ_TIMEOUT=get_float('REMNAWAVE_READ_TIMEOUT', 25.0),
+        REMNAWAVE_TOTAL_TIMEOUT=get_float('REMNAWAVE_TOTAL_TIMEOUT', 30.0),
+        REMNAWAVE_BREAKER_THRESHOLD=get_int('REMNAWAVE_BREAKER_THRESHOLD', 5),
+        REMNAWAVE_BREAKER_RECOVERY=get_float('REMNAWAVE_BREAKER_RECOVERY', 30.0),
+        FSM_STORAGE=os.getenv('FSM_STORAGE', 'sql'),
+        FSM_REDIS_URL=os.getenv('FSM_REDIS_URL', 'redis://localhost:6379/0'),
+        FSM_STATE_TTL=get_int('FSM_STATE_TTL', 86400),
+        SYNC_BATCH_SIZE=get_int('SYNC_BATCH_SIZE', 500),
+        SYNC_PROGRESS_INTERVAL=get_int('SYNC_PROGRESS_INTERVAL', 5),
+        SYNC_DELTA_INTERVAL=get_int('SYNC_DELTA_INTERVAL', 300),
+        RATE_LIMIT_BACKEND=os.getenv('RATE_LIMIT_BACKEND', 'memory'),
+        RATE_LIMIT_REDIS_URL=os.getenv('RATE_LIMIT_REDIS_URL', 'redis://localhost:6379/0'),
+        RATE_LIMIT_NAVIGATION_RATE=get_float('RATE_LIMIT_NAVIGATION_RATE', 2.0),
+        RATE_LIMIT_NAVIGATION_BURST=get_float('RATE_LIMIT_NAVIGATION_BURST', 5.0),
+        RATE_LIMIT_PAYMENT_RATE=get_float('RATE_LIMIT_PAYMENT_RATE', 0.5),
+        RATE_LIMIT_PAYMENT_BURST=get_float('RATE_LIMIT_PAYMENT_BURST', 3.0),
+        RATE_LIMIT_ADMIN_RATE=get_float('RATE_LIMIT_ADMIN_RATE', 5.0),
+        RATE_LIMIT_ADMIN_BURST=get_float('RATE_LIMIT_ADMIN_BURST', 10.0),
+        BOT_MODE=os.getenv('BOT_MODE', 'polling').lower(),
+        TELEGRAM_WEBHOOK_URL=os.getenv('TELEGRAM_WEBHOOK_URL', '').rstrip('/'),
+        TELEGRAM_WEBHOOK_PATH=os.getenv('TELEGRAM_WEBHOOK_PATH', '/telegram-webhook'),
+        TELEGRAM_WEBHOOK_SECRET=os.getenv('TELEGRAM_WEBHOOK_SECRET', ''),
+        UPDATE_WORKERS=get_int('UPDATE_WORKERS', 8),
+        UPDATE_QUEUE_SIZE=get_int('UPDATE_QUEUE_SIZE', 1000),
+        AUTOPAY_CONCURRENCY=get_int('AUTOPAY_CONCURRENCY', 10),
+        SCHEDULER_ENABLED=get_bool('SCHEDULER_ENABLED', True),
+        DB_AUTO_MIGRATE=get_bool('DB_AUTO_MIGRATE', True)
     )
 
 def debug_environment():
@@ -1,12 +1,22 @@
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import BigInteger, String, Float, DateTime, Boolean, Text, Integer, text, select, func, and_, Column
+from sqlalchemy import BigInteger, String, Float, DateTime, Boolean, Text, Integer, text, select, func, and_, Column, Index, UniqueConstraint
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, AsyncIterator, Tuple, Callable
+import asyncio
 import logging
+import time
+
+from user_cache import UserCache
+from stats_cache import StatsCache
+from promocode_cache import PromocodeCache
 
 logger = logging.getLogger(__name__)
 
+# Допустимые значения UserSubscription.auto_pay_days_before
+AUTOPAY_DAYS_OPTIONS = (1, 2, 3, 5, 7)
+
 class Base(DeclarativeBase):
     pass
 
@@ -48,6 +58,14 @@ class User(Base):
     remnawave_uuid: Mapped[Optional[str]] = mapped_column(String(255))
     is_trial_used: Mapped[bool] = mapped_column(Boolean, default=False)
 
+    __table_args__ = (
+        Index('idx_users_created_at', 'created_at'),
+        Index('idx_users_balance', 'balance'),
+    )
+
+# Префиксный поиск по username без учета регистра (админский список пользователей)
+Index('idx_users_username_lower', func.lower(User.username))
+
 class Subscription(Base):
     __tablename__ = 'subscriptions'
     
@@ -78,6 +96,12 @@ class UserSubscription(Base):
     auto_pay_enabled: Mapped[bool] = mapped_column(Boolean, default=False)
     auto_pay_days_before: Mapped[int] = mapped_column(Integer, default=3)  
 
+    __table_args__ = (
+        Index('idx_user_subscriptions_active_expires', 'is_active', 'expires_at'),
+        Index('idx_user_subscriptions_user_active', 'user_id', 'is_active', 'expires_at'),
+        Index('idx_user_subscriptions_autopay', 'auto_pay_enabled', 'auto_pay_days_before', 'expires_at'),
+    )
+
 class Payment(Base):
     __tablename__ = 'payments'
     
@@ -89,6 +113,11 @@ class Payment(Base):
     status: Mapped[str] = mapped_column(String(50), default='pending')  
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        Index('idx_payments_user_created', 'user_id', 'created_at'),
+        Index('idx_payments_type_created', 'payment_type', 'created_at'),
+    )
+
 class Promocode(Base):
     __tablename__ = 'promocodes'
     
@@ -110,6 +139,10 @@ class PromocodeUsage(Base):
     promocode_id: Mapped[int] = mapped_column(Integer, index=True)
     used_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        Index('uq_promocode_usage_user_promocode', 'user_id', 'promocode_id', unique=True),
+    )
+
 class LuckyGame(Base):
     __tablename__ = 'lucky_games'
     
@@ -121,6 +154,10 @@ class LuckyGame(Base):
     reward_amount: Mapped[float] = mapped_column(Float, default=0.0)
     played_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        Index('idx_lucky_games_user_played', 'user_id', 'played_at'),
+    )
+
 class StarPayment(Base):
     __tablename__ = 'star_payments'
     
@@ -144,8 +181,72 @@ class ServiceRule(Base):
     created_at = Column(DateTime, default=func.now())
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
 
+class BroadcastJob(Base):
+    __tablename__ = 'broadcast_jobs'
+    
+    id: Mapped[int] = mapped_column(primary_key=True)
+    admin_id: Mapped[int] = mapped_column(BigInteger, index=True)
+    message_text: Mapped[str] = mapped_column(Text)
+    audience: Mapped[str] = mapped_column(String(50), default='all')
+    status: Mapped[str] = mapped_column(String(20), default='pending', index=True)
+    last_user_id: Mapped[int] = mapped_column(Integer, default=0)
+    total_count: Mapped[int] = mapped_column(Integer, default=0)
+    sent_count: Mapped[int] = mapped_column(Integer, default=0)
+    error_count: Mapped[int] = mapped_column(Integer, default=0)
+    progress_chat_id: Mapped[Optional[int]] = mapped_column(BigInteger)
+    progress_message_id: Mapped[Optional[int]] = mapped_column(Integer)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    updated_at: Mapped[Optional[datetime]] = mapped_column(DateTime, onupdate=datetime.utcnow)
+    finished_at: Mapped[Optional[datetime]] = mapped_column(DateTime)
+
+class FSMRecord(Base):
+    __tablename__ = 'fsm_records'
+    
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    state: Mapped[Optional[str]] = mapped_column(String(255))
+    data: Mapped[Optional[str]] = mapped_column(Text)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+    
+    name: Mapped[str] = mapped_column(String(50), primary_key=True)
+    watermark: Mapped[Optional[datetime]] = mapped_column(DateTime)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class BalanceTransaction(Base):
+    __tablename__ = 'balance_transactions'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[int] = mapped_column(BigInteger, index=True)
+    amount: Mapped[float] = mapped_column(Float)
+    balance_after: Mapped[float] = mapped_column(Float)
+    kind: Mapped[str] = mapped_column(String(50), index=True)
+    idempotency_key: Mapped[Optional[str]] = mapped_column(String(255), unique=True)
+    payment_id: Mapped[Optional[int]] = mapped_column(Integer)
+    description: Mapped[Optional[str]] = mapped_column(Text)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+class NotificationLog(Base):
+    __tablename__ = 'notification_log'
+    
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_subscription_id: Mapped[int] = mapped_column(Integer, index=True)
+    kind: Mapped[str] = mapped_column(String(30))
+    threshold: Mapped[int] = mapped_column(Integer, default=0)
+    # Период подписки: после продления те же пороги отправляются заново
+    expires_at: Mapped[datetime] = mapped_column(DateTime)
+    sent_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        UniqueConstraint('user_subscription_id', 'kind', 'threshold', 'expires_at', name='uq_notification_log_key'),
+    )
+
 class Database:
-    def __init__(self, database_url: str):
+    def __init__(self, database_url: str, user_cache_ttl: int = 60, user_cache_size: int = 10000,
+                 profile_flush_delay: float = 5.0, stats_cache_ttl: int = 60,
+                 subscription_view_ttl: float = 30, promocode_cache_ttl: int = 60,
+                 promocode_negative_ttl: int = 10):
         self.engine = create_async_engine(
             database_url, 
             echo=False,
@@ -157,16 +258,47 @@ class Database:
             class_=AsyncSession,
             expire_on_commit=False
         )
+        self.user_cache = UserCache(ttl=user_cache_ttl, max_size=user_cache_size)
+        self.stats_cache = StatsCache(ttl=stats_cache_ttl)
+        self.promocode_cache = PromocodeCache(ttl=promocode_cache_ttl, negative_ttl=promocode_negative_ttl)
+        # user_id -> (момент устаревания, [(UserSubscription, Subscription)])
+        self.subscription_view_ttl = subscription_view_ttl
+        self._subscription_views: Dict[int, Tuple[float, List[Tuple[UserSubscription, Subscription]]]] = {}
+        self.profile_flush_delay = profile_flush_delay
+        self._pending_profile_updates: Dict[int, Dict[str, Any]] = {}
+        self._profile_flush_task: Optional[asyncio.Task] = None
+        # Вызываются после любых изменений user_subscriptions (перевзвод планировщика)
+        self.subscription_listeners: List[Callable[[], None]] = []
+
+    def _subscriptions_changed(self):
+        self.stats_cache.invalidate('overview', 'subscriptions', 'autopay')
+        self._subscription_views.clear()
+        for listener in self.subscription_listeners:
+            try:
+                listener()
+            except Exception as e:
+                logger.error(f"Error in subscription change listener: {e}")
     
-    async def init_db(self):
-        async with self.engine.begin() as conn:
-            await conn.run_sync(Base.metadata.create_all)
-    
-        await self.migrate_user_subscriptions()
-        await self.migrate_subscription_imported_field()
-        await self.migrate_referral_tables() 
-        await self.migrate_star_payments_table()
-        await self.migrate_autopay_fields()
+    async def init_db(self, auto_migrate: bool = True):
+        """Проверяет версию схемы и при auto_migrate применяет недостающие миграции.
+
+        Без auto_migrate отстающая схема - ошибка старта: миграции тогда
+        накатываются отдельно командой python migrations.py upgrade.
+        """
+        from migrations import run_migrations, get_schema_version, LATEST_VERSION
+
+        if auto_migrate:
+            applied = await run_migrations(self.engine)
+            if applied:
+                logger.info(f"Applied database migrations: {applied}")
+            return
+
+        version = await get_schema_version(self.engine)
+        if version < LATEST_VERSION:
+            raise RuntimeError(
+                f"Database schema version {version} is behind {LATEST_VERSION}, "
+                f"run `python migrations.py upgrade`"
+            )
 
     async def toggle_autopay(self, user_subscription_id: int, enabled: bool) -> bool:
         """Включает/выключает автоплатеж для подписки"""
@@ -179,6 +311,7 @@ class Database:
                     .values(auto_pay_enabled=enabled)
                 )
                 await session.commit()
+                self._subscriptions_changed()
                 return result.rowcount > 0
             except Exception as e:
                 logger.error(f"Error toggling autopay: {e}")
@@ -196,6 +329,7 @@ class Database:
                     .values(auto_pay_days_before=days_before)
                 )
                 await session.commit()
+                self._subscriptions_changed()
                 return result.rowcount > 0
             except Exception as e:
                 logger.error(f"Error setting autopay days: {e}")
@@ -212,7 +346,7 @@ class Database:
                     current_time = datetime.utcnow()
                 
                     conditions = []
-                    for days in [1, 2, 3, 5, 7]:
+                    for days in AUTOPAY_DAYS_OPTIONS:
                         threshold_date = current_time + timedelta(days=days)
                         conditions.append(
                             and_(
@@ -247,65 +381,31 @@ class Database:
                 logger.error(f"Error getting subscriptions for autopay: {e}")
                 return []
 
-    async def migrate_referral_tables(self):
+    async def get_users_by_telegram_ids(self, telegram_ids: List[int]) -> Dict[int, User]:
         try:
-            async with self.engine.begin() as conn:
-                try:
-                    await conn.execute(text("SELECT 1 FROM referral_programs LIMIT 1"))
-                    logger.info("referral_programs table already exists")
-                except Exception:
-                    await conn.execute(text("""
-                        CREATE TABLE referral_programs (
-                            id SERIAL PRIMARY KEY,
-                            referrer_id BIGINT NOT NULL,
-                            referred_id BIGINT UNIQUE NOT NULL,
-                            referral_code VARCHAR(20) NOT NULL,
-                            first_reward_paid BOOLEAN DEFAULT FALSE,
-                            total_earned DOUBLE PRECISION DEFAULT 0.0,
-                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                            first_reward_at TIMESTAMP
-                        )
-                    """))
-                
-                    try:
-                        await conn.execute(text("CREATE INDEX idx_referrer ON referral_programs(referrer_id)"))
-                        await conn.execute(text("CREATE INDEX idx_referred ON referral_programs(referred_id)"))
-                        await conn.execute(text("CREATE INDEX idx_referral_code ON referral_programs(referral_code)"))
-                    except Exception as e:
-                        logger.warning(f"Some referral_programs indexes may already exist: {e}")
-                
-                    logger.info("Created referral_programs table")
-            
-                try:
-                    await conn.execute(text("SELECT 1 FROM referral_earnings LIMIT 1"))
-                    logger.info("referral_earnings table already exists")
-                except Exception:
-                    await conn.execute(text("""
-                        CREATE TABLE referral_earnings (
-                            id SERIAL PRIMARY KEY,
-                            referrer_id BIGINT NOT NULL,
-                            referred_id BIGINT NOT NULL,
-                            amount DOUBLE PRECISION NOT NULL,
-                            earning_type VARCHAR(20) NOT NULL,
-                            related_payment_id INTEGER,
-                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                        )
-                    """))
-                
-                    try:
-                        await conn.execute(text("CREATE INDEX idx_referrer_earnings ON referral_earnings(referrer_id)"))
-                        await conn.execute(text("CREATE INDEX idx_referred_earnings ON referral_earnings(referred_id)"))
-                        await conn.execute(text("CREATE INDEX idx_earning_type ON referral_earnings(earning_type)"))
-                    except Exception as e:
-                        logger.warning(f"Some referral_earnings indexes may already exist: {e}")
-                
-                    logger.info("Created referral_earnings table")
-            
-                logger.info("Successfully created referral system tables")
+            from sqlalchemy import select
+            rows = await self._select_by_telegram_ids(select(User), User.telegram_id, list(telegram_ids))
+            return {row[0].telegram_id: row[0] for row in rows}
         except Exception as e:
-            logger.error(f"Error creating referral tables: {e}")
-    
+            logger.error(f"Error getting users by telegram ids: {e}")
+            return {}
+
+    async def get_subscriptions_by_ids(self, subscription_ids: List[int]) -> Dict[int, Subscription]:
+        async with self.session_factory() as session:
+            try:
+                from sqlalchemy import select
+                result = await session.execute(
+                    select(Subscription).where(Subscription.id.in_(list(subscription_ids)))
+                )
+                return {subscription.id: subscription for subscription in result.scalars().all()}
+            except Exception as e:
+                logger.error(f"Error getting subscriptions by ids: {e}")
+                return {}
+
     async def close(self):
+        if self._profile_flush_task and not self._profile_flush_task.done():
+            self._profile_flush_task.cancel()
+        await self.flush_user_profile_updates()
         await self.engine.dispose()
     
     async def get_user_by_telegram_id(self, telegram_id: int) -> Optional[User]:
@@ -315,11 +415,65 @@ class Database:
                 result = await session.execute(
                     select(User).where(User.telegram_id == telegram_id)
                 )
-                return result.scalar_one_or_none()
+                user = result.scalar_one_or_none()
+                self.user_cache.set(user)
+                return user
             except Exception as e:
                 logger.error(f"Error getting user by telegram_id {telegram_id}: {e}")
                 return None
     
+    async def get_cached_user(self, telegram_id: int) -> Optional[User]:
+        """Пользователь из кэша, при промахе - из БД (read-through)"""
+        user = self.user_cache.get(telegram_id)
+        if user is not None:
+            return user
+        return await self.get_user_by_telegram_id(telegram_id)
+    
+    def queue_user_profile_update(self, telegram_id: int, **values):
+        """Откладывает запись профильных полей (username, имя, is_admin).
+
+        Кэш обновляется сразу, а в БД изменения уходят одним UPDATE на
+        пользователя не раньше чем через profile_flush_delay секунд, так что
+        серия апдейтов от одного пользователя схлопывается в одну запись.
+        """
+        self.user_cache.update_fields(telegram_id, **values)
+        self._pending_profile_updates.setdefault(telegram_id, {}).update(values)
+        
+        if self._profile_flush_task is None or self._profile_flush_task.done():
+            self._profile_flush_task = asyncio.create_task(self._delayed_profile_flush())
+    
+    async def _delayed_profile_flush(self):
+        try:
+            await asyncio.sleep(self.profile_flush_delay)
+        except asyncio.CancelledError:
+            return
+        await self.flush_user_profile_updates()
+    
+    async def flush_user_profile_updates(self) -> int:
+        if not self._pending_profile_updates:
+            return 0
+        
+        pending, self._pending_profile_updates = self._pending_profile_updates, {}
+        
+        async with self.session_factory() as session:
+            try:
+                from sqlalchemy import update
+                for telegram_id, values in pending.items():
+                    await session.execute(
+                        update(User)
+                        .where(User.telegram_id == telegram_id)
+                        .values(**values)
+                    )
+                await session.commit()
+                logger.debug(f"Flushed profile updates for {len(pending)} users")
+                return len(pending)
+            except Exception as e:
+                logger.error(f"Error flushing user profile updates: {e}")
+                await session.rollback()
+                for telegram_id, values in pending.items():
+                    self.user_cache.invalidate(telegram_id)
+                return 0
+    
     async def create_user(self, telegram_id: int, username: str = None, 
                          first_name: str = None, last_name: str = None, 
                          language: str = 'ru', is_admin: bool = False) -> User:
@@ -335,40 +489,210 @@ class Database:
                 )
                 session.add(user)
                 await session.commit()
+                self.stats_cache.invalidate('overview')
                 await session.refresh(user)
+                self.user_cache.set(user)
                 return user
             except Exception as e:
                 logger.error(f"Error creating user {telegram_id}: {e}")
                 await session.rollback()
                 raise
     
+    # Колонки, которые нельзя переписывать из объекта пользователя: balance
+    # меняется только проводками журнала, а объект может быть снимком из кэша
+    USER_PROTECTED_COLUMNS = {'id', 'telegram_id', 'balance', 'created_at'}
+
     async def update_user(self, user: User) -> User:
+        """Записывает профильные колонки пользователя, но не balance.
+
+        Хендлеры получают снимок из кэша, который может отставать от БД;
+        merge такого снимка вернул бы старый баланс поверх проводок.
+        Если известно, что именно поменялось, лучше update_user_fields.
+        """
+        values = {
+            column.key: getattr(user, column.key)
+            for column in User.__table__.columns
+            if column.key not in self.USER_PROTECTED_COLUMNS
+        }
+        await self.update_user_fields(user.telegram_id, **values)
+        return user
+
+    async def update_user_fields(self, telegram_id: int, **values) -> bool:
+        """Точечный UPDATE переданных колонок пользователя (balance запрещен)"""
+        protected = self.USER_PROTECTED_COLUMNS.intersection(values)
+        if protected:
+            raise ValueError(f"Columns {sorted(protected)} cannot be updated directly")
+
         async with self.session_factory() as session:
             try:
-                await session.merge(user)
+                from sqlalchemy import update
+                result = await session.execute(
+                    update(User).where(User.telegram_id == telegram_id).values(**values)
+                )
                 await session.commit()
-                return user
+                return result.rowcount > 0
             except Exception as e:
-                logger.error(f"Error updating user {user.telegram_id}: {e}")
+                logger.error(f"Error updating user {telegram_id}: {e}")
                 await session.rollback()
                 raise
+            finally:
+                self.user_cache.invalidate(telegram_id)
     
-    async def add_balance(self, user_id: int, amount: float) -> bool:
+    async def add_balance(self, user_id: int, amount: float, kind: str = 'adjustment',
+                          idempotency_key: Optional[str] = None, description: Optional[str] = None) -> bool:
+        """Начисление через журнал без записи в payments; остаток не проверяется"""
+        result = await self.post_balance_change(
+            user_id, amount, kind,
+            idempotency_key=idempotency_key,
+            description=description,
+            allow_negative=True,
+            record_payment=False
+        )
+        return result['success']
+
+    @staticmethod
+    def _ledger_result(status: str, entry: Optional['BalanceTransaction'] = None) -> Dict[str, Any]:
+        return {
+            'success': status in ('posted', 'duplicate'),
+            'status': status,
+            'balance': entry.balance_after if entry else None,
+            'transaction_id': entry.id if entry else None,
+            'payment_id': entry.payment_id if entry else None
+        }
+
+    async def _apply_balance_change(self, session: AsyncSession, user_id: int, amount: float, kind: str,
+                                    idempotency_key: Optional[str] = None, description: Optional[str] = None,
+                                    allow_negative: bool = False, record_payment: bool = True) -> Dict[str, Any]:
+        """Проводка внутри открытой транзакции сессии, commit остается за вызывающим.
+
+        Баланс меняется одним условным UPDATE (balance >= -amount для списаний):
+        параллельное списание ждет блокировку строки и перепроверяет условие
+        уже по новому балансу, поэтому двойной клик не уведет баланс в минус.
+        Повтор ключа дает статус 'duplicate' без изменений; гонку двух
+        одинаковых ключей ловит уникальный индекс (IntegrityError при flush).
+        """
+        from sqlalchemy import update
+
+        if idempotency_key:
+            existing = await session.scalar(
+                select(BalanceTransaction).where(BalanceTransaction.idempotency_key == idempotency_key)
+            )
+            if existing:
+                return self._ledger_result('duplicate', existing)
+
+        query = update(User).where(User.telegram_id == user_id)
+        if amount < 0 and not allow_negative:
+            query = query.where(User.balance >= -amount)
+        result = await session.execute(query.values(balance=User.balance + amount))
+
+        if result.rowcount == 0:
+            user_exists = await session.scalar(select(User.id).where(User.telegram_id == user_id))
+            return self._ledger_result('insufficient_funds' if user_exists else 'user_not_found')
+
+        balance = await session.scalar(select(User.balance).where(User.telegram_id == user_id))
+
+        payment_id = None
+        if record_payment:
+            payment = Payment(
+                user_id=user_id,
+                amount=amount,
+                payment_type=kind,
+                description=description or '',
+                status='completed'
+            )
+            session.add(payment)
+            await session.flush()
+            payment_id = payment.id
+
+        entry = BalanceTransaction(
+            user_id=user_id,
+            amount=amount,
+            balance_after=balance,
+            kind=kind,
+            idempotency_key=idempotency_key,
+            payment_id=payment_id,
+            description=description
+        )
+        session.add(entry)
+        await session.flush()
+        return self._ledger_result('posted', entry)
+
+    async def post_balance_change(self, user_id: int, amount: float, kind: str,
+                                  idempotency_key: Optional[str] = None, description: Optional[str] = None,
+                                  allow_negative: bool = False, record_payment: bool = True) -> Dict[str, Any]:
+        """Атомарно меняет баланс и пишет проводку (и платеж, если record_payment).
+
+        Возвращает словарь success/status/balance/transaction_id/payment_id,
+        status: posted, duplicate, insufficient_funds, user_not_found или error.
+        """
         async with self.session_factory() as session:
             try:
-                from sqlalchemy import select, update
-                result = await session.execute(
-                    update(User)
-                    .where(User.telegram_id == user_id)
-                    .values(balance=User.balance + amount)
+                result = await self._apply_balance_change(
+                    session, user_id, amount, kind,
+                    idempotency_key=idempotency_key,
+                    description=description,
+                    allow_negative=allow_negative,
+                    record_payment=record_payment
                 )
+                if result['status'] == 'posted':
+                    await session.commit()
+                    if record_payment:
+                        self.stats_cache.invalidate('overview')
+                else:
+                    await session.rollback()
+                return result
+            except IntegrityError:
+                await session.rollback()
+                existing = await self.get_balance_transaction(idempotency_key) if idempotency_key else None
+                if existing:
+                    return self._ledger_result('duplicate', existing)
+                logger.error(f"Integrity error posting balance change for user {user_id}")
+                return self._ledger_result('error')
+            except Exception as e:
+                logger.error(f"Error posting balance change for user {user_id}: {e}")
+                await session.rollback()
+                return self._ledger_result('error')
+            finally:
+                self.user_cache.invalidate(user_id)
+
+    async def post_balance_changes(self, entries: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Пакетная проводка одним commit (прогоны автоплатежей).
+
+        entries - словари с аргументами post_balance_change. Проводки без
+        средств или пользователя просто не применяются; если же транзакция
+        упала целиком (например, гонка ключей), пакет откатывается и
+        проводится поштучно.
+        """
+        if not entries:
+            return []
+
+        async with self.session_factory() as session:
+            try:
+                results = []
+                for entry in entries:
+                    results.append(await self._apply_balance_change(session, **entry))
                 await session.commit()
-                return result.rowcount > 0
+                self.stats_cache.invalidate('overview')
+                return results
             except Exception as e:
-                logger.error(f"Error adding balance to user {user_id}: {e}")
+                logger.warning(f"Batch balance posting failed, posting {len(entries)} entries one by one: {e}")
                 await session.rollback()
-                return False
-    
+            finally:
+                for entry in entries:
+                    self.user_cache.invalidate(entry['user_id'])
+
+        return [await self.post_balance_change(**entry) for entry in entries]
+
+    async def get_balance_transaction(self, idempotency_key: str) -> Optional[BalanceTransaction]:
+        async with self.session_factory() as session:
+            try:
+                return await session.scalar(
+                    select(BalanceTransaction).where(BalanceTransaction.idempotency_key == idempotency_key)
+                )
+            except Exception as e:
+                logger.error(f"Error getting balance transaction {idempotency_key}: {e}")
+                return None
+
     async def get_all_subscriptions(self, include_inactive: bool = False, exclude_trial: bool = True, exclude_imported: bool = True) -> List[Subscription]:
         async with self.session_factory() as session:
             try:
@@ -396,24 +720,6 @@ class Database:
                 logger.error(f"Error getting admin subscriptions: {e}")
                 return []
 
-    async def migrate_subscription_imported_field(self):
-        try:
-            async with self.engine.begin() as conn:
-                try:
-                    await conn.execute(text("SELECT is_imported FROM subscriptions LIMIT 1"))
-                    logger.info("is_imported field already exists")
-                except Exception:
-                    try:
-                        await conn.execute(text("""
-                            ALTER TABLE subscriptions 
-                            ADD COLUMN is_imported BOOLEAN DEFAULT FALSE
-                        """))
-                        logger.info("Successfully added is_imported field to subscriptions table")
-                    except Exception as e:
-                        logger.warning(f"Error adding is_imported field: {e}")
-        except Exception as e:
-            logger.error(f"Error during subscription migration: {e}")            
-    
     async def get_subscription_by_id(self, subscription_id: int) -> Optional[Subscription]:
         async with self.session_factory() as session:
             try:
@@ -454,6 +760,7 @@ class Database:
             try:
                 await session.merge(subscription)
                 await session.commit()
+                self._subscription_views.clear()
                 return subscription
             except Exception as e:
                 logger.error(f"Error updating subscription {subscription.id}: {e}")
@@ -468,6 +775,7 @@ class Database:
                     delete(Subscription).where(Subscription.id == subscription_id)
                 )
                 await session.commit()
+                self._subscription_views.clear()
                 return result.rowcount > 0
             except Exception as e:
                 logger.error(f"Error deleting subscription {subscription_id}: {e}")
@@ -486,6 +794,70 @@ class Database:
                 logger.error(f"Error getting user subscriptions for {user_id}: {e}")
                 return []
     
+    async def get_user_subscription_views(self, user_id: int,
+                                          use_cache: bool = True) -> List[Tuple[UserSubscription, Subscription]]:
+        """Подписки пользователя вместе с тарифами одним запросом.
+
+        Результат запоминается на subscription_view_ttl секунд и сбрасывается
+        при любом изменении user_subscriptions или тарифов. Подписки, тариф
+        которых удален, пропускаются. Возвращаемые объекты общие для
+        повторных вызовов: перед изменением берите use_cache=False.
+        """
+        if use_cache and self.subscription_view_ttl > 0:
+            entry = self._subscription_views.get(user_id)
+            if entry and entry[0] >= time.monotonic():
+                return list(entry[1])
+
+        async with self.session_factory() as session:
+            try:
+                from sqlalchemy import select
+                result = await session.execute(
+                    select(UserSubscription, Subscription)
+                    .join(Subscription, UserSubscription.subscription_id == Subscription.id)
+                    .where(UserSubscription.user_id == user_id)
+                    .order_by(UserSubscription.id)
+                )
+                views = [(user_sub, subscription) for user_sub, subscription in result.all()]
+            except Exception as e:
+                logger.error(f"Error getting subscription views for {user_id}: {e}")
+                return []
+
+        if use_cache and self.subscription_view_ttl > 0:
+            now = time.monotonic()
+            if len(self._subscription_views) >= 10000:
+                self._subscription_views = {
+                    key: entry for key, entry in self._subscription_views.items() if entry[0] >= now
+                }
+            self._subscription_views[user_id] = (now + self.subscription_view_ttl, views)
+        return list(views)
+
+    async def get_user_subscription_view(self, user_id: int, user_subscription_id: int,
+                                         use_cache: bool = True) -> Tuple[Optional[UserSubscription], Optional[Subscription]]:
+        """Одна подписка пользователя с тарифом; (None, None), если ее нет или она чужая"""
+        entry = self._subscription_views.get(user_id) if use_cache else None
+        if entry and entry[0] >= time.monotonic():
+            for user_sub, subscription in entry[1]:
+                if user_sub.id == user_subscription_id:
+                    return user_sub, subscription
+            return None, None
+
+        async with self.session_factory() as session:
+            try:
+                from sqlalchemy import select
+                result = await session.execute(
+                    select(UserSubscription, Subscription)
+                    .join(Subscription, UserSubscription.subscription_id == Subscription.id)
+                    .where(
+                        UserSubscription.id == user_subscription_id,
+                        UserSubscription.user_id == user_id
+                    )
+                )
+                row = result.first()
+                return (row[0], row[1]) if row else (None, None)
+            except Exception as e:
+                logger.error(f"Error getting subscription view {user_subscription_id} for {user_id}: {e}")
+                return None, None
+
     async def create_user_subscription(self, user_id: int, subscription_id: int, 
                                  short_uuid: str, expires_at: datetime, 
                                  is_active: bool = True, traffic_limit_gb: int = None) -> Optional[UserSubscription]:
@@ -514,6 +886,7 @@ class Database:
             
                 session.add(new_subscription)
                 await session.commit()
+                self._subscriptions_changed()
                 await session.refresh(new_subscription)
             
                 return new_subscription
@@ -536,6 +909,7 @@ class Database:
                 )
                 session.add(payment)
                 await session.commit()
+                self.stats_cache.invalidate('overview')
                 await session.refresh(payment)
                 return payment
             except Exception as e:
@@ -560,12 +934,58 @@ class Database:
             try:
                 await session.merge(payment)
                 await session.commit()
+                self.stats_cache.invalidate('overview')
                 return payment
             except Exception as e:
                 logger.error(f"Error updating payment {payment.id}: {e}")
                 await session.rollback()
                 raise
     
+    async def complete_payment(self, payment_id: int) -> Dict[str, Any]:
+        """Одобрение ожидающего платежа: статус completed и зачисление через
+        журнал (ключ payment:<id>) одной транзакцией.
+
+        Возвращает результат проводки; 'duplicate', если платеж уже не pending.
+        """
+        idempotency_key = f"payment:{payment_id}"
+        async with self.session_factory() as session:
+            try:
+                from sqlalchemy import update
+
+                payment = await session.scalar(
+                    update(Payment)
+                    .where(Payment.id == payment_id, Payment.status == 'pending')
+                    .values(status='completed')
+                    .returning(Payment)
+                )
+                if not payment:
+                    await session.rollback()
+                    existing = await self.get_balance_transaction(idempotency_key)
+                    return self._ledger_result('duplicate', existing)
+
+                result = await self._apply_balance_change(
+                    session, payment.user_id, payment.amount, payment.payment_type,
+                    idempotency_key=idempotency_key,
+                    description=payment.description,
+                    record_payment=False
+                )
+                if result['status'] != 'posted':
+                    logger.error(f"Payment {payment_id} not credited: {result['status']}")
+                    await session.rollback()
+                    return result
+
+                await session.commit()
+                self.user_cache.invalidate(payment.user_id)
+                self.stats_cache.invalidate('overview')
+                return result
+            except IntegrityError:
+                await session.rollback()
+                return self._ledger_result('duplicate', await self.get_balance_transaction(idempotency_key))
+            except Exception as e:
+                logger.error(f"Error completing payment {payment_id}: {e}")
+                await session.rollback()
+                return self._ledger_result('error')
+    
     async def get_user_payments(self, user_id: int) -> List[Payment]:
         async with self.session_factory() as session:
             try:
@@ -581,13 +1001,19 @@ class Database:
                 return []
     
     async def get_promocode_by_code(self, code: str) -> Optional[Promocode]:
+        cached, promocode = self.promocode_cache.get(code)
+        if cached:
+            return promocode
+
         async with self.session_factory() as session:
             try:
                 from sqlalchemy import select
                 result = await session.execute(
-                    select(Promocode).where(Promocode.code == code)
+                    select(Promocode).where(Promocode.code == PromocodeCache.normalize(code))
                 )
-                return result.scalar_one_or_none()
+                promocode = result.scalar_one_or_none()
+                self.promocode_cache.set(code, promocode)
+                return promocode
             except Exception as e:
                 logger.error(f"Error getting promocode {code}: {e}")
                 return None
@@ -606,6 +1032,8 @@ class Database:
                 )
                 session.add(promocode)
                 await session.commit()
+                self.stats_cache.invalidate('promocodes')
+                self.promocode_cache.invalidate(code)
                 await session.refresh(promocode)
                 return promocode
             except Exception as e:
@@ -613,31 +1041,80 @@ class Database:
                 await session.rollback()
                 raise
     
-    async def use_promocode(self, user_id: int, promocode: Promocode) -> bool:
-        async with self.session_factory() as session:
-            try:
-                from sqlalchemy import select
-                existing = await session.execute(
-                    select(PromocodeUsage).where(
-                        PromocodeUsage.user_id == user_id,
-                        PromocodeUsage.promocode_id == promocode.id
+    async def redeem_promocode(self, user_id: int, promocode_id: int) -> Dict[str, Any]:
+        """Активация промокода одной транзакцией: отметка использования,
+        зачисление на баланс с платежом и увеличение счетчика.
+
+        Счетчик растет условным UPDATE (used_count < usage_limit, код активен
+        и не истек), поэтому лимит не превышается при любой конкуренции, а
+        повторную активацию отсекает уникальный индекс (user_id, promocode_id).
+        UPDATE идет последним, чтобы блокировка строки промокода держалась
+        только до commit.
+
+        Возвращает словарь success/status/amount/balance, status: redeemed,
+        already_used, limit_reached, expired, inactive, not_found,
+        user_not_found или error.
+        """
+        from sqlalchemy import update, or_
+
+        def result(status: str, amount: Optional[float] = None, balance: Optional[float] = None) -> Dict[str, Any]:
+            return {'success': status == 'redeemed', 'status': status, 'amount': amount, 'balance': balance}
+
+        async with self.session_factory() as session:
+            try:
+                promocode = await session.get(Promocode, promocode_id)
+                if not promocode:
+                    return result('not_found')
+                if not promocode.is_active:
+                    return result('inactive')
+                now = datetime.utcnow()
+                if promocode.expires_at and promocode.expires_at < now:
+                    return result('expired')
+                if promocode.used_count >= promocode.usage_limit:
+                    self.promocode_cache.invalidate(promocode.code)
+                    return result('limit_reached')
+
+                code, amount = promocode.code, promocode.discount_amount
+                session.add(PromocodeUsage(user_id=user_id, promocode_id=promocode_id))
+                await session.flush()
+
+                posted = await self._apply_balance_change(
+                    session, user_id, amount, 'promocode',
+                    idempotency_key=f"promocode:{promocode_id}:{user_id}",
+                    description=f'Промокод: {code}'
+                )
+                if posted['status'] != 'posted':
+                    await session.rollback()
+                    return result('already_used' if posted['status'] == 'duplicate' else posted['status'])
+
+                claimed = await session.execute(
+                    update(Promocode)
+                    .where(
+                        Promocode.id == promocode_id,
+                        Promocode.is_active == True,
+                        Promocode.used_count < Promocode.usage_limit,
+                        or_(Promocode.expires_at.is_(None), Promocode.expires_at >= now)
                     )
+                    .values(used_count=Promocode.used_count + 1)
+                    .execution_options(synchronize_session=False)
                 )
-                if existing.scalar_one_or_none():
-                    return False
-                
-                usage = PromocodeUsage(user_id=user_id, promocode_id=promocode.id)
-                session.add(usage)
-                
-                promocode.used_count += 1
-                await session.merge(promocode)
-                
+                if claimed.rowcount == 0:
+                    await session.rollback()
+                    self.promocode_cache.invalidate(code)
+                    return result('limit_reached')
+
                 await session.commit()
-                return True
+                self.stats_cache.invalidate('promocodes', 'overview')
+                return result('redeemed', amount, posted['balance'])
+            except IntegrityError:
+                await session.rollback()
+                return result('already_used')
             except Exception as e:
-                logger.error(f"Error using promocode: {e}")
+                logger.error(f"Error redeeming promocode {promocode_id} for user {user_id}: {e}")
                 await session.rollback()
-                return False
+                return result('error')
+            finally:
+                self.user_cache.invalidate(user_id)
     
     async def get_all_promocodes(self) -> List[Promocode]:
         async with self.session_factory() as session:
@@ -658,53 +1135,302 @@ class Database:
             except Exception as e:
                 logger.error(f"Error getting all users: {e}")
                 return []
-    
-    async def get_stats(self) -> dict:
+
+    async def get_users_page(self, after_id: int = 0, before_id: Optional[int] = None, limit: int = 20,
+                             min_balance: Optional[float] = None, max_balance: Optional[float] = None,
+                             language: Optional[str] = None, is_admin: Optional[bool] = None,
+                             created_after: Optional[datetime] = None, created_before: Optional[datetime] = None,
+                             has_active_subscription: Optional[bool] = None,
+                             username_prefix: Optional[str] = None) -> Tuple[List[User], bool]:
+        """Страница пользователей для админки (keyset-пагинация по users.id).
+
+        Вперед - строки с id > after_id, назад - строки с id < before_id.
+        Возвращает (пользователи по возрастанию id, есть ли еще строки в
+        направлении листания); общий COUNT не считается, поэтому стоимость
+        не зависит от размера таблицы. Поиск по username - префиксный и без
+        учета регистра, по индексу idx_users_username_lower.
+        """
+        async with self.session_factory() as session:
+            try:
+                from sqlalchemy import select, func, exists, and_
+
+                query = select(User)
+                if min_balance is not None:
+                    query = query.where(User.balance >= min_balance)
+                if max_balance is not None:
+                    query = query.where(User.balance <= max_balance)
+                if language:
+                    query = query.where(User.language == language)
+                if is_admin is not None:
+                    query = query.where(User.is_admin == is_admin)
+                if created_after:
+                    query = query.where(User.created_at >= created_after)
+                if created_before:
+                    query = query.where(User.created_at < created_before)
+                if has_active_subscription is not None:
+                    active = exists().where(
+                        and_(
+                            UserSubscription.user_id == User.telegram_id,
+                            UserSubscription.is_active == True,
+                            UserSubscription.expires_at > datetime.utcnow()
+                        )
+                    )
+                    query = query.where(active if has_active_subscription else ~active)
+                if username_prefix:
+                    prefix = username_prefix.lstrip('@').lower()
+                    username = func.lower(User.username)
+                    # Диапазон вместо LIKE, чтобы работал индекс по lower(username)
+                    query = query.where(
+                        username >= prefix,
+                        username < prefix + '\uffff',
+                        username.startswith(prefix, autoescape=True)
+                    )
+
+                if before_id is not None:
+                    query = query.where(User.id < before_id).order_by(User.id.desc())
+                else:
+                    query = query.where(User.id > after_id).order_by(User.id)
+
+                result = await session.execute(query.limit(limit + 1))
+                users = list(result.scalars().all())
+                has_more = len(users) > limit
+                users = users[:limit]
+                if before_id is not None:
+                    users.reverse()
+                return users, has_more
+            except Exception as e:
+                logger.error(f"Error getting users page after {after_id}: {e}")
+                return [], False
+
+    def _broadcast_audience_query(self, query, audience: str):
+        from sqlalchemy import exists, and_
+
+        has_active_subscription = exists().where(
+            and_(
+                UserSubscription.user_id == User.telegram_id,
+                UserSubscription.is_active == True,
+                UserSubscription.expires_at > datetime.utcnow()
+            )
+        )
+
+        if audience == 'active':
+            return query.where(has_active_subscription)
+        if audience == 'inactive':
+            return query.where(~has_active_subscription)
+        if audience.startswith('lang_'):
+            return query.where(User.language == audience[len('lang_'):])
+        return query
+
+    async def count_broadcast_recipients(self, audience: str = 'all') -> int:
         async with self.session_factory() as session:
             try:
-                from sqlalchemy import select, func, and_
-            
-                total_users = await session.execute(
-                    select(func.count(User.id))
+                from sqlalchemy import select, func
+                query = self._broadcast_audience_query(select(func.count(User.id)), audience)
+                result = await session.execute(query)
+                return result.scalar() or 0
+            except Exception as e:
+                logger.error(f"Error counting broadcast recipients for {audience}: {e}")
+                return 0
+
+    async def get_broadcast_recipients(self, audience: str = 'all', after_id: int = 0,
+                                       limit: int = 100) -> List[Tuple[int, int]]:
+        """Возвращает пачку (users.id, telegram_id) после after_id (keyset-пагинация)."""
+        async with self.session_factory() as session:
+            try:
+                from sqlalchemy import select
+                query = self._broadcast_audience_query(
+                    select(User.id, User.telegram_id).where(User.id > after_id), audience
                 )
-                total_users = total_users.scalar()
-        
-                total_subs_non_trial = await session.execute(
-                    select(func.count(UserSubscription.id))
-                    .join(Subscription, UserSubscription.subscription_id == Subscription.id)
-                    .where(Subscription.is_trial == False)
+                result = await session.execute(query.order_by(User.id).limit(limit))
+                return [(row.id, row.telegram_id) for row in result.all()]
+            except Exception as e:
+                logger.error(f"Error getting broadcast recipients after {after_id}: {e}")
+                return []
+
+    async def create_broadcast_job(self, admin_id: int, message_text: str, audience: str = 'all',
+                                   total_count: int = 0) -> BroadcastJob:
+        async with self.session_factory() as session:
+            try:
+                job = BroadcastJob(
+                    admin_id=admin_id,
+                    message_text=message_text,
+                    audience=audience,
+                    total_count=total_count,
+                    status='pending'
                 )
-                total_subs_non_trial = total_subs_non_trial.scalar()
-        
-                total_payments = await session.execute(
-                    select(func.sum(Payment.amount)).where(
-                        and_(
-                            Payment.status == 'completed',
-                            Payment.payment_type.in_([
-                                'topup',              # Обычные пополнения
-                                'subscription',       # Покупка подписок
-                                'subscription_extend', # Продление подписок
-                                'promocode',          # Активация промокодов
-                                'admin_topup',        # Пополнения администратором
-                                'stars',              # Пополнения через Telegram Stars
-                                'autopay'             # Автоплатежи
-                            ])
+                session.add(job)
+                await session.commit()
+                await session.refresh(job)
+                return job
+            except Exception as e:
+                logger.error(f"Error creating broadcast job: {e}")
+                await session.rollback()
+                raise
+
+    async def get_broadcast_job(self, job_id: int) -> Optional[BroadcastJob]:
+        async with self.session_factory() as session:
+            try:
+                from sqlalchemy import select
+                result = await session.execute(
+                    select(BroadcastJob).where(BroadcastJob.id == job_id)
+                )
+                return result.scalar_one_or_none()
+            except Exception as e:
+                logger.error(f"Error getting broadcast job {job_id}: {e}")
+                return None
+
+    async def get_broadcast_jobs_by_status(self, statuses: List[str]) -> List[BroadcastJob]:
+        async with self.session_factory() as session:
+            try:
+                from sqlalchemy import select
+                result = await session.execute(
+                    select(BroadcastJob)
+                    .where(BroadcastJob.status.in_(statuses))
+                    .order_by(BroadcastJob.id)
+                )
+                return list(result.scalars().all())
+            except Exception as e:
+                logger.error(f"Error getting broadcast jobs with status {statuses}: {e}")
+                return []
+
+    async def update_broadcast_job(self, job_id: int, **values) -> bool:
+        async with self.session_factory() as session:
+            try:
+                from sqlalchemy import update
+                values['updated_at'] = datetime.utcnow()
+                result = await session.execute(
+                    update(BroadcastJob).where(BroadcastJob.id == job_id).values(**values)
+                )
+                await session.commit()
+                return result.rowcount > 0
+            except Exception as e:
+                logger.error(f"Error updating broadcast job {job_id}: {e}")
+                await session.rollback()
+                return False
+
+    async def get_fsm_record(self, key: str, ttl: int = 0) -> Optional[FSMRecord]:
+        async with self.session_factory() as session:
+            try:
+                from sqlalchemy import select
+                query = select(FSMRecord).where(FSMRecord.key == key)
+                if ttl > 0:
+                    query = query.where(FSMRecord.updated_at > datetime.utcnow() - timedelta(seconds=ttl))
+                result = await session.execute(query)
+                return result.scalar_one_or_none()
+            except Exception as e:
+                logger.error(f"Error getting FSM record {key}: {e}")
+                return None
+
+    async def save_fsm_record(self, key: str, ttl: int = 0, **values: Optional[str]) -> bool:
+        """Пишет state и/или data ключа одним upsert, без чтения перед записью.
+
+        Непереданная колонка сохраняет прежнее значение, а если запись уже
+        старше ttl, сбрасывается: устаревшие данные не должны ожить вместе
+        с новым состоянием.
+        """
+        async with self.session_factory() as session:
+            try:
+                from sqlalchemy import case
+
+                now = datetime.utcnow()
+                row = {'key': key, 'state': None, 'data': None, 'updated_at': now, **values}
+                dialect = self.engine.dialect.name
+                if dialect == 'postgresql':
+                    from sqlalchemy.dialects.postgresql import insert as dialect_insert
+                elif dialect == 'sqlite':
+                    from sqlalchemy.dialects.sqlite import insert as dialect_insert
+                else:
+                    record = await session.get(FSMRecord, key)
+                    if record and ttl > 0 and record.updated_at <= now - timedelta(seconds=ttl):
+                        record.state = record.data = None
+                    record = record or FSMRecord(key=key)
+                    for column, value in values.items():
+                        setattr(record, column, value)
+                    record.updated_at = now
+                    session.add(record)
+                    await session.commit()
+                    return True
+
+                statement = dialect_insert(FSMRecord).values(**row)
+                updates = {'updated_at': statement.excluded.updated_at}
+                for column in ('state', 'data'):
+                    if column in values:
+                        updates[column] = getattr(statement.excluded, column)
+                    elif ttl > 0:
+                        updates[column] = case(
+                            (FSMRecord.updated_at <= now - timedelta(seconds=ttl), None),
+                            else_=getattr(FSMRecord, column)
                         )
-                    )
+                await session.execute(statement.on_conflict_do_update(index_elements=['key'], set_=updates))
+                await session.commit()
+                return True
+            except Exception as e:
+                logger.error(f"Error saving FSM record {key}: {e}")
+                await session.rollback()
+                return False
+
+    async def delete_expired_fsm_records(self, ttl: int) -> int:
+        async with self.session_factory() as session:
+            try:
+                from sqlalchemy import delete
+                result = await session.execute(
+                    delete(FSMRecord).where(FSMRecord.updated_at <= datetime.utcnow() - timedelta(seconds=ttl))
                 )
-                total_payments = total_payments.scalar() or 0
-        
-                return {
-                   'total_users': total_users,
-                   'total_subscriptions_non_trial': total_subs_non_trial,
-                   'total_revenue': total_payments
-                }
+                await session.commit()
+                return result.rowcount
             except Exception as e:
-                logger.error(f"Error getting stats: {e}")
-                return {
-                    'total_users': 0,
-                    'total_subscriptions_non_trial': 0,
-                    'total_revenue': 0
+                logger.error(f"Error deleting expired FSM records: {e}")
+                await session.rollback()
+                return 0
+
+    async def get_stats(self) -> dict:
+        try:
+            return await self.stats_cache.get_or_load('overview', self._load_stats)
+        except Exception as e:
+            logger.error(f"Error getting stats: {e}")
+            return {
+                'total_users': 0,
+                'total_subscriptions_non_trial': 0,
+                'total_revenue': 0
+            }
+
+    async def _load_stats(self) -> dict:
+        async with self.session_factory() as session:
+            from sqlalchemy import select, func, and_
+
+            total_users = select(func.count(User.id)).scalar_subquery()
+            total_subs_non_trial = (
+                select(func.count(UserSubscription.id))
+                .join(Subscription, UserSubscription.subscription_id == Subscription.id)
+                .where(Subscription.is_trial == False)
+                .scalar_subquery()
+            )
+            total_payments = (
+                select(func.coalesce(func.sum(Payment.amount), 0)).where(
+                    and_(
+                        Payment.status == 'completed',
+                        Payment.payment_type.in_([
+                            'topup',              # Обычные пополнения
+                            'subscription',       # Покупка подписок
+                            'subscription_extend', # Продление подписок
+                            'promocode',          # Активация промокодов
+                            'admin_topup',        # Пополнения администратором
+                            'stars',              # Пополнения через Telegram Stars
+                            'autopay'             # Автоплатежи
+                        ])
+                    )
+                )
+                .scalar_subquery()
+            )
+
+            row = (await session.execute(
+                select(total_users, total_subs_non_trial, total_payments)
+            )).one()
+
+            return {
+                'total_users': row[0],
+                'total_subscriptions_non_trial': row[1],
+                'total_revenue': row[2]
             }
 
     async def get_trial_subscriptions(self) -> List[Subscription]:
@@ -741,37 +1467,13 @@ class Database:
             
                 await session.merge(user_subscription)
                 await session.commit()
+                self._subscriptions_changed()
                 return True
             except Exception as e:
                 logger.error(f"Error updating user subscription: {e}")
                 await session.rollback()
                 return False
 
-    async def migrate_user_subscriptions(self):
-        try:
-            async with self.engine.begin() as conn:
-                fields_to_add = [
-                    ("traffic_limit_gb", "INTEGER"),
-                    ("updated_at", "TIMESTAMP")
-                ]
-            
-                for field_name, field_type in fields_to_add:
-                    try:
-                        await conn.execute(text(f"SELECT {field_name} FROM user_subscriptions LIMIT 1"))
-                    except Exception:
-                        try:
-                            await conn.execute(text(f"""
-                                ALTER TABLE user_subscriptions 
-                                ADD COLUMN {field_name} {field_type}
-                            """))
-                            logger.info(f"Added {field_name} column to user_subscriptions")
-                        except Exception as e:
-                            logger.warning(f"Error adding {field_name} column: {e}")
-            
-                logger.info("Successfully migrated user_subscriptions table")
-        except Exception as e:
-            logger.error(f"Error during user_subscriptions migration: {e}")
-
     async def get_expiring_subscriptions(self, user_id: int, days_threshold: int = 3) -> List[UserSubscription]:
         async with self.session_factory() as session:
             try:
@@ -793,6 +1495,136 @@ class Database:
                 logger.error(f"Error getting expiring subscriptions for {user_id}: {e}")
                 return []
 
+    async def iter_due_user_subscriptions(self, expires_after: Optional[datetime] = None,
+                                          expires_before: Optional[datetime] = None,
+                                          is_active: Optional[bool] = None,
+                                          is_trial: Optional[bool] = None,
+                                          is_imported: Optional[bool] = None,
+                                          batch_size: int = 500) -> AsyncIterator[Tuple[UserSubscription, Subscription, User]]:
+        """Стримит (UserSubscription, Subscription, User) с expires_at в заданном окне.
+
+        Выборка идет keyset-пачками по UserSubscription.id, каждая пачка в своей
+        короткой сессии, поэтому строки можно менять/удалять прямо во время обхода.
+        """
+        from sqlalchemy import select
+
+        last_id = 0
+        while True:
+            async with self.session_factory() as session:
+                try:
+                    query = (
+                        select(UserSubscription, Subscription, User)
+                        .join(Subscription, UserSubscription.subscription_id == Subscription.id)
+                        .join(User, UserSubscription.user_id == User.telegram_id)
+                        .where(UserSubscription.id > last_id)
+                    )
+                    if expires_after is not None:
+                        query = query.where(UserSubscription.expires_at > expires_after)
+                    if expires_before is not None:
+                        query = query.where(UserSubscription.expires_at <= expires_before)
+                    if is_active is not None:
+                        query = query.where(UserSubscription.is_active == is_active)
+                    if is_trial is not None:
+                        query = query.where(Subscription.is_trial == is_trial)
+                    if is_imported is not None:
+                        query = query.where(Subscription.is_imported == is_imported)
+
+                    result = await session.execute(
+                        query.order_by(UserSubscription.id).limit(batch_size)
+                    )
+                    rows = result.all()
+                except Exception as e:
+                    logger.error(f"Error scanning due user subscriptions after id {last_id}: {e}")
+                    return
+
+            if not rows:
+                return
+
+            for user_sub, subscription, user in rows:
+                yield user_sub, subscription, user
+
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0].id
+
+    async def get_upcoming_expirations(self, after: datetime, after_id: int = 0, limit: int = 200,
+                                       is_trial: Optional[bool] = None,
+                                       is_imported: Optional[bool] = None,
+                                       auto_pay_days_before: Optional[int] = None) -> List[Tuple[int, datetime]]:
+        """(id, expires_at) активных подписок, истекающих после (after, after_id), по возрастанию.
+
+        Keyset по (expires_at, id) идет по индексу is_active + expires_at.
+        auto_pay_days_before ограничивает выборку подписками с включенным
+        автоплатежом за столько дней.
+        """
+        async with self.session_factory() as session:
+            try:
+                from sqlalchemy import select, or_
+                query = select(UserSubscription.id, UserSubscription.expires_at).where(
+                    UserSubscription.is_active == True,
+                    or_(
+                        UserSubscription.expires_at > after,
+                        and_(UserSubscription.expires_at == after, UserSubscription.id > after_id)
+                    )
+                )
+                if is_trial is not None or is_imported is not None:
+                    query = query.join(Subscription, UserSubscription.subscription_id == Subscription.id)
+                    if is_trial is not None:
+                        query = query.where(Subscription.is_trial == is_trial)
+                    if is_imported is not None:
+                        query = query.where(Subscription.is_imported == is_imported)
+                if auto_pay_days_before is not None:
+                    query = query.where(
+                        UserSubscription.auto_pay_enabled == True,
+                        UserSubscription.auto_pay_days_before == auto_pay_days_before
+                    )
+
+                result = await session.execute(
+                    query.order_by(UserSubscription.expires_at, UserSubscription.id).limit(limit)
+                )
+                return [(row.id, row.expires_at) for row in result]
+            except Exception as e:
+                logger.error(f"Error getting upcoming expirations after {after}: {e}")
+                return []
+
+    async def get_user_subscription_details(self, user_subscription_ids: List[int]) -> List[Tuple[UserSubscription, Subscription, User]]:
+        if not user_subscription_ids:
+            return []
+
+        async with self.session_factory() as session:
+            try:
+                from sqlalchemy import select
+                result = await session.execute(
+                    select(UserSubscription, Subscription, User)
+                    .join(Subscription, UserSubscription.subscription_id == Subscription.id)
+                    .join(User, UserSubscription.user_id == User.telegram_id)
+                    .where(UserSubscription.id.in_(list(user_subscription_ids)))
+                )
+                return [tuple(row) for row in result.all()]
+            except Exception as e:
+                logger.error(f"Error getting user subscription details {user_subscription_ids}: {e}")
+                return []
+
+    async def deactivate_user_subscriptions(self, user_subscription_ids: List[int]) -> int:
+        if not user_subscription_ids:
+            return 0
+
+        async with self.session_factory() as session:
+            try:
+                from sqlalchemy import update
+                result = await session.execute(
+                    update(UserSubscription)
+                    .where(UserSubscription.id.in_(user_subscription_ids))
+                    .values(is_active=False, updated_at=datetime.utcnow())
+                )
+                await session.commit()
+                self._subscriptions_changed()
+                return result.rowcount
+            except Exception as e:
+                logger.error(f"Error deactivating user subscriptions {user_subscription_ids}: {e}")
+                await session.rollback()
+                return 0
+
     async def has_used_trial(self, user_id: int) -> bool:
         async with self.session_factory() as session:
             try:
@@ -821,6 +1653,8 @@ class Database:
                 logger.error(f"Error marking trial used for user {user_id}: {e}")
                 await session.rollback()
                 return False
+            finally:
+                self.user_cache.invalidate(user_id)
 
     async def get_all_payments_paginated(self, offset: int = 0, limit: int = 10) -> tuple[List[Payment], int]:
         async with self.session_factory() as session:
@@ -903,24 +1737,268 @@ class Database:
                 result = await session.execute(
                     select(UserSubscription).where(UserSubscription.subscription_id == plan_id)
                 )
-                return list(result.scalars().all())
+                return list(result.scalars().all())
+            except Exception as e:
+                logger.error(f"Error getting user subscriptions for plan {plan_id}: {e}")
+                return []
+
+    async def delete_user_subscription(self, user_subscription_id: int) -> bool:
+        async with self.session_factory() as session:
+            try:
+                from sqlalchemy import delete
+                result = await session.execute(
+                    delete(UserSubscription).where(UserSubscription.id == user_subscription_id)
+                )
+                await session.commit()
+                self._subscriptions_changed()
+                return result.rowcount > 0
+            except Exception as e:
+                logger.error(f"Error deleting user subscription {user_subscription_id}: {e}")
+                await session.rollback()
+                return False
+
+    async def delete_user_subscriptions(self, user_subscription_ids: List[int]) -> int:
+        if not user_subscription_ids:
+            return 0
+
+        async with self.session_factory() as session:
+            try:
+                from sqlalchemy import delete
+                result = await session.execute(
+                    delete(UserSubscription).where(UserSubscription.id.in_(user_subscription_ids))
+                )
+                await session.commit()
+                self._subscriptions_changed()
+                return result.rowcount
+            except Exception as e:
+                logger.error(f"Error deleting user subscriptions {user_subscription_ids}: {e}")
+                await session.rollback()
+                return 0
+
+    async def _select_by_telegram_ids(self, query, column, telegram_ids: Optional[List[int]], chunk_size: int = 500):
+        """Строки query целиком или только для telegram_ids (IN-списками по chunk_size)."""
+        async with self.session_factory() as session:
+            if telegram_ids is None:
+                return list(await session.execute(query))
+
+            rows = []
+            for start in range(0, len(telegram_ids), chunk_size):
+                chunk = telegram_ids[start:start + chunk_size]
+                rows.extend(await session.execute(query.where(column.in_(chunk))))
+            return rows
+
+    async def get_user_sync_index(self, telegram_ids: Optional[List[int]] = None) -> Dict[int, Dict[str, Any]]:
+        """telegram_id -> {'id', 'remnawave_uuid'} для всех (или только указанных) пользователей."""
+        try:
+            from sqlalchemy import select
+            rows = await self._select_by_telegram_ids(
+                select(User.id, User.telegram_id, User.remnawave_uuid),
+                User.telegram_id,
+                telegram_ids
+            )
+            return {
+                row.telegram_id: {'id': row.id, 'remnawave_uuid': row.remnawave_uuid}
+                for row in rows
+            }
+        except Exception as e:
+            logger.error(f"Error building user sync index: {e}")
+            return {}
+
+    async def get_user_subscription_sync_index(self, telegram_ids: Optional[List[int]] = None) -> Dict[Tuple[int, str], Dict[str, Any]]:
+        """(user_id, short_uuid) -> поля подписки, которые сверяются с панелью."""
+        try:
+            from sqlalchemy import select
+            rows = await self._select_by_telegram_ids(
+                select(
+                    UserSubscription.id,
+                    UserSubscription.user_id,
+                    UserSubscription.short_uuid,
+                    UserSubscription.subscription_id,
+                    UserSubscription.expires_at,
+                    UserSubscription.is_active,
+                    UserSubscription.traffic_limit_gb
+                ),
+                UserSubscription.user_id,
+                telegram_ids
+            )
+            return {
+                (row.user_id, row.short_uuid): {
+                    'id': row.id,
+                    'subscription_id': row.subscription_id,
+                    'expires_at': row.expires_at,
+                    'is_active': row.is_active,
+                    'traffic_limit_gb': row.traffic_limit_gb
+                }
+                for row in rows
+            }
+        except Exception as e:
+            logger.error(f"Error building user subscription sync index: {e}")
+            return {}
+
+    async def get_sync_watermark(self, name: str) -> Optional[datetime]:
+        async with self.session_factory() as session:
+            try:
+                state = await session.get(SyncState, name)
+                return state.watermark if state else None
+            except Exception as e:
+                logger.error(f"Error getting sync watermark {name}: {e}")
+                return None
+
+    async def set_sync_watermark(self, name: str, watermark: datetime) -> bool:
+        async with self.session_factory() as session:
+            try:
+                await session.merge(SyncState(name=name, watermark=watermark, updated_at=datetime.utcnow()))
+                await session.commit()
+                return True
+            except Exception as e:
+                logger.error(f"Error saving sync watermark {name}: {e}")
+                await session.rollback()
+                return False
+
+    def _insert_ignoring_duplicates(self, model, conflict_columns: List[str]):
+        from sqlalchemy import insert
+
+        dialect = self.engine.dialect.name
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        elif dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            return insert(model)
+        return dialect_insert(model).on_conflict_do_nothing(index_elements=conflict_columns)
+
+    async def _execute_in_chunks(self, statement, rows: List[Dict[str, Any]], chunk_size: int, label: str) -> int:
+        """Выполняет statement как executemany по chunk_size строк, каждая пачка в своей транзакции.
+
+        Ошибка в пачке откатывает только ее; возвращается число строк в успешно
+        записанных пачках.
+        """
+        written = 0
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            async with self.session_factory() as session:
+                try:
+                    await session.execute(statement, chunk)
+                    await session.commit()
+                    written += len(chunk)
+                except Exception as e:
+                    logger.error(f"Error writing {label} batch of {len(chunk)} rows at offset {start}: {e}")
+                    await session.rollback()
+        return written
+
+    async def bulk_insert_users(self, rows: List[Dict[str, Any]], chunk_size: int = 500) -> int:
+        if not rows:
+            return 0
+        statement = self._insert_ignoring_duplicates(User, ['telegram_id'])
+        inserted = await self._execute_in_chunks(statement, rows, chunk_size, 'users insert')
+        self.stats_cache.invalidate('overview')
+        return inserted
+
+    async def bulk_update_users(self, rows: List[Dict[str, Any]], chunk_size: int = 500) -> int:
+        """UPDATE по первичному ключу: каждая строка содержит id, telegram_id и новые значения."""
+        if not rows:
+            return 0
+
+        from sqlalchemy import update
+        try:
+            return await self._execute_in_chunks(update(User), rows, chunk_size, 'users update')
+        finally:
+            for row in rows:
+                self.user_cache.invalidate(row['telegram_id'])
+
+    async def bulk_insert_user_subscriptions(self, rows: List[Dict[str, Any]], chunk_size: int = 500) -> int:
+        if not rows:
+            return 0
+
+        from sqlalchemy import insert
+        written = await self._execute_in_chunks(insert(UserSubscription), rows, chunk_size, 'user subscriptions insert')
+        self._subscriptions_changed()
+        return written
+
+    async def bulk_update_user_subscriptions(self, rows: List[Dict[str, Any]], chunk_size: int = 500) -> int:
+        """UPDATE по первичному ключу: каждая строка содержит id и новые значения."""
+        if not rows:
+            return 0
+
+        from sqlalchemy import update
+        now = datetime.utcnow()
+        rows = [{**row, 'updated_at': now} for row in rows]
+        written = await self._execute_in_chunks(update(UserSubscription), rows, chunk_size, 'user subscriptions update')
+        self._subscriptions_changed()
+        return written
+
+    async def get_sent_notifications(self, kind: str, keys: List[Tuple[int, int, datetime]]) -> set:
+        """Какие из ключей (user_subscription_id, threshold, expires_at) уже отправлены - одним запросом."""
+        if not keys:
+            return set()
+
+        async with self.session_factory() as session:
+            try:
+                from sqlalchemy import select
+                result = await session.execute(
+                    select(NotificationLog.user_subscription_id, NotificationLog.threshold, NotificationLog.expires_at)
+                    .where(
+                        NotificationLog.kind == kind,
+                        NotificationLog.user_subscription_id.in_({key[0] for key in keys})
+                    )
+                )
+                sent = {tuple(row) for row in result}
+                return {key for key in keys if key in sent}
             except Exception as e:
-                logger.error(f"Error getting user subscriptions for plan {plan_id}: {e}")
-                return []
+                logger.error(f"Error checking sent {kind} notifications: {e}")
+                return set()
 
-    async def delete_user_subscription(self, user_subscription_id: int) -> bool:
+    async def log_notifications(self, kind: str, keys: List[Tuple[int, int, datetime]]) -> int:
+        if not keys:
+            return 0
+
+        now = datetime.utcnow()
+        rows = [
+            {'user_subscription_id': user_sub_id, 'kind': kind, 'threshold': threshold,
+             'expires_at': expires_at, 'sent_at': now}
+            for user_sub_id, threshold, expires_at in keys
+        ]
+        statement = self._insert_ignoring_duplicates(
+            NotificationLog, ['user_subscription_id', 'kind', 'threshold', 'expires_at']
+        )
+        return await self._execute_in_chunks(statement, rows, 500, f'{kind} notification log')
+
+    async def cleanup_notification_log(self, older_than_days: int = 60) -> int:
         async with self.session_factory() as session:
             try:
                 from sqlalchemy import delete
                 result = await session.execute(
-                    delete(UserSubscription).where(UserSubscription.id == user_subscription_id)
+                    delete(NotificationLog).where(
+                        NotificationLog.sent_at < datetime.utcnow() - timedelta(days=older_than_days)
+                    )
                 )
                 await session.commit()
-                return result.rowcount > 0
+                return result.rowcount
             except Exception as e:
-                logger.error(f"Error deleting user subscription {user_subscription_id}: {e}")
+                logger.error(f"Error cleaning up notification log: {e}")
                 await session.rollback()
-                return False
+                return 0
+
+    async def get_sync_totals(self) -> Dict[str, int]:
+        async with self.session_factory() as session:
+            try:
+                from sqlalchemy import select, func, case
+                users = await session.execute(select(func.count(User.id)))
+                subscriptions = await session.execute(
+                    select(
+                        func.count(UserSubscription.id),
+                        func.coalesce(func.sum(case((UserSubscription.is_active == True, 1), else_=0)), 0)
+                    )
+                )
+                total_subscriptions, active_subscriptions = subscriptions.one()
+                return {
+                    'users': users.scalar() or 0,
+                    'subscriptions': total_subscriptions or 0,
+                    'active_subscriptions': int(active_subscriptions or 0)
+                }
+            except Exception as e:
+                logger.error(f"Error getting sync totals: {e}")
+                return {'users': 0, 'subscriptions': 0, 'active_subscriptions': 0}
 
     async def create_referral(self, referrer_id: int, referred_id: int, referral_code: str) -> Optional[ReferralProgram]:
         async with self.session_factory() as session:
@@ -1065,6 +2143,7 @@ class Database:
                 )
                 session.add(referral)
                 await session.commit()
+                self.stats_cache.invalidate('referrals')
                 await session.refresh(referral)
                 return referral
             except Exception as e:
@@ -1220,6 +2299,7 @@ class Database:
                     await session.merge(referral_record)
                 
                 await session.commit()
+                self.stats_cache.invalidate('referrals')
                 return True
                 
             except Exception as e:
@@ -1244,6 +2324,8 @@ class Database:
             try:
                 await session.merge(promocode)
                 await session.commit()
+                self.stats_cache.invalidate('promocodes')
+                self.promocode_cache.clear()
                 return promocode
             except Exception as e:
                 logger.error(f"Error updating promocode {promocode.id}: {e}")
@@ -1264,6 +2346,8 @@ class Database:
                 )
             
                 await session.commit()
+                self.stats_cache.invalidate('promocodes')
+                self.promocode_cache.clear()
                 return result.rowcount > 0
             except Exception as e:
                 logger.error(f"Error deleting promocode {promocode_id}: {e}")
@@ -1333,6 +2417,8 @@ class Database:
                 )
             
                 await session.commit()
+                self.stats_cache.invalidate('promocodes')
+                self.promocode_cache.clear()
                 return result.rowcount
             
             except Exception as e:
@@ -1357,6 +2443,8 @@ class Database:
                 )
             
                 await session.commit()
+                self.stats_cache.invalidate('promocodes')
+                self.promocode_cache.clear()
                 return result.rowcount
                 
             except Exception as e:
@@ -1365,75 +2453,50 @@ class Database:
                 return 0
 
     async def get_promocode_stats(self) -> Dict:
-        async with self.session_factory() as session:
-            try:
-                from sqlalchemy import select, func, and_
-                from datetime import datetime
-            
-                total_promos = await session.execute(
-                    select(func.count(Promocode.id)).where(~Promocode.code.startswith('REF'))
-                )
-                total_count = total_promos.scalar() or 0
-            
-                active_promos = await session.execute(
-                    select(func.count(Promocode.id)).where(
-                        and_(
-                            ~Promocode.code.startswith('REF'),
-                            Promocode.is_active == True
-                        )
-                    )
-                )
-                active_count = active_promos.scalar() or 0
-                
-                expired_promos = await session.execute(
-                    select(func.count(Promocode.id)).where(
-                        and_(
-                            ~Promocode.code.startswith('REF'),
-                            Promocode.expires_at < datetime.utcnow()
-                        )
-                    )
-                )
-                expired_count = expired_promos.scalar() or 0
-            
-                total_usage = await session.execute(
-                    select(func.sum(Promocode.used_count)).where(~Promocode.code.startswith('REF'))
-                )
-                usage_count = total_usage.scalar() or 0
-            
-                total_discount = await session.execute(
-                    select(func.sum(Promocode.discount_amount * Promocode.used_count)).where(
-                        ~Promocode.code.startswith('REF')
-                    )
-                )
-                discount_amount = total_discount.scalar() or 0.0
-            
-                top_promos = await session.execute(
-                    select(Promocode.code, Promocode.used_count, Promocode.discount_amount)
-                    .where(~Promocode.code.startswith('REF'))
-                    .order_by(Promocode.used_count.desc())
-                    .limit(5)
-                )
-                top_promocodes = list(top_promos.fetchall())
-            
-                return {
-                    'total_promocodes': total_count,
-                    'active_promocodes': active_count,
-                    'expired_promocodes': expired_count,
-                    'total_usage': usage_count,
-                    'total_discount_amount': discount_amount,
-                    'top_promocodes': top_promocodes
-                }
-            
-            except Exception as e:
-                logger.error(f"Error getting promocode stats: {e}")
-                return {
-                    'total_promocodes': 0,
-                    'active_promocodes': 0,
-                    'expired_promocodes': 0,
-                    'total_usage': 0,
-                    'total_discount_amount': 0.0,
-                    'top_promocodes': []
-                }
+        try:
+            return await self.stats_cache.get_or_load('promocodes', self._load_promocode_stats)
+        except Exception as e:
+            logger.error(f"Error getting promocode stats: {e}")
+            return {
+                'total_promocodes': 0,
+                'active_promocodes': 0,
+                'expired_promocodes': 0,
+                'total_usage': 0,
+                'total_discount_amount': 0.0,
+                'top_promocodes': []
+            }
+
+    async def _load_promocode_stats(self) -> Dict:
+        async with self.session_factory() as session:
+            from sqlalchemy import select, func, case
+            from datetime import datetime
+
+            regular = ~Promocode.code.startswith('REF')
+            totals = (await session.execute(
+                select(
+                    func.count(Promocode.id),
+                    func.count(case((Promocode.is_active == True, 1))),
+                    func.count(case((Promocode.expires_at < datetime.utcnow(), 1))),
+                    func.sum(Promocode.used_count),
+                    func.sum(Promocode.discount_amount * Promocode.used_count)
+                ).where(regular)
+            )).one()
+
+            top_promos = await session.execute(
+                select(Promocode.code, Promocode.used_count, Promocode.discount_amount)
+                .where(regular)
+                .order_by(Promocode.used_count.desc())
+                .limit(5)
+            )
+
+            return {
+                'total_promocodes': totals[0] or 0,
+                'active_promocodes': totals[1] or 0,
+                'expired_promocodes': totals[2] or 0,
+                'total_usage': totals[3] or 0,
+                'total_discount_amount': totals[4] or 0.0,
+                'top_promocodes': [tuple(row) for row in top_promos.fetchall()]
+            }
 
     async def get_promocode_usage_by_id(self, promocode_id: int) -> List[PromocodeUsage]:
         async with self.session_factory() as session:
@@ -1466,6 +2529,7 @@ class Database:
                 )
                 session.add(game)
                 await session.commit()
+                self.stats_cache.invalidate('lucky_game')
                 await session.refresh(game)
                 return game
             except Exception as e:
@@ -1612,14 +2676,19 @@ class Database:
                 return None
 
     async def complete_star_payment(self, payment_id: int, telegram_payment_charge_id: str) -> bool:
-        """Завершить платеж через звезды"""
+        """Завершить платеж через звезды
+
+        Зачисление идет через журнал с ключом stars:<charge id>, поэтому
+        повторная доставка successful_payment не зачислит сумму дважды.
+        """
+        idempotency_key = f"stars:{telegram_payment_charge_id}"
         async with self.session_factory() as session:
             try:
                 from sqlalchemy import update
             
                 result = await session.execute(
                     update(StarPayment)
-                    .where(StarPayment.id == payment_id)
+                    .where(StarPayment.id == payment_id, StarPayment.status == 'pending')
                     .values(
                         status='completed',
                         telegram_payment_charge_id=telegram_payment_charge_id,
@@ -1628,7 +2697,8 @@ class Database:
                 )
             
                 if result.rowcount == 0:
-                    return False
+                    await session.rollback()
+                    return await self.get_balance_transaction(idempotency_key) is not None
             
                 payment_result = await session.execute(
                     select(StarPayment).where(StarPayment.id == payment_id)
@@ -1638,24 +2708,24 @@ class Database:
                 if not payment:
                     return False
             
-                balance_result = await session.execute(
-                    update(User)
-                    .where(User.telegram_id == payment.user_id)
-                    .values(balance=User.balance + payment.rub_amount)
-                )
-            
-                regular_payment = Payment(
-                    user_id=payment.user_id,
-                    amount=payment.rub_amount,
-                    payment_type='stars',
-                    description=f'Пополнение через Telegram Stars ({payment.stars_amount} ⭐)',
-                    status='completed'
+                ledger = await self._apply_balance_change(
+                    session, payment.user_id, payment.rub_amount, 'stars',
+                    idempotency_key=idempotency_key,
+                    description=f'Пополнение через Telegram Stars ({payment.stars_amount} ⭐)'
                 )
-                session.add(regular_payment)
+                if not ledger['success']:
+                    logger.error(f"Star payment {payment_id} not credited: {ledger['status']}")
+                    await session.rollback()
+                    return False
             
                 await session.commit()
+                self.user_cache.invalidate(payment.user_id)
+                self.stats_cache.invalidate('overview')
                 return True
             
+            except IntegrityError:
+                await session.rollback()
+                return await self.get_balance_transaction(idempotency_key) is not None
             except Exception as e:
                 logger.error(f"Error completing star payment {payment_id}: {e}")
                 await session.rollback()
@@ -1694,39 +2764,6 @@ class Database:
                 logger.error(f"Error getting user star payments for {user_id}: {e}")
                 return []
 
-    async def migrate_star_payments_table(self):
-        try:
-            async with self.engine.begin() as conn:
-                try:
-                    await conn.execute(text("SELECT 1 FROM star_payments LIMIT 1"))
-                    logger.info("star_payments table already exists")
-                    return
-                except Exception:
-                    pass
-            
-                await conn.execute(text("""
-                    CREATE TABLE star_payments (
-                        id SERIAL PRIMARY KEY,
-                        user_id BIGINT NOT NULL,
-                        stars_amount INTEGER NOT NULL,
-                        rub_amount DOUBLE PRECISION NOT NULL,
-                        status VARCHAR(50) DEFAULT 'pending',
-                        telegram_payment_charge_id VARCHAR(255),
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        completed_at TIMESTAMP
-                    )
-                """))
-            
-                try:
-                    await conn.execute(text("CREATE INDEX idx_star_payments_user ON star_payments(user_id)"))
-                    await conn.execute(text("CREATE INDEX idx_star_payments_status ON star_payments(status)"))
-                except Exception as e:
-                    logger.warning(f"Some indexes may already exist: {e}")
-            
-                logger.info("Successfully created star_payments table")
-        except Exception as e:
-            logger.error(f"Error creating star_payments table: {e}")
-
     async def create_service_rule(self, title: str, content: str, page_order: int = None) -> ServiceRule:
         async with self.session_factory() as session:
             if page_order is None:
@@ -1890,44 +2927,6 @@ class Database:
         except Exception as e:
             logger.error(f"Error creating service_rules table: {e}")
 
-    async def migrate_autopay_fields(self):
-        try:
-            async with self.engine.begin() as conn:
-                try:
-                    await conn.execute(text("SELECT auto_pay_enabled FROM user_subscriptions LIMIT 1"))
-                    logger.info("auto_pay_enabled field already exists")
-                except Exception:
-                    try:
-                        await conn.execute(text("""
-                            ALTER TABLE user_subscriptions 
-                            ADD COLUMN auto_pay_enabled BOOLEAN DEFAULT FALSE
-                        """))
-                        logger.info("Added auto_pay_enabled column")
-                    except Exception as e:
-                        logger.error(f"Error adding auto_pay_enabled column: {e}")
-                        pass
-        
-            async with self.engine.begin() as conn:
-                try:
-                    await conn.execute(text("SELECT auto_pay_days_before FROM user_subscriptions LIMIT 1"))
-                    logger.info("auto_pay_days_before field already exists")
-                except Exception:
-                    try:
-                        await conn.execute(text("""
-                            ALTER TABLE user_subscriptions 
-                            ADD COLUMN auto_pay_days_before INTEGER DEFAULT 3
-                        """))
-                        logger.info("Added auto_pay_days_before column")
-                    except Exception as e:
-                        logger.error(f"Error adding auto_pay_days_before column: {e}")
-                        pass
-        
-            logger.info("Successfully completed autopay fields migration")
-        
-        except Exception as e:
-            logger.error(f"Error during autopay migration: {e}")
-
-
     async def get_autopay_history(self, limit: int = 50) -> List[Dict[str, Any]]:
         async with self.session_factory() as session:
             try:
@@ -1989,6 +2988,7 @@ class Database:
                 )
             
                 await session.commit()
+                self._subscriptions_changed()
                 return result.rowcount
             
             except Exception as e:
@@ -2017,80 +3017,55 @@ class Database:
                 return None
 
     async def get_autopay_statistics(self) -> Dict[str, Any]:
+        try:
+            return await self.stats_cache.get_or_load('autopay', self._load_autopay_statistics)
+        except Exception as e:
+            logger.error(f"Error getting autopay statistics: {e}")
+            return {
+                'total_autopay_subscriptions': 0,
+                'active_autopay_subscriptions': 0,
+                'expired_autopay_subscriptions': 0,
+                'ready_for_autopay': []
+            }
+
+    async def _load_autopay_statistics(self) -> Dict[str, Any]:
         async with self.session_factory() as session:
-            try:
-                from sqlalchemy import select, func, and_, case
-                from datetime import datetime, timedelta
-            
-                total_autopay = await session.execute(
-                    select(func.count(UserSubscription.id))
-                    .where(UserSubscription.auto_pay_enabled == True)
-                )
-                total_autopay_subscriptions = total_autopay.scalar() or 0
-            
-                active_autopay = await session.execute(
-                    select(func.count(UserSubscription.id))
-                    .where(
-                        and_(
-                            UserSubscription.auto_pay_enabled == True,
-                            UserSubscription.is_active == True,
-                            UserSubscription.expires_at > datetime.utcnow()
-                        )
-                    )
-                )
-                active_autopay_subscriptions = active_autopay.scalar() or 0
-            
-                expired_autopay = await session.execute(
-                    select(func.count(UserSubscription.id))
-                    .where(
-                        and_(
-                            UserSubscription.auto_pay_enabled == True,
-                            UserSubscription.expires_at <= datetime.utcnow()
-                        )
-                    )
-                )
-                expired_autopay_subscriptions = expired_autopay.scalar() or 0
-            
-                ready_for_autopay = []
-                current_time = datetime.utcnow()
-            
-                for days in [1, 2, 3, 5, 7]:
-                    threshold_date = current_time + timedelta(days=days)
-                
-                    ready_count = await session.execute(
-                        select(func.count(UserSubscription.id))
-                        .where(
-                            and_(
-                                UserSubscription.auto_pay_enabled == True,
-                                UserSubscription.is_active == True,
-                                UserSubscription.auto_pay_days_before == days,
-                                UserSubscription.expires_at <= threshold_date,
-                                UserSubscription.expires_at > current_time
-                            )
-                        )
-                    )
-                
-                    count = ready_count.scalar() or 0
-                    ready_for_autopay.append({
-                        'days': days,
-                        'count': count
-                    })
-            
-                return {
-                    'total_autopay_subscriptions': total_autopay_subscriptions,
-                    'active_autopay_subscriptions': active_autopay_subscriptions,
-                    'expired_autopay_subscriptions': expired_autopay_subscriptions,
-                    'ready_for_autopay': ready_for_autopay
-                }
-            
-            except Exception as e:
-                logger.error(f"Error getting autopay statistics: {e}")
-                return {
-                    'total_autopay_subscriptions': 0,
-                    'active_autopay_subscriptions': 0,
-                    'expired_autopay_subscriptions': 0,
-                    'ready_for_autopay': []
-                }
+            from sqlalchemy import select, func, and_, case
+            from datetime import datetime, timedelta
+
+            current_time = datetime.utcnow()
+            active = and_(
+                UserSubscription.is_active == True,
+                UserSubscription.expires_at > current_time
+            )
+            columns = [
+                func.count(UserSubscription.id),
+                func.count(case((active, 1))),
+                func.count(case((UserSubscription.expires_at <= current_time, 1)))
+            ]
+            for days in AUTOPAY_DAYS_OPTIONS:
+                columns.append(func.count(case((
+                    and_(
+                        active,
+                        UserSubscription.auto_pay_days_before == days,
+                        UserSubscription.expires_at <= current_time + timedelta(days=days)
+                    ),
+                    1
+                ))))
+
+            row = (await session.execute(
+                select(*columns).where(UserSubscription.auto_pay_enabled == True)
+            )).one()
+
+            return {
+                'total_autopay_subscriptions': row[0],
+                'active_autopay_subscriptions': row[1],
+                'expired_autopay_subscriptions': row[2],
+                'ready_for_autopay': [
+                    {'days': days, 'count': count}
+                    for days, count in zip(AUTOPAY_DAYS_OPTIONS, row[3:])
+                ]
+            }
 
     async def get_users_with_insufficient_autopay_balance(self) -> List[Dict[str, Any]]:
         async with self.session_factory() as session:
@@ -2351,192 +3326,155 @@ class Database:
                 return None
 
     async def get_user_subscriptions_stats_admin(self) -> Dict[str, Any]:
+        try:
+            return await self.stats_cache.get_or_load('subscriptions', self._load_user_subscriptions_stats)
+        except Exception as e:
+            logger.error(f"Error getting user subscriptions stats: {e}")
+            return {
+                'total_subscriptions': 0,
+                'active_subscriptions': 0,
+                'expired_subscriptions': 0,
+                'autopay_subscriptions': 0,
+                'expiring_subscriptions': 0,
+                'trial_subscriptions': 0,
+                'imported_subscriptions': 0
+            }
+
+    async def _load_user_subscriptions_stats(self) -> Dict[str, Any]:
         async with self.session_factory() as session:
-            try:
-                from sqlalchemy import select, func, and_, or_
-                from datetime import datetime, timedelta
-            
-                current_time = datetime.utcnow()
-            
-                total_subs = await session.execute(
-                    select(func.count(UserSubscription.id))
-                )
-                total_subscriptions = total_subs.scalar() or 0
-            
-                active_subs = await session.execute(
-                    select(func.count(UserSubscription.id)).where(
-                        and_(
-                            UserSubscription.is_active == True,
-                            UserSubscription.expires_at > current_time
-                        )
-                    )
-                )
-                active_subscriptions = active_subs.scalar() or 0
-            
-                expired_subs = await session.execute(
-                    select(func.count(UserSubscription.id)).where(
+            from sqlalchemy import select, func, and_, or_, case
+            from datetime import datetime, timedelta
+
+            current_time = datetime.utcnow()
+            active = and_(
+                UserSubscription.is_active == True,
+                UserSubscription.expires_at > current_time
+            )
+
+            row = (await session.execute(
+                select(
+                    func.count(UserSubscription.id),
+                    func.count(case((active, 1))),
+                    func.count(case((
                         or_(
                             UserSubscription.is_active == False,
                             UserSubscription.expires_at <= current_time
-                        )
-                    )
-                )
-                expired_subscriptions = expired_subs.scalar() or 0
-            
-                autopay_subs = await session.execute(
-                    select(func.count(UserSubscription.id)).where(
-                        UserSubscription.auto_pay_enabled == True
-                    )
-                )
-                autopay_subscriptions = autopay_subs.scalar() or 0
-            
-                expiring_date = current_time + timedelta(days=7)
-                expiring_subs = await session.execute(
-                    select(func.count(UserSubscription.id)).where(
-                        and_(
-                            UserSubscription.is_active == True,
-                            UserSubscription.expires_at > current_time,
-                            UserSubscription.expires_at <= expiring_date
-                        )
-                    )
-                )
-                expiring_subscriptions = expiring_subs.scalar() or 0
-            
-                trial_subs = await session.execute(
-                    select(func.count(UserSubscription.id))
-                    .select_from(
-                        UserSubscription.__table__.join(
-                            Subscription.__table__, UserSubscription.subscription_id == Subscription.id
-                        )
-                    )
-                    .where(Subscription.is_trial == True)
-                )
-                trial_subscriptions = trial_subs.scalar() or 0
-                
-                imported_subs = await session.execute(
-                    select(func.count(UserSubscription.id))
-                    .select_from(
-                        UserSubscription.__table__.join(
-                            Subscription.__table__, UserSubscription.subscription_id == Subscription.id
-                        )
-                    )
-                    .where(Subscription.is_imported == True)
-                )
-                imported_subscriptions = imported_subs.scalar() or 0
-            
-                return {
-                    'total_subscriptions': total_subscriptions,
-                    'active_subscriptions': active_subscriptions,
-                    'expired_subscriptions': expired_subscriptions,
-                    'autopay_subscriptions': autopay_subscriptions,
-                    'expiring_subscriptions': expiring_subscriptions,
-                    'trial_subscriptions': trial_subscriptions,
-                    'imported_subscriptions': imported_subscriptions
-                }
-            
-            except Exception as e:
-                logger.error(f"Error getting user subscriptions stats: {e}")
-                return {
-                    'total_subscriptions': 0,
-                    'active_subscriptions': 0,
-                    'expired_subscriptions': 0,
-                    'autopay_subscriptions': 0,
-                    'expiring_subscriptions': 0,
-                    'trial_subscriptions': 0,
-                    'imported_subscriptions': 0
-                }
+                        ),
+                        1
+                    ))),
+                    func.count(case((UserSubscription.auto_pay_enabled == True, 1))),
+                    func.count(case((
+                        and_(active, UserSubscription.expires_at <= current_time + timedelta(days=7)),
+                        1
+                    ))),
+                    func.count(case((Subscription.is_trial == True, 1))),
+                    func.count(case((Subscription.is_imported == True, 1)))
+                )
+                .select_from(UserSubscription)
+                .outerjoin(Subscription, UserSubscription.subscription_id == Subscription.id)
+            )).one()
+
+            return {
+                'total_subscriptions': row[0],
+                'active_subscriptions': row[1],
+                'expired_subscriptions': row[2],
+                'autopay_subscriptions': row[3],
+                'expiring_subscriptions': row[4],
+                'trial_subscriptions': row[5],
+                'imported_subscriptions': row[6]
+            }
 
     async def get_lucky_game_admin_stats(self) -> dict:
+        try:
+            return await self.stats_cache.get_or_load('lucky_game', self._load_lucky_game_admin_stats)
+        except Exception as e:
+            logger.error(f"Error getting lucky game admin stats: {e}")
+            return {
+                'total_games': 0,
+                'total_wins': 0,
+                'unique_players': 0,
+                'total_rewards': 0.0,
+                'avg_reward': 0.0,
+                'games_today': 0,
+                'wins_today': 0,
+                'win_rate': 0,
+                'win_rate_today': 0,
+                'first_game': None,
+                'last_game': None
+            }
+
+    async def _load_lucky_game_admin_stats(self) -> dict:
+        async with self.session_factory() as session:
+            from sqlalchemy import select, func, and_, case
+            from datetime import date
+
+            is_today = func.date(LuckyGame.played_at) == date.today()
+            row = (await session.execute(
+                select(
+                    func.count(LuckyGame.id),
+                    func.count(case((LuckyGame.is_winner == True, 1))),
+                    func.count(func.distinct(LuckyGame.user_id)),
+                    func.sum(LuckyGame.reward_amount),
+                    func.avg(case((LuckyGame.is_winner == True, LuckyGame.reward_amount))),
+                    func.count(case((is_today, 1))),
+                    func.count(case((and_(is_today, LuckyGame.is_winner == True), 1))),
+                    func.min(LuckyGame.played_at),
+                    func.max(LuckyGame.played_at)
+                )
+            )).one()
+
+            total_games, total_wins, unique_players = row[0], row[1], row[2]
+            games_today, wins_today = row[5], row[6]
+            first_game_date, last_game_date = row[7], row[8]
+
+            win_rate = (total_wins / total_games * 100) if total_games > 0 else 0
+            win_rate_today = (wins_today / games_today * 100) if games_today > 0 else 0
+
+            return {
+                'total_games': total_games,
+                'total_wins': total_wins,
+                'unique_players': unique_players,
+                'total_rewards': row[3] or 0.0,
+                'avg_reward': row[4] or 0.0,
+                'games_today': games_today,
+                'wins_today': wins_today,
+                'win_rate': win_rate,
+                'win_rate_today': win_rate_today,
+                'first_game': first_game_date.isoformat() if first_game_date else None,
+                'last_game': last_game_date.isoformat() if last_game_date else None
+            }
+
+    async def get_referral_stats(self) -> Dict[str, Any]:
+        try:
+            return await self.stats_cache.get_or_load('referrals', self._load_referral_stats)
+        except Exception as e:
+            logger.error(f"Error getting referral stats: {e}")
+            return {'total_paid': 0.0, 'active_referrers': 0, 'total_referrals': 0}
+
+    async def _load_referral_stats(self) -> Dict[str, Any]:
         async with self.session_factory() as session:
-            try:
-                from sqlalchemy import select, func, and_, text
-                from datetime import date
-            
-                total_games = await session.execute(
-                    select(func.count(LuckyGame.id))
-                )
-                total_games = total_games.scalar() or 0
-            
-                total_wins = await session.execute(
-                    select(func.count(LuckyGame.id)).where(LuckyGame.is_winner == True)
-                )
-                total_wins = total_wins.scalar() or 0
-            
-                unique_players = await session.execute(
-                    select(func.count(func.distinct(LuckyGame.user_id)))
-                )
-                unique_players = unique_players.scalar() or 0
-            
-                total_rewards = await session.execute(
-                    select(func.sum(LuckyGame.reward_amount))
-                )
-                total_rewards = total_rewards.scalar() or 0.0
-            
-                avg_reward = await session.execute(
-                    select(func.avg(LuckyGame.reward_amount)).where(LuckyGame.is_winner == True)
-                )
-                avg_reward = avg_reward.scalar() or 0.0
-            
-                today = date.today()
-                games_today = await session.execute(
-                    select(func.count(LuckyGame.id)).where(
-                        func.date(LuckyGame.played_at) == today
-                    )
-                )
-                games_today = games_today.scalar() or 0
-                
-                wins_today = await session.execute(
-                    select(func.count(LuckyGame.id)).where(
-                        and_(
-                            func.date(LuckyGame.played_at) == today,
-                            LuckyGame.is_winner == True
-                        )
-                    )
-                )
-                wins_today = wins_today.scalar() or 0
-            
-                first_game = await session.execute(
-                    select(LuckyGame.played_at).order_by(LuckyGame.played_at.asc()).limit(1)
-                )
-                first_game_date = first_game.scalar()
-            
-                last_game = await session.execute(
-                    select(LuckyGame.played_at).order_by(LuckyGame.played_at.desc()).limit(1)
+            from sqlalchemy import select, func, and_
+
+            earnings = select(
+                func.sum(ReferralEarning.amount).label('total_paid'),
+                func.count(func.distinct(ReferralEarning.referrer_id)).label('active_referrers')
+            ).subquery()
+            total_referrals = select(func.count(ReferralProgram.id)).where(
+                and_(
+                    ReferralProgram.referred_id < 900000000,
+                    ReferralProgram.referred_id > 0
                 )
-                last_game_date = last_game.scalar()
-            
-                win_rate = (total_wins / total_games * 100) if total_games > 0 else 0
-                win_rate_today = (wins_today / games_today * 100) if games_today > 0 else 0
-            
-                return {
-                    'total_games': total_games,
-                    'total_wins': total_wins,
-                    'unique_players': unique_players,
-                    'total_rewards': total_rewards,
-                    'avg_reward': avg_reward,
-                    'games_today': games_today,
-                    'wins_today': wins_today,
-                    'win_rate': win_rate,
-                    'win_rate_today': win_rate_today,
-                    'first_game': first_game_date.isoformat() if first_game_date else None,
-                    'last_game': last_game_date.isoformat() if last_game_date else None
-                }
-            
-            except Exception as e:
-                logger.error(f"Error getting lucky game admin stats: {e}")
-                return {
-                    'total_games': 0,
-                    'total_wins': 0,
-                    'unique_players': 0,
-                    'total_rewards': 0.0,
-                    'avg_reward': 0.0,
-                    'games_today': 0,
-                    'wins_today': 0,
-                    'win_rate': 0,
-                    'win_rate_today': 0,
-                    'first_game': None,
-                    'last_game': None
-                }
+            ).scalar_subquery()
+
+            row = (await session.execute(
+                select(earnings.c.total_paid, earnings.c.active_referrers, total_referrals)
+            )).one()
+
+            return {
+                'total_paid': row[0] or 0.0,
+                'active_referrers': row[1] or 0,
+                'total_referrals': row[2] or 0
+            }
 
     async def get_lucky_game_top_players(self, limit: int = 5) -> List[dict]:
         try:
@@ -0,0 +1,111 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+
+class SQLStorage(BaseStorage):
+    """FSM-хранилище в таблице fsm_records той же БД, что и у бота.
+
+    Состояние и данные одного ключа лежат в одной строке. Записи старше
+    state_ttl секунд считаются отсутствующими и периодически удаляются.
+    """
+
+    def __init__(self, db: Database, state_ttl: int = 86400, cleanup_interval: int = 3600):
+        self.db = db
+        self.state_ttl = state_ttl
+        self.cleanup_interval = cleanup_interval
+        self._last_cleanup = time.monotonic()
+        self._cleanup_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _build_key(key: StorageKey) -> str:
+        parts = [
+            key.bot_id,
+            key.chat_id,
+            key.user_id,
+            getattr(key, 'thread_id', None) or '',
+            getattr(key, 'business_connection_id', None) or '',
+            key.destiny
+        ]
+        return ':'.join(str(part) for part in parts)
+
+    async def _load(self, key: StorageKey):
+        return await self.db.get_fsm_record(self._build_key(key), self.state_ttl)
+
+    async def _save(self, key: StorageKey, **values: Optional[str]):
+        await self.db.save_fsm_record(self._build_key(key), self.state_ttl, **values)
+        self._schedule_cleanup()
+
+    def _schedule_cleanup(self):
+        if self.state_ttl <= 0 or time.monotonic() - self._last_cleanup < self.cleanup_interval:
+            return
+        if self._cleanup_task and not self._cleanup_task.done():
+            return
+
+        self._last_cleanup = time.monotonic()
+        self._cleanup_task = asyncio.create_task(self._cleanup())
+
+    async def _cleanup(self):
+        deleted = await self.db.delete_expired_fsm_records(self.state_ttl)
+        if deleted:
+            logger.info(f"🧹 Removed {deleted} expired FSM records")
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        await self._save(key, state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = await self._load(key)
+        return record.state if record else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await self._save(key, data=json.dumps(dict(data), ensure_ascii=False) if data else None)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = await self._load(key)
+        if not record or not record.data:
+            return {}
+        return json.loads(record.data)
+
+    async def close(self) -> None:
+        if self._cleanup_task and not self._cleanup_task.done():
+            self._cleanup_task.cancel()
+
+
+def create_fsm_storage(config, db: Database) -> BaseStorage:
+    """Выбирает FSM-хранилище по FSM_STORAGE: memory, sql или redis."""
+    backend = (getattr(config, 'FSM_STORAGE', 'sql') or 'sql').lower()
+    state_ttl = getattr(config, 'FSM_STATE_TTL', 86400)
+
+    if backend == 'redis':
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+            storage = RedisStorage.from_url(
+                config.FSM_REDIS_URL,
+                state_ttl=state_ttl or None,
+                data_ttl=state_ttl or None
+            )
+            logger.info("✅ FSM storage: Redis")
+            return storage
+        except ImportError:
+            logger.warning("⚠️ redis package is not installed, falling back to SQL FSM storage")
+            backend = 'sql'
+        except Exception as e:
+            logger.error(f"❌ Failed to create Redis FSM storage: {e}, falling back to SQL FSM storage")
+            backend = 'sql'
+
+    if backend == 'sql':
+        logger.info(f"✅ FSM storage: SQL (ttl={state_ttl}s)")
+        return SQLStorage(db, state_ttl=state_ttl)
+
+    logger.info("FSM storage: memory (состояния не переживают рестарт)")
+    return MemoryStorage()
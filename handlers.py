@@ -53,6 +53,7 @@ class BotStates(StatesGroup):
     admin_broadcast_text = State()
     admin_search_user_uuid = State()
     admin_search_user_any = State()
+    admin_search_user_username = State()
     admin_edit_user_expiry = State()
     admin_edit_user_traffic = State()
     admin_test_monitor_user = State()
@@ -142,7 +143,7 @@ async def language_callback(callback: CallbackQuery, state: FSMContext, db: Data
     
     try:
         user.language = lang
-        await db.update_user(user)
+        await db.update_user_fields(user.telegram_id, language=lang)
         logger.info(f"Updated language for user {user.telegram_id} to {lang}")
         
         current_state = await state.get_state()
@@ -249,7 +250,7 @@ async def trial_subscription_callback(callback: CallbackQuery, db: Database, **k
         logger.error(f"Error showing trial info: {e}")
         await callback.answer(t('error_occurred', user.language))
 
-@router.callback_query(F.data == "confirm_trial")
+@router.callback_query(F.data == "confirm_trial", flags={'rate_limit': 'payment'})
 async def confirm_trial_callback(callback: CallbackQuery, db: Database, **kwargs):
     user = kwargs.get('user')
     api = kwargs.get('api')
@@ -473,7 +474,7 @@ async def topup_support_callback(callback: CallbackQuery, state: FSMContext, **k
     )
     await state.set_state(BotStates.waiting_amount)
 
-@router.message(StateFilter(BotStates.waiting_amount))
+@router.message(StateFilter(BotStates.waiting_amount), flags={'rate_limit': 'payment'})
 async def handle_amount(message: Message, state: FSMContext, db: Database, **kwargs):
     user = kwargs.get('user')
     config = kwargs.get('config')
@@ -665,7 +666,7 @@ async def buy_subscription_detail(callback: CallbackQuery, db: Database, **kwarg
         logger.error(f"Error showing subscription detail: {e}")
         await callback.answer(t('error_occurred', user.language))
 
-@router.callback_query(F.data.startswith("confirm_buy_"))
+@router.callback_query(F.data.startswith("confirm_buy_"), flags={'rate_limit': 'payment'})
 async def confirm_purchase(callback: CallbackQuery, db: Database, **kwargs):
     user = kwargs.get('user')
     api = kwargs.get('api')
@@ -758,8 +759,30 @@ async def confirm_purchase(callback: CallbackQuery, db: Database, **kwargs):
             )
             return
 
-        user.balance -= subscription.price
-        await db.update_user(user)
+        charge = await db.post_balance_change(
+            user.telegram_id,
+            -subscription.price,
+            'subscription',
+            idempotency_key=f"purchase:{user.telegram_id}:{subscription.id}:{callback.message.message_id}",
+            description=f'Покупка подписки: {subscription.name}'
+        )
+        
+        if charge['status'] != 'posted':
+            logger.warning(f"Purchase charge for user {user.telegram_id} not posted: {charge['status']}, removing panel user {user_uuid}")
+            try:
+                await api.delete_user(user_uuid)
+            except Exception as e:
+                logger.error(f"Failed to remove unpaid RemnaWave user {user_uuid}: {e}")
+            if charge['status'] == 'duplicate':
+                return
+            await callback.message.edit_text(
+                t('insufficient_balance', user.language) if charge['status'] == 'insufficient_funds'
+                else "❌ Ошибка создания подписки. Средства не списаны.",
+                reply_markup=main_menu_keyboard(user.language, user.is_admin)
+            )
+            return
+        
+        user.balance = charge['balance']
 
         expires_at = datetime.utcnow() + timedelta(days=subscription.duration_days)
         
@@ -772,15 +795,7 @@ async def confirm_purchase(callback: CallbackQuery, db: Database, **kwargs):
         
         if not user.remnawave_uuid:
             user.remnawave_uuid = user_uuid
-            await db.update_user(user)
-        
-        payment = await db.create_payment(
-            user_id=user.telegram_id,
-            amount=-subscription.price, 
-            payment_type='subscription', 
-            description=f'Покупка подписки: {subscription.name}',
-            status='completed'
-        )
+            await db.update_user_fields(user.telegram_id, remnawave_uuid=user_uuid)
         
         
         success_text = f"✅ Подписка успешно создана!\n\n"
@@ -826,23 +841,26 @@ async def my_subscriptions_callback(callback: CallbackQuery, db: Database, **kwa
         return
     
     try:
-        user_subs = await db.get_user_subscriptions(user.telegram_id)
+        views = await db.get_user_subscription_views(user.telegram_id)
         
-        if not user_subs:
+        if not views:
             await callback.message.edit_text(
                 t('no_subscriptions', user.language),
                 reply_markup=back_keyboard("main_menu", user.language)
             )
             return
         
+        subscription_urls = {}
+        if api:
+            subscription_urls = await api.get_subscription_urls(
+                [user_sub.short_uuid for user_sub, _ in views if user_sub.short_uuid]
+            )
+        
         text = t('your_subscriptions', user.language) + "\n\n"
+        sub_list = []
+        now = datetime.utcnow()
         
-        for i, user_sub in enumerate(user_subs, 1):
-            subscription = await db.get_subscription_by_id(user_sub.subscription_id)
-            if not subscription:
-                continue
-            
-            now = datetime.utcnow()
+        for i, (user_sub, subscription) in enumerate(views, 1):
             if user_sub.expires_at < now:
                 status = "❌ Истекла"
             elif not user_sub.is_active:
@@ -860,31 +878,18 @@ async def my_subscriptions_callback(callback: CallbackQuery, db: Database, **kwa
             text += f"   До: {format_date(user_sub.expires_at, user.language)}\n"
             
             if user_sub.short_uuid and api:
-                try:
-                    subscription_url = await api.get_subscription_url(user_sub.short_uuid)
-                    if subscription_url:
-                        text += f"   🔗 <a href='{subscription_url}'>Подключить</a>\n"
-                    else:
-                        text += f"   🔗 URL недоступен\n"
-                except Exception as e:
-                    logger.warning(f"Could not get subscription URL for {user_sub.short_uuid}: {e}")
+                subscription_url = subscription_urls.get(user_sub.short_uuid)
+                if subscription_url:
+                    text += f"   🔗 <a href='{subscription_url}'>Подключить</a>\n"
+                else:
                     text += f"   🔗 URL недоступен\n"
             
             text += "\n"
-        
-        
-        sub_list = []
-        for user_sub in user_subs:
-            subscription = await db.get_subscription_by_id(user_sub.subscription_id)
-            if subscription:
-                display_name = subscription.name
-                if subscription.is_imported or subscription.name == "Старая подписка":
-                    display_name += " 🔄"
-                
-                sub_list.append({
-                    'id': user_sub.id,
-                    'name': display_name
-                })
+            
+            sub_list.append({
+                'id': user_sub.id,
+                'name': subscription_name
+            })
         
         await callback.message.edit_text(
             text,
@@ -909,18 +914,12 @@ async def view_subscription_detail(callback: CallbackQuery, db: Database, **kwar
     try:
         user_sub_id = int(callback.data.split("_")[2])
         
-        user_subs = await db.get_user_subscriptions(user.telegram_id)
-        user_sub = next((sub for sub in user_subs if sub.id == user_sub_id), None)
+        user_sub, subscription = await db.get_user_subscription_view(user.telegram_id, user_sub_id)
         
         if not user_sub:
             await callback.answer("❌ Подписка не найдена")
             return
         
-        subscription = await db.get_subscription_by_id(user_sub.subscription_id)
-        if not subscription:
-            await callback.answer("❌ Подписка не найдена")
-            return
-        
         sub_dict = {
             'name': subscription.name,
             'duration_days': subscription.duration_days,
@@ -1002,18 +1001,12 @@ async def extend_subscription_callback(callback: CallbackQuery, db: Database, **
     try:
         user_sub_id = int(callback.data.split("_")[2])
         
-        user_subs = await db.get_user_subscriptions(user.telegram_id)
-        user_sub = next((sub for sub in user_subs if sub.id == user_sub_id), None)
+        user_sub, subscription = await db.get_user_subscription_view(user.telegram_id, user_sub_id)
         
         if not user_sub:
             await callback.answer(t('subscription_not_found', user.language))
             return
         
-        subscription = await db.get_subscription_by_id(user_sub.subscription_id)
-        if not subscription:
-            await callback.answer(t('subscription_not_found', user.language))
-            return
-        
         if subscription.is_trial:
             await callback.answer("❌ Тестовую подписку нельзя продлить")
             return
@@ -1062,7 +1055,7 @@ async def extend_subscription_callback(callback: CallbackQuery, db: Database, **
         logger.error(f"Error showing extend subscription: {e}")
         await callback.answer(t('error_occurred', user.language))
 
-@router.callback_query(F.data.startswith("confirm_extend_"))
+@router.callback_query(F.data.startswith("confirm_extend_"), flags={'rate_limit': 'payment'})
 async def confirm_extend_subscription_callback(callback: CallbackQuery, db: Database, **kwargs):
     user = kwargs.get('user')
     api = kwargs.get('api')
@@ -1074,26 +1067,32 @@ async def confirm_extend_subscription_callback(callback: CallbackQuery, db: Data
     try:
         user_sub_id = int(callback.data.split("_")[2])
         
-        user_subs = await db.get_user_subscriptions(user.telegram_id)
-        user_sub = next((sub for sub in user_subs if sub.id == user_sub_id), None)
+        user_sub, subscription = await db.get_user_subscription_view(user.telegram_id, user_sub_id, use_cache=False)
         
         if not user_sub:
             await callback.answer(t('subscription_not_found', user.language))
             return
         
-        subscription = await db.get_subscription_by_id(user_sub.subscription_id)
-        if not subscription:
-            await callback.answer(t('subscription_not_found', user.language))
-            return
-        
         if subscription.is_trial:
             await callback.answer("❌ Тестовую подписку нельзя продлить")
             return
         
-        if user.balance < subscription.price:
+        charge = await db.post_balance_change(
+            user.telegram_id,
+            -subscription.price,
+            'subscription_extend',
+            idempotency_key=f"extend:{user_sub.id}:{user_sub.expires_at.isoformat()}",
+            description=f'Продление подписки: {subscription.name}'
+        )
+        
+        if charge['status'] == 'duplicate':
+            return
+        
+        if not charge['success']:
             await callback.answer("❌ Недостаточно средств")
             return
         
+        user.balance = charge['balance']
         now = datetime.utcnow()
         
         if user_sub.expires_at > now:
@@ -1145,17 +1144,6 @@ async def confirm_extend_subscription_callback(callback: CallbackQuery, db: Data
         user_sub.is_active = True
         await db.update_user_subscription(user_sub)
         
-        user.balance -= subscription.price
-        await db.update_user(user)
-        
-        payment = await db.create_payment(
-            user_id=user.telegram_id,
-            amount=-subscription.price, 
-            payment_type='subscription_extend', 
-            description=f'Продление подписки: {subscription.name}',
-            status='completed'
-        )
-        
         
         success_text = f"✅ Подписка успешно продлена!\n\n"
         success_text += f"📋 Подписка: {subscription.name}\n"
@@ -1201,10 +1189,8 @@ async def get_connection_callback(callback: CallbackQuery, db: Database, **kwarg
         return
     
     try:
-        user_subs = await db.get_user_subscriptions(user.telegram_id)
-        
         sub_id = int(callback.data.split("_")[2])
-        user_sub = next((s for s in user_subs if s.id == sub_id), None)
+        user_sub, _ = await db.get_user_subscription_view(user.telegram_id, sub_id)
         if not user_sub:
             await callback.answer("❌ Подписка не найдена")
             return
@@ -1290,7 +1276,7 @@ async def promocode_callback(callback: CallbackQuery, state: FSMContext, **kwarg
     await state.update_data(promocode_message_id=edited_message.message_id)
     await state.set_state(BotStates.waiting_promocode)
 
-@router.message(StateFilter(BotStates.waiting_promocode))
+@router.message(StateFilter(BotStates.waiting_promocode), flags={'rate_limit': 'payment'})
 async def handle_promocode(message: Message, state: FSMContext, db: Database, **kwargs):
     user = kwargs.get('user')
     config = kwargs.get('config')
@@ -1325,41 +1311,25 @@ async def handle_promocode(message: Message, state: FSMContext, db: Database, **
         promocode = await db.get_promocode_by_code(code)
         
         if promocode and promocode.is_active:
+            # Промокод мог прийти из кэша: срок и исчерпанный лимит отсекаем без БД,
+            # окончательное решение за redeem_promocode
             if promocode.expires_at and promocode.expires_at < datetime.utcnow():
-                response_msg = await message.answer(
-                    "❌ Промокод истек",
-                    reply_markup=main_menu_keyboard(user.language, user.is_admin)
-                )
-                
-                if bot and promocode_message_id:
-                    try:
-                        await bot.delete_message(chat_id=message.chat.id, message_id=promocode_message_id)
-                    except:
-                        pass
-                        
-                await state.clear()
-                return
-            
-            if promocode.used_count >= promocode.usage_limit:
-                response_msg = await message.answer(
-                    "❌ Лимит использования промокода исчерпан",
-                    reply_markup=main_menu_keyboard(user.language, user.is_admin)
-                )
-                
-                if bot and promocode_message_id:
-                    try:
-                        await bot.delete_message(chat_id=message.chat.id, message_id=promocode_message_id)
-                    except:
-                        pass
-                        
-                await state.clear()
-                return
-            
-            success = await db.use_promocode(user.telegram_id, promocode)
+                redemption = {'success': False, 'status': 'expired'}
+            elif promocode.used_count >= promocode.usage_limit:
+                redemption = {'success': False, 'status': 'limit_reached'}
+            else:
+                redemption = await db.redeem_promocode(user.telegram_id, promocode.id)
             
-            if not success:
+            if not redemption['success']:
+                error_messages = {
+                    'expired': "❌ Промокод истек",
+                    'limit_reached': "❌ Лимит использования промокода исчерпан",
+                    'already_used': "❌ Вы уже использовали этот промокод",
+                    'inactive': "❌ Промокод не найден",
+                    'not_found': "❌ Промокод не найден",
+                }
                 response_msg = await message.answer(
-                    "❌ Вы уже использовали этот промокод",
+                    error_messages.get(redemption['status'], "❌ Произошла ошибка при обработке промокода"),
                     reply_markup=main_menu_keyboard(user.language, user.is_admin)
                 )
                 
@@ -1372,17 +1342,7 @@ async def handle_promocode(message: Message, state: FSMContext, db: Database, **
                 await state.clear()
                 return
             
-            await db.add_balance(user.telegram_id, promocode.discount_amount)
-            
-            await db.create_payment(
-                user_id=user.telegram_id,
-                amount=promocode.discount_amount,
-                payment_type='promocode',
-                description=f'Промокод: {code}',
-                status='completed'
-            )
-            
-            discount_text = f"{promocode.discount_amount} руб."
+            discount_text = f"{redemption['amount']} руб."
             success_msg = await message.answer(
                 t('promocode_success', user.language, discount=discount_text),
                 reply_markup=main_menu_keyboard(user.language, user.is_admin)
@@ -1809,18 +1769,12 @@ async def toggle_autopay_callback(callback: CallbackQuery, db: Database, **kwarg
     try:
         user_sub_id = int(callback.data.split("_")[2])
         
-        user_subs = await db.get_user_subscriptions(user.telegram_id)
-        user_sub = next((sub for sub in user_subs if sub.id == user_sub_id), None)
+        user_sub, subscription = await db.get_user_subscription_view(user.telegram_id, user_sub_id)
         
         if not user_sub:
             await callback.answer("❌ Подписка не найдена")
             return
         
-        subscription = await db.get_subscription_by_id(user_sub.subscription_id)
-        if not subscription:
-            await callback.answer("❌ План подписки не найден")
-            return
-        
         if subscription.is_trial:
             await callback.answer("❌ Автоплатеж недоступен для тестовых подписок")
             return
@@ -1835,12 +1789,7 @@ async def toggle_autopay_callback(callback: CallbackQuery, db: Database, **kwarg
         if success:
             status_text = "включен" if new_state else "отключен"
             await callback.answer(f"✅ Автоплатеж {status_text}")
-            
-            updated_subs = await db.get_user_subscriptions(user.telegram_id)
-            updated_sub = next((sub for sub in updated_subs if sub.id == user_sub_id), None)
-            
-            if updated_sub:
-                await autopay_settings_callback(callback, db, user=user)
+            await autopay_settings_callback(callback, db, user=user)
         else:
             await callback.answer("❌ Ошибка изменения настроек")
         
@@ -1927,18 +1876,12 @@ async def autopay_settings_callback(callback: CallbackQuery, db: Database, **kwa
     try:
         user_sub_id = int(callback.data.split("_")[2])
         
-        user_subs = await db.get_user_subscriptions(user.telegram_id)
-        user_sub = next((sub for sub in user_subs if sub.id == user_sub_id), None)
+        user_sub, subscription = await db.get_user_subscription_view(user.telegram_id, user_sub_id)
         
         if not user_sub:
             await callback.answer("❌ Подписка не найдена")
             return
         
-        subscription = await db.get_subscription_by_id(user_sub.subscription_id)
-        if not subscription:
-            await callback.answer("❌ План подписки не найден")
-            return
-        
         if subscription.is_trial:
             await callback.answer("❌ Автоплатеж недоступен для тестовых подписок")
             return
@@ -1998,8 +1941,7 @@ async def autopay_days_callback(callback: CallbackQuery, db: Database, **kwargs)
         user_sub_id = int(parts[2])
         days = int(parts[3])
         
-        user_subs = await db.get_user_subscriptions(user.telegram_id)
-        user_sub = next((sub for sub in user_subs if sub.id == user_sub_id), None)
+        user_sub, _ = await db.get_user_subscription_view(user.telegram_id, user_sub_id)
         
         if not user_sub:
             await callback.answer("❌ Подписка не найдена")
@@ -2009,12 +1951,7 @@ async def autopay_days_callback(callback: CallbackQuery, db: Database, **kwargs)
         
         if success:
             await callback.answer(f"✅ Установлено: продлять за {days} дн.")
-            
-            updated_subs = await db.get_user_subscriptions(user.telegram_id)
-            updated_sub = next((sub for sub in updated_subs if sub.id == user_sub_id), None)
-            
-            if updated_sub:
-                await autopay_settings_callback(callback, db, user=user)
+            await autopay_settings_callback(callback, db, user=user)
         else:
             await callback.answer("❌ Ошибка обновления настроек")
         
@@ -2022,7 +1959,7 @@ async def autopay_days_callback(callback: CallbackQuery, db: Database, **kwargs)
         logger.error(f"Error setting autopay days: {e}")
         await callback.answer("❌ Ошибка операции")
 
-@router.callback_query(F.data == "topup_tribute")
+@router.callback_query(F.data == "topup_tribute", flags={'rate_limit': 'payment'})
 async def topup_tribute_callback(callback: CallbackQuery, **kwargs):
     user = kwargs.get('user')
     config = kwargs.get('config')
@@ -2078,7 +2015,7 @@ async def create_tribute_payment(callback, user, amount: int, config):
         logger.error(f"Error creating Tribute payment: {e}")
         await callback.answer("❌ Ошибка создания платежа")
 
-@router.callback_query(F.data.startswith("check_tribute_"))
+@router.callback_query(F.data.startswith("check_tribute_"), flags={'rate_limit': 'payment'})
 async def check_tribute_payment_callback(callback: CallbackQuery, db: Database, **kwargs):
     user = kwargs.get('user')
     
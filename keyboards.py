@@ -259,6 +259,60 @@ def admin_users_keyboard(lang: str = 'ru') -> InlineKeyboardMarkup:
     ])
     return keyboard
 
+def admin_users_list_keyboard(first_id: int, last_id: int, has_prev: bool, has_next: bool,
+                              lang: str = 'ru') -> InlineKeyboardMarkup:
+    buttons = []
+
+    nav_row = []
+    if has_prev:
+        nav_row.append(InlineKeyboardButton(text="⬅️", callback_data=f"bot_users_prev_{first_id}"))
+    if has_next:
+        nav_row.append(InlineKeyboardButton(text="➡️", callback_data=f"bot_users_next_{last_id}"))
+    if nav_row:
+        buttons.append(nav_row)
+
+    buttons.append([
+        InlineKeyboardButton(text="🔍 Фильтры", callback_data="users_filters"),
+        InlineKeyboardButton(text="🔎 Username", callback_data="search_user")
+    ])
+    buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="admin_users")])
+
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+def admin_users_filters_keyboard(filters: dict, lang: str = 'ru') -> InlineKeyboardMarkup:
+    """Клавиатура фильтров списка пользователей: каждая кнопка перебирает значения"""
+    balance_labels = {None: "любой", 'positive': "> 0", 'zero': "= 0", 'rich': "≥ 100"}
+    created_labels = {None: "когда угодно", 1: "за сутки", 7: "за неделю", 30: "за месяц"}
+    active_labels = {None: "неважно", True: "есть", False: "нет"}
+
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(
+            text=f"💰 Баланс: {balance_labels.get(filters.get('balance'))}",
+            callback_data="users_filter_balance"
+        )],
+        [InlineKeyboardButton(
+            text=f"🌐 Язык: {filters.get('language') or 'любой'}",
+            callback_data="users_filter_language"
+        )],
+        [InlineKeyboardButton(
+            text=f"👑 Только админы: {'да' if filters.get('is_admin') else 'нет'}",
+            callback_data="users_filter_admin"
+        )],
+        [InlineKeyboardButton(
+            text=f"📅 Регистрация: {created_labels.get(filters.get('created_days'))}",
+            callback_data="users_filter_created"
+        )],
+        [InlineKeyboardButton(
+            text=f"📋 Активная подписка: {active_labels.get(filters.get('has_active_subscription'))}",
+            callback_data="users_filter_active"
+        )],
+        [
+            InlineKeyboardButton(text="♻️ Сбросить", callback_data="users_filter_reset"),
+            InlineKeyboardButton(text="👥 Показать", callback_data="list_users")
+        ]
+    ])
+    return keyboard
+
 def admin_user_subscriptions_filters_keyboard(lang: str = 'ru') -> InlineKeyboardMarkup:
     """Клавиатура фильтров для подписок пользователей"""
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -512,6 +566,34 @@ def admin_messages_keyboard(lang: str = 'ru') -> InlineKeyboardMarkup:
     ])
     return keyboard
 
+def broadcast_audience_keyboard(lang: str = 'ru') -> InlineKeyboardMarkup:
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="👥 Все пользователи", callback_data="broadcast_audience_all")],
+        [InlineKeyboardButton(text="✅ С активной подпиской", callback_data="broadcast_audience_active")],
+        [InlineKeyboardButton(text="💤 Без активной подписки", callback_data="broadcast_audience_inactive")],
+        [
+            InlineKeyboardButton(text="🇷🇺 Русский язык", callback_data="broadcast_audience_lang_ru"),
+            InlineKeyboardButton(text="🇺🇸 English", callback_data="broadcast_audience_lang_en")
+        ],
+        [InlineKeyboardButton(text="❌ " + t('cancel', lang), callback_data="admin_messages")]
+    ])
+    return keyboard
+
+def broadcast_control_keyboard(job_id: int, status: str, lang: str = 'ru') -> Optional[InlineKeyboardMarkup]:
+    if status == 'running':
+        buttons = [[
+            InlineKeyboardButton(text="⏸ Пауза", callback_data=f"broadcast_pause_{job_id}"),
+            InlineKeyboardButton(text="⏹ Отменить", callback_data=f"broadcast_cancel_{job_id}")
+        ]]
+    elif status == 'paused':
+        buttons = [[
+            InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"broadcast_resume_{job_id}"),
+            InlineKeyboardButton(text="⏹ Отменить", callback_data=f"broadcast_cancel_{job_id}")
+        ]]
+    else:
+        buttons = [[InlineKeyboardButton(text="🔙 " + t('back', lang), callback_data="admin_messages")]]
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
 def quick_topup_keyboard(lang: str = 'ru') -> InlineKeyboardMarkup:
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -556,6 +638,7 @@ def admin_system_keyboard(lang: str = 'ru') -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="👥 Пользователи системы", callback_data="system_users")],
         [InlineKeyboardButton(text="🔄 Синхронизация с RemnaWave", callback_data="sync_remnawave")],
         [InlineKeyboardButton(text="🔍 Отладка API", callback_data="debug_api_comprehensive")],
+        [InlineKeyboardButton(text="📈 Метрики API", callback_data="api_metrics")],
         [InlineKeyboardButton(text="🔙 " + t('back', lang), callback_data="admin_panel")]
     ])
     return keyboard
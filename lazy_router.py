@@ -0,0 +1,50 @@
+import asyncio
+import importlib
+import logging
+import time
+from typing import Any, Callable, Dict, Optional
+
+from aiogram import Router
+from aiogram.types import TelegramObject
+
+logger = logging.getLogger(__name__)
+
+
+class LazyRouter(Router):
+    """Заглушка на месте тяжелого роутера, который импортируется по требованию.
+
+    Стоит в цепочке роутеров там же, где стоял бы настоящий. Пока модуль не
+    загружен, события проходят насквозь; первое событие, для которого
+    should_load(data) вернул True, импортирует module и подключает
+    module.<attribute> как вложенный роутер, после чего событие
+    обрабатывается уже им. Middleware диспетчера действуют на вложенный
+    роутер так же, как если бы он был подключен при старте.
+    """
+
+    def __init__(self, module: str, attribute: str,
+                 should_load: Optional[Callable[[Dict[str, Any]], bool]] = None,
+                 name: Optional[str] = None):
+        super().__init__(name=name or f"lazy:{module}")
+        self.module = module
+        self.attribute = attribute
+        self.should_load = should_load
+        self.loaded = False
+        self.load_time: Optional[float] = None
+        self._lock = asyncio.Lock()
+
+    async def propagate_event(self, update_type: str, event: TelegramObject, **kwargs: Any) -> Any:
+        if not self.loaded and (self.should_load is None or self.should_load(kwargs)):
+            await self.load()
+        return await super().propagate_event(update_type, event, **kwargs)
+
+    async def load(self):
+        async with self._lock:
+            if self.loaded:
+                return
+
+            started = time.monotonic()
+            module = importlib.import_module(self.module)
+            self.include_router(getattr(module, self.attribute))
+            self.loaded = True
+            self.load_time = time.monotonic() - started
+            logger.info(f"📦 Loaded {self.module} on first use in {self.load_time:.2f}s")
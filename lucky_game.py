@@ -152,7 +152,7 @@ async def start_lucky_game_callback(callback: CallbackQuery, db: Database, state
         logger.error(f"Error starting lucky game: {e}")
         await callback.answer("❌ Ошибка запуска игры")
 
-@lucky_game_router.callback_query(F.data.startswith("choose_number_"), StateFilter(LuckyGameStates.waiting_number_choice))
+@lucky_game_router.callback_query(F.data.startswith("choose_number_"), StateFilter(LuckyGameStates.waiting_number_choice), flags={'rate_limit': 'payment'})
 async def choose_number_callback(callback: CallbackQuery, db: Database, state: FSMContext, **kwargs):
     """Обработка выбора числа"""
     user = kwargs.get('user')
@@ -175,14 +175,12 @@ async def choose_number_callback(callback: CallbackQuery, db: Database, state: F
         await save_game_result(db, user.telegram_id, chosen_number, winning_numbers, is_winner, reward_amount if is_winner else 0.0)
         
         if is_winner:
-            await db.add_balance(user.telegram_id, reward_amount)
-            
-            await db.create_payment(
-                user_id=user.telegram_id,
-                amount=reward_amount,
-                payment_type='lucky_game',
-                description=f'Выигрыш в игре удачи (число {chosen_number})',
-                status='completed'
+            await db.post_balance_change(
+                user.telegram_id,
+                reward_amount,
+                'lucky_game',
+                idempotency_key=f"lucky_game:{user.telegram_id}:{datetime.utcnow().date().isoformat()}",
+                description=f'Выигрыш в игре удачи (число {chosen_number})'
             )
             
             text = "🎉 **ПОЗДРАВЛЯЕМ! ВЫ ВЫИГРАЛИ!** 🎉\n\n"
@@ -1,18 +1,20 @@
 import asyncio
 import logging
+import signal
 import sys
 import os
+import time
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from lucky_game import lucky_game_router
 from stars_handlers import stars_router
 from autopay_service import AutoPayService
+from broadcast_service import BroadcastService
+from sync_service import RemnaWaveSyncService
 
 print("🚀 Запуск бота...")
 print(f"📍 Рабочая директория: {os.getcwd()}")
-print(f"📁 Файлы в директории: {os.listdir('.')}")
 
 if os.path.exists('.env'):
     print("✅ Файл .env найден")
@@ -23,10 +25,15 @@ else:
 from config import load_config, debug_environment
 from database import Database
 from remnawave_api import RemnaWaveAPI
+from panel_users_store import PanelUsersStore
+from fsm_storage import create_fsm_storage
 from subscription_monitor import create_subscription_monitor
-from middlewares import DatabaseMiddleware, UserMiddleware, LoggingMiddleware, ThrottlingMiddleware, WorkflowDataMiddleware, BotMiddleware
+from middlewares import DatabaseMiddleware, UserMiddleware, LoggingMiddleware, RateLimitMiddleware, WorkflowDataMiddleware, BotMiddleware
+from rate_limiter import create_rate_limiter
+from update_queue import UpdateQueue
+from scheduler import DueEventScheduler
 from handlers import router
-from admin_handlers import admin_router
+from lazy_router import LazyRouter
 
 logging.basicConfig(
     level=logging.INFO,
@@ -44,11 +51,20 @@ class BotApplication:
         self.config = None
         self.db = None
         self.api = None
+        self.panel_users_store = None
         self.bot = None
         self.dp = None
         self.monitor_service = None
         self.autopay_service = None
+        self.broadcast_service = None
+        self.sync_service = None
+        self.rate_limiter = None
+        self.update_queue = None
         self.webhook_server = None
+        self.scheduler = None
+        self.admin_router = None
+        self.startup_timings = {}
+        self._api_check_task = None
 
     async def _init_autopay_service(self):
         try:
@@ -62,7 +78,11 @@ class BotApplication:
                 logger.error("❌ Database instance is None, cannot initialize autopay")
                 return
             
-            self.autopay_service = AutoPayService(self.db, self.api, self.bot)
+            self.autopay_service = AutoPayService(
+                self.db, self.api, self.bot,
+                concurrency=self.config.AUTOPAY_CONCURRENCY,
+                periodic_check=not self.config.SCHEDULER_ENABLED
+            )
             
             self.dp.workflow_data["autopay_service"] = self.autopay_service
             logger.info("✅ Autopay service added to workflow_data")
@@ -82,7 +102,38 @@ class BotApplication:
             logger.warning("⚠️ Continuing without autopay service")
             self.autopay_service = None
         
+    async def _init_broadcast_service(self):
+        try:
+            logger.info("🔧 Initializing broadcast service...")
+            
+            self.broadcast_service = BroadcastService(
+                self.db,
+                self.bot,
+                rate_limit=self.config.BROADCAST_RATE_LIMIT,
+                concurrency=self.config.BROADCAST_CONCURRENCY,
+                progress_interval=self.config.BROADCAST_PROGRESS_INTERVAL
+            )
+            
+            self.dp.workflow_data["broadcast_service"] = self.broadcast_service
+            await self.broadcast_service.start()
+            
+            logger.info(f"✅ Broadcast service started: rate={self.config.BROADCAST_RATE_LIMIT}/s, "
+                       f"concurrency={self.config.BROADCAST_CONCURRENCY}")
+            
+        except Exception as e:
+            logger.error(f"❌ Failed to initialize broadcast service: {e}", exc_info=True)
+            logger.warning("⚠️ Continuing without broadcast service")
+            self.broadcast_service = None
+        
+    async def _timed(self, phase: str, step):
+        started = time.monotonic()
+        try:
+            return await step
+        finally:
+            self.startup_timings[phase] = time.monotonic() - started
+
     async def initialize(self):
+        started = time.monotonic()
         
         debug_environment()
         
@@ -110,29 +161,79 @@ class BotApplication:
         logger.info(f"Admin IDs: {self.config.ADMIN_IDS}")
         logger.info(f"Bot Username: {self.config.BOT_USERNAME}")
         
-        self.db = Database(self.config.DATABASE_URL)
-        
-        await self._init_database()
+        self.db = Database(
+            self.config.DATABASE_URL,
+            user_cache_ttl=self.config.USER_CACHE_TTL,
+            user_cache_size=self.config.USER_CACHE_SIZE,
+            stats_cache_ttl=self.config.STATS_CACHE_TTL,
+            subscription_view_ttl=self.config.SUBSCRIPTION_VIEW_CACHE_TTL,
+            promocode_cache_ttl=self.config.PROMOCODE_CACHE_TTL,
+            promocode_negative_ttl=self.config.PROMOCODE_NEGATIVE_CACHE_TTL
+        )
         
         self.api = RemnaWaveAPI(
             self.config.REMNAWAVE_URL, 
             self.config.REMNAWAVE_TOKEN, 
-            self.config.SUBSCRIPTION_BASE_URL
+            self.config.SUBSCRIPTION_BASE_URL,
+            subscription_url_ttl=self.config.SUBSCRIPTION_URL_CACHE_TTL,
+            subscription_url_cache_size=self.config.SUBSCRIPTION_URL_CACHE_SIZE,
+            bulk_concurrency=self.config.REMNAWAVE_BULK_CONCURRENCY,
+            max_retries=self.config.REMNAWAVE_MAX_RETRIES,
+            pool_size=self.config.REMNAWAVE_POOL_SIZE,
+            pool_per_host=self.config.REMNAWAVE_POOL_PER_HOST,
+            keepalive_timeout=self.config.REMNAWAVE_KEEPALIVE_TIMEOUT,
+            dns_cache_ttl=self.config.REMNAWAVE_DNS_CACHE_TTL,
+            connect_timeout=self.config.REMNAWAVE_CONNECT_TIMEOUT,
+            read_timeout=self.config.REMNAWAVE_READ_TIMEOUT,
+            total_timeout=self.config.REMNAWAVE_TOTAL_TIMEOUT,
+            breaker_threshold=self.config.REMNAWAVE_BREAKER_THRESHOLD,
+            breaker_recovery=self.config.REMNAWAVE_BREAKER_RECOVERY
         )
         logger.info("RemnaWave API initialized")
         
-        await self._test_api_connection()
+        self.panel_users_store = PanelUsersStore(self.api, ttl=self.config.PANEL_USERS_CACHE_TTL)
         
         self.bot = Bot(
             token=self.config.BOT_TOKEN,
             default=DefaultBotProperties(parse_mode=ParseMode.HTML)
         )
+        self.startup_timings['config'] = time.monotonic() - started
         
-        await self._test_bot_token()
+        # Проверка панели только пишет в лог, поэтому старт ее не ждет
+        self._api_check_task = asyncio.create_task(self._timed('api_check', self._test_api_connection()))
         
+        await asyncio.gather(
+            self._timed('database', self._init_database()),
+            self._timed('bot_token', self._test_bot_token())
+        )
+        
+        self.sync_service = RemnaWaveSyncService(
+            self.db,
+            self.api,
+            self.bot,
+            admin_ids=self.config.ADMIN_IDS,
+            batch_size=self.config.SYNC_BATCH_SIZE,
+            progress_interval=self.config.SYNC_PROGRESS_INTERVAL,
+            delta_interval=self.config.SYNC_DELTA_INTERVAL
+        )
+        
+        phase_started = time.monotonic()
         self._setup_dispatcher()
 
-        await self._init_webhook_server()
+        if self.config.BOT_MODE == 'webhook':
+            if not self.config.TELEGRAM_WEBHOOK_URL:
+                logger.error("TELEGRAM_WEBHOOK_URL is required for BOT_MODE=webhook")
+                raise ValueError("TELEGRAM_WEBHOOK_URL is required for BOT_MODE=webhook")
+            if not self.config.TELEGRAM_WEBHOOK_SECRET:
+                logger.error("TELEGRAM_WEBHOOK_SECRET is required for BOT_MODE=webhook")
+                raise ValueError("TELEGRAM_WEBHOOK_SECRET is required for BOT_MODE=webhook")
+            self.update_queue = UpdateQueue(
+                self.dp,
+                self.bot,
+                workers=self.config.UPDATE_WORKERS,
+                max_size=self.config.UPDATE_QUEUE_SIZE
+            )
+        self.startup_timings['dispatcher'] = time.monotonic() - phase_started
 
         if self.config.TRIBUTE_ENABLED:
             logger.info("✅ Tribute платежи включены")
@@ -143,8 +244,15 @@ class BotApplication:
         else:
             logger.info("❌ Tribute платежи отключены")
         
-        await self._init_monitor_service()
-        await self._init_autopay_service()
+        # Сервисы друг от друга не зависят; планировщику нужны монитор и автоплатежи
+        await asyncio.gather(
+            self._timed('webhook_server', self._init_webhook_server()),
+            self._timed('monitor', self._init_monitor_service()),
+            self._timed('autopay', self._init_autopay_service()),
+            self._timed('broadcast', self._init_broadcast_service()),
+            self._timed('sync', self.sync_service.start())
+        )
+        await self._timed('scheduler', self._init_scheduler())
 
         if self.config.STARS_ENABLED:
             logger.info("✅ Telegram Stars пополнение включено")
@@ -164,13 +272,38 @@ class BotApplication:
         else:
             logger.info("❌ Telegram Stars пополнение отключено")
 
+        self.startup_timings['total'] = time.monotonic() - started
+        breakdown = ", ".join(
+            f"{phase}={seconds:.2f}s" for phase, seconds in self.startup_timings.items() if phase != 'total'
+        )
+        logger.info(f"⏱ Startup finished in {self.startup_timings['total']:.2f}s ({breakdown})")
+
+    async def _init_scheduler(self):
+        if not self.config.SCHEDULER_ENABLED:
+            logger.info("⏰ Due-time scheduler disabled, using periodic checks")
+            return
+
+        try:
+            monitor_service = self.monitor_service if self.monitor_service and self.monitor_service.is_running else None
+            self.scheduler = DueEventScheduler(
+                self.db,
+                self.config,
+                autopay_service=self.autopay_service,
+                monitor_service=monitor_service,
+                max_sleep=self.config.MONITOR_CHECK_INTERVAL
+            )
+            await self.scheduler.start()
+        except Exception as e:
+            logger.error(f"❌ Failed to start due-time scheduler: {e}", exc_info=True)
+            self.scheduler = None
+
     async def _init_webhook_server(self):
         """Инициализация webhook сервера для Tribute"""
         try:
             logger.info("🔧 Initializing webhook server...")
             
             from webhook_server import WebhookServer
-            self.webhook_server = WebhookServer(self.bot, self.db, self.config)
+            self.webhook_server = WebhookServer(self.bot, self.db, self.config, update_queue=self.update_queue)
             
             logger.info("🚀 Starting webhook server...")
             await self.webhook_server.start()
@@ -179,6 +312,8 @@ class BotApplication:
             
         except Exception as e:
             logger.error(f"❌ Failed to initialize webhook server: {e}", exc_info=True)
+            if self.update_queue:
+                raise
             logger.warning("⚠️ Continuing without webhook server")
             self.webhook_server = None
         
@@ -187,8 +322,8 @@ class BotApplication:
         for attempt in range(max_retries):
             try:
                 logger.info(f"🗄️  Database initialization attempt {attempt + 1}/{max_retries}")
-                await self.db.init_db()
-                logger.info("✅ Database initialized successfully with all migrations")
+                await self.db.init_db(auto_migrate=self.config.DB_AUTO_MIGRATE)
+                logger.info("✅ Database schema is up to date")
                 break
             except Exception as e:
                 logger.error(f"❌ Database initialization attempt {attempt + 1} failed: {e}")
@@ -222,22 +357,27 @@ class BotApplication:
             raise
             
     def _setup_dispatcher(self):
-        storage = MemoryStorage()
+        storage = create_fsm_storage(self.config, self.db)
         self.dp = Dispatcher(storage=storage)
         
         self.dp.workflow_data.update({
             "config": self.config,
             "api": self.api,
+            "panel_users_store": self.panel_users_store,
+            "sync_service": self.sync_service,
             "db": self.db,
             "monitor_service": None,
-            "autopay_service": None
+            "autopay_service": None,
+            "broadcast_service": None
         })
         
         self.dp.message.middleware(LoggingMiddleware())
         self.dp.callback_query.middleware(LoggingMiddleware())
         
-        self.dp.message.middleware(ThrottlingMiddleware(rate_limit=0.5))
-        self.dp.callback_query.middleware(ThrottlingMiddleware(rate_limit=0.3))
+        self.rate_limiter = create_rate_limiter(self.config)
+        rate_limit_middleware = RateLimitMiddleware(self.rate_limiter)
+        self.dp.message.middleware(rate_limit_middleware)
+        self.dp.callback_query.middleware(rate_limit_middleware)
         
         self.dp.message.middleware(WorkflowDataMiddleware())
         self.dp.callback_query.middleware(WorkflowDataMiddleware())
@@ -251,8 +391,14 @@ class BotApplication:
         self.dp.message.middleware(UserMiddleware(self.db, self.config))
         self.dp.callback_query.middleware(UserMiddleware(self.db, self.config))
         
+        admin_ids = set(self.config.ADMIN_IDS)
+        self.admin_router = LazyRouter(
+            'admin_handlers', 'admin_router',
+            should_load=lambda data: getattr(data.get('event_from_user'), 'id', None) in admin_ids
+        )
+        
         self.dp.include_router(router)
-        self.dp.include_router(admin_router)
+        self.dp.include_router(self.admin_router)
         self.dp.include_router(lucky_game_router)
         self.dp.include_router(stars_router)
         
@@ -300,24 +446,57 @@ class BotApplication:
             self.monitor_service = None
             
     async def start(self):
-        logger.info("Bot polling started successfully")
-        
         if self.config.BOT_USERNAME:
             logger.info(f"🎁 Реферальная система активна! Ссылки: https://t.me/{self.config.BOT_USERNAME}?start=ref_USERID")
         else:
             logger.warning("⚠️  Реферальная система неактивна! Установите BOT_USERNAME")
         
         try:
-            await self.dp.start_polling(self.bot)
+            if self.update_queue:
+                await self._run_webhook()
+            else:
+                logger.info("Bot polling started successfully")
+                await self.dp.start_polling(self.bot)
         except Exception as e:
             logger.error(f"Error during polling: {e}")
             raise
         finally:
             await self.shutdown()
+    
+    async def _run_webhook(self):
+        await self.update_queue.start()
+        await self.dp.emit_startup(bot=self.bot, **self.dp.workflow_data)
+        
+        webhook_url = self.config.TELEGRAM_WEBHOOK_URL + self.config.TELEGRAM_WEBHOOK_PATH
+        await self.bot.set_webhook(
+            webhook_url,
+            secret_token=self.config.TELEGRAM_WEBHOOK_SECRET,
+            allowed_updates=self.dp.resolve_used_update_types(),
+            max_connections=min(100, max(1, self.config.UPDATE_WORKERS * 5))
+        )
+        logger.info(f"Bot webhook mode started: {webhook_url}")
+        
+        # Вебхук не снимается при остановке: с несколькими репликами за
+        # балансировщиком остальные продолжают принимать апдейты
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+        
+        try:
+            await stop_event.wait()
+        finally:
+            await self.dp.emit_shutdown(bot=self.bot, **self.dp.workflow_data)
             
     async def shutdown(self):
         logger.info("Shutting down bot...")
 
+        if self._api_check_task and not self._api_check_task.done():
+            self._api_check_task.cancel()
+
         if self.webhook_server:
             try:
                 await self.webhook_server.stop()
@@ -325,6 +504,27 @@ class BotApplication:
             except Exception as e:
                 logger.error(f"Error stopping webhook server: {e}")
 
+        if self.update_queue:
+            try:
+                await self.update_queue.stop()
+                logger.info("Update queue stopped")
+            except Exception as e:
+                logger.error(f"Error stopping update queue: {e}")
+
+        if self.broadcast_service:
+            try:
+                await self.broadcast_service.stop()
+                logger.info("Broadcast service stopped")
+            except Exception as e:
+                logger.error(f"Error stopping broadcast service: {e}")
+
+        if self.scheduler:
+            try:
+                await self.scheduler.stop()
+                logger.info("Scheduler stopped")
+            except Exception as e:
+                logger.error(f"Error stopping scheduler: {e}")
+
         if self.autopay_service: 
             try:
                 await self.autopay_service.stop()
@@ -339,6 +539,12 @@ class BotApplication:
             except Exception as e:
                 logger.error(f"Error stopping monitor service: {e}")
         
+        if self.sync_service:
+            await self.sync_service.stop()
+        
+        if self.panel_users_store:
+            await self.panel_users_store.stop()
+        
         if self.api:
             try:
                 await self.api.close()
@@ -346,6 +552,18 @@ class BotApplication:
             except Exception as e:
                 logger.error(f"Error closing API: {e}")
         
+        if self.dp:
+            try:
+                await self.dp.storage.close()
+            except Exception as e:
+                logger.error(f"Error closing FSM storage: {e}")
+        
+        if self.rate_limiter:
+            try:
+                await self.rate_limiter.close()
+            except Exception as e:
+                logger.error(f"Error closing rate limiter: {e}")
+        
         if self.db:
             try:
                 await self.db.close()
@@ -1,9 +1,12 @@
 from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
 from aiogram.types import TelegramObject, User as TgUser, Message, CallbackQuery
 from typing import Callable, Dict, Any, Awaitable
 import logging
+import math
 from database import Database, User
 from config import Config
+from rate_limiter import RateLimiter
 
 logger = logging.getLogger(__name__)
 
@@ -37,7 +40,7 @@ class UserMiddleware(BaseMiddleware):
         
         if telegram_user and not telegram_user.is_bot:
             try:
-                user = await self.db.get_user_by_telegram_id(telegram_user.id)
+                user = await self.db.get_cached_user(telegram_user.id)
                 
                 if not user:
                     is_admin = telegram_user.id in self.config.ADMIN_IDS
@@ -52,24 +55,22 @@ class UserMiddleware(BaseMiddleware):
                     )
                     logger.info(f"Created new user: {telegram_user.id} without language")
                 else:
-                    updated = False
+                    changes = {}
                     if user.username != telegram_user.username:
-                        user.username = telegram_user.username
-                        updated = True
+                        changes['username'] = telegram_user.username
                     if user.first_name != telegram_user.first_name:
-                        user.first_name = telegram_user.first_name
-                        updated = True
+                        changes['first_name'] = telegram_user.first_name
                     if user.last_name != telegram_user.last_name:
-                        user.last_name = telegram_user.last_name
-                        updated = True
+                        changes['last_name'] = telegram_user.last_name
                     
                     should_be_admin = telegram_user.id in self.config.ADMIN_IDS
                     if user.is_admin != should_be_admin:
-                        user.is_admin = should_be_admin
-                        updated = True
+                        changes['is_admin'] = should_be_admin
                     
-                    if updated:
-                        await self.db.update_user(user)
+                    if changes:
+                        for field, value in changes.items():
+                            setattr(user, field, value)
+                        self.db.queue_user_profile_update(telegram_user.id, **changes)
                 
                 data['user'] = user
                 data['lang'] = user.language if user.language and user.language != '' else self.config.DEFAULT_LANGUAGE
@@ -123,11 +124,17 @@ class LoggingMiddleware(BaseMiddleware):
         
         return await handler(event, data)
 
-class ThrottlingMiddleware(BaseMiddleware):
+class RateLimitMiddleware(BaseMiddleware):
+    """Token bucket на пользователя с отдельным бюджетом на класс хендлера.
+
+    Класс берется из флага хендлера rate_limit (flags={'rate_limit': 'payment'}),
+    для хендлеров admin-роутера - 'admin', для остальных - 'navigation'.
+    Флаг 'exempt' снимает ограничение. Вместо молчаливого отбрасывания
+    пользователь получает ответ, через сколько можно повторить.
+    """
     
-    def __init__(self, rate_limit: float = 1.0):
-        self.rate_limit = rate_limit
-        self.user_last_action = {}
+    def __init__(self, limiter: RateLimiter):
+        self.limiter = limiter
     
     async def __call__(
         self,
@@ -136,20 +143,40 @@ class ThrottlingMiddleware(BaseMiddleware):
         data: Dict[str, Any]
     ) -> Any:
         telegram_user: TgUser = data.get('event_from_user')
+        if not telegram_user:
+            return await handler(event, data)
         
-        if telegram_user:
-            import time
-            current_time = time.time()
-            user_id = telegram_user.id
-            
-            if user_id in self.user_last_action:
-                if current_time - self.user_last_action[user_id] < self.rate_limit:
-                    logger.warning(f"Throttling user {user_id}")
-                    return
-            
-            self.user_last_action[user_id] = current_time
+        handler_class = self._classify(data)
+        if handler_class == 'exempt':
+            return await handler(event, data)
         
-        return await handler(event, data)
+        retry_after = await self.limiter.hit(telegram_user.id, handler_class)
+        if retry_after <= 0:
+            return await handler(event, data)
+        
+        logger.warning(f"Rate limit: user {telegram_user.id}, class {handler_class}, retry in {retry_after:.1f}s")
+        await self._notify(event, telegram_user.id, retry_after)
+    
+    @staticmethod
+    def _classify(data: Dict[str, Any]) -> str:
+        handler_class = get_flag(data, 'rate_limit')
+        if handler_class:
+            return handler_class
+        
+        router = data.get('event_router')
+        if router is not None and router.name == 'admin':
+            return 'admin'
+        return 'navigation'
+    
+    async def _notify(self, event: TelegramObject, user_id: int, retry_after: float):
+        text = f"⏳ Слишком много запросов, повторите через {max(1, math.ceil(retry_after))} сек."
+        try:
+            if isinstance(event, CallbackQuery):
+                await event.answer(text)
+            elif isinstance(event, Message) and await self.limiter.hit(user_id, 'notice') <= 0:
+                await event.answer(text)
+        except Exception as e:
+            logger.debug(f"Could not send rate limit notice to {user_id}: {e}")
 
 class WorkflowDataMiddleware(BaseMiddleware):
     
@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import sys
+from datetime import datetime
+from typing import Callable, List, Tuple
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+logger = logging.getLogger(__name__)
+
+# Отдельные метаданные: таблицу версий создает только раннер, а не Base.metadata.create_all
+schema_version = Table(
+    'schema_version', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('description', String(255)),
+    Column('applied_at', DateTime, default=datetime.utcnow)
+)
+
+
+def _add_columns(conn: Connection, table: str, columns: List[Tuple[str, str]]):
+    existing = {column['name'] for column in inspect(conn).get_columns(table)}
+    for name, ddl in columns:
+        if name not in existing:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+            logger.info(f"Added {table}.{name}")
+
+
+def _create_indexes(conn: Connection, indexes: List[Tuple[str, str, str]]):
+    for name, table, columns in indexes:
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table}({columns})"))
+
+
+def _baseline(conn: Connection):
+    """Таблицы текущих моделей и колонки, которые раньше добавлялись при каждом старте.
+
+    Базовая миграция не заморожена: create_all строит схему по текущим
+    моделям, поэтому на новой базе объекты последующих миграций уже
+    существуют к моменту их запуска.
+    """
+    from database import Base
+
+    Base.metadata.create_all(conn)
+    _add_columns(conn, 'user_subscriptions', [
+        ('traffic_limit_gb', 'INTEGER'),
+        ('updated_at', 'TIMESTAMP'),
+        ('auto_pay_enabled', 'BOOLEAN DEFAULT FALSE'),
+        ('auto_pay_days_before', 'INTEGER DEFAULT 3'),
+    ])
+    _add_columns(conn, 'subscriptions', [
+        ('is_imported', 'BOOLEAN DEFAULT FALSE'),
+    ])
+
+
+def _scheduler_and_admin_indexes(conn: Connection):
+    _create_indexes(conn, [
+        ('idx_user_subscriptions_active_expires', 'user_subscriptions', 'is_active, expires_at'),
+        ('idx_users_created_at', 'users', 'created_at'),
+        ('idx_users_balance', 'users', 'balance'),
+        ('idx_users_username_lower', 'users', 'lower(username)'),
+    ])
+
+
+def _hot_query_indexes(conn: Connection):
+    _create_indexes(conn, [
+        ('idx_user_subscriptions_user_active', 'user_subscriptions', 'user_id, is_active, expires_at'),
+        ('idx_user_subscriptions_autopay', 'user_subscriptions', 'auto_pay_enabled, auto_pay_days_before, expires_at'),
+        ('idx_payments_user_created', 'payments', 'user_id, created_at'),
+        ('idx_payments_type_created', 'payments', 'payment_type, created_at'),
+        ('idx_promocode_usage_user_promocode', 'promocode_usage', 'user_id, promocode_id'),
+        ('idx_lucky_games_user_played', 'lucky_games', 'user_id, played_at'),
+    ])
+
+
+def _unique_promocode_usage(conn: Connection):
+    """Одна активация промокода на пользователя; дубли от старых гонок схлопываются"""
+    conn.execute(text(
+        "DELETE FROM promocode_usage WHERE id NOT IN "
+        "(SELECT MIN(id) FROM promocode_usage GROUP BY user_id, promocode_id)"
+    ))
+    conn.execute(text("DROP INDEX IF EXISTS idx_promocode_usage_user_promocode"))
+    conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_promocode_usage_user_promocode "
+        "ON promocode_usage(user_id, promocode_id)"
+    ))
+
+
+# (версия, описание, миграция). Новые миграции только дописываются в конец,
+# уже выпущенные не меняются.
+#
+# Каждая миграция обязана пропускать то, что уже есть: на новой базе baseline
+# создает схему по текущим моделям, и колонки, индексы и таблицы поздних
+# миграций к их запуску уже существуют. Поэтому колонки добавляются через
+# _add_columns (проверка по inspector), индексы - CREATE INDEX IF NOT EXISTS,
+# удаления - DROP ... IF EXISTS. Голый ADD COLUMN или CREATE INDEX упадет
+# на свежей установке; tests/test_migrations.py прогоняет все миграции
+# повторно на актуальной схеме и ловит такие ошибки.
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, 'baseline schema', _baseline),
+    (2, 'scheduler and admin user browser indexes', _scheduler_and_admin_indexes),
+    (3, 'composite indexes for hot queries', _hot_query_indexes),
+    (4, 'unique promocode usage per user', _unique_promocode_usage),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _current_version(conn: Connection) -> int:
+    if not inspect(conn).has_table('schema_version'):
+        return 0
+    return conn.execute(select(schema_version.c.version).order_by(schema_version.c.version.desc()).limit(1)).scalar() or 0
+
+
+async def get_schema_version(engine: AsyncEngine) -> int:
+    async with engine.connect() as conn:
+        return await conn.run_sync(_current_version)
+
+
+async def run_migrations(engine: AsyncEngine) -> List[int]:
+    """Применяет недостающие миграции, каждую в своей транзакции.
+
+    Если схема актуальна, это один запрос версии. Ошибка миграции не
+    глотается: транзакция откатывается, версия остается на последней
+    примененной, а исключение уходит наверх.
+    """
+    if await get_schema_version(engine) >= LATEST_VERSION:
+        return []
+
+    applied = []
+    for version, description, migration in MIGRATIONS:
+        async with engine.begin() as conn:
+            if conn.dialect.name == 'postgresql':
+                # Несколько реплик могут стартовать одновременно
+                await conn.execute(text("SELECT pg_advisory_xact_lock(72170224)"))
+            await conn.run_sync(schema_version.create, checkfirst=True)
+
+            if version <= await conn.run_sync(_current_version):
+                continue
+
+            logger.info(f"🗄️  Applying migration {version}: {description}")
+            await conn.run_sync(migration)
+            await conn.execute(schema_version.insert().values(
+                version=version, description=description, applied_at=datetime.utcnow()
+            ))
+            applied.append(version)
+
+    return applied
+
+
+async def _main(command: str) -> int:
+    from config import load_config
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    engine = create_async_engine(load_config().DATABASE_URL)
+    try:
+        version = await get_schema_version(engine)
+        if command == 'status':
+            print(f"Schema version: {version}, latest: {LATEST_VERSION}")
+            for number, description, _ in MIGRATIONS:
+                print(f"  {'✅' if number <= version else '⏳'} {number}: {description}")
+            return 0
+
+        applied = await run_migrations(engine)
+        if applied:
+            print(f"Applied migrations: {', '.join(map(str, applied))}")
+        else:
+            print(f"Schema is up to date (version {version})")
+        return 0
+    finally:
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else 'upgrade'
+    if command not in ('upgrade', 'status'):
+        print("Usage: python migrations.py [upgrade|status]")
+        sys.exit(2)
+    sys.exit(asyncio.run(_main(command)))
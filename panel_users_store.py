@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from remnawave_api import RemnaWaveAPI
+
+logger = logging.getLogger(__name__)
+
+
+class PanelUsersSnapshot:
+    """Неизменяемый снимок пользователей панели с готовыми индексами.
+
+    users уже отсортирован в порядке вывода в админке, by_status и
+    with_telegram сохраняют этот порядок, так что фильтры и страницы
+    строятся срезами без повторной сортировки.
+    """
+
+    def __init__(self, users: List[Dict]):
+        self.fetched_at = time.monotonic()
+        self.users = sorted(users, key=lambda x: (
+            0 if x.get('status') == 'ACTIVE' else 1,
+            x.get('createdAt') or '',
+        ), reverse=True)
+
+        self.by_status: Dict[str, List[Dict]] = {}
+        self.by_telegram_id: Dict[int, Dict] = {}
+        self.by_short_uuid: Dict[str, Dict] = {}
+        self.with_telegram: List[Dict] = []
+
+        for user in self.users:
+            self.by_status.setdefault(str(user.get('status', 'UNKNOWN')).upper(), []).append(user)
+            if user.get('telegramId'):
+                self.with_telegram.append(user)
+                self.by_telegram_id[user['telegramId']] = user
+            if user.get('shortUuid'):
+                self.by_short_uuid[user['shortUuid']] = user
+
+        self.counters = {
+            'total': len(self.users),
+            'active': len(self.by_status.get('ACTIVE', [])),
+            'disabled': len(self.by_status.get('DISABLED', [])),
+            'limited': len(self.by_status.get('LIMITED', [])),
+            'expired': len(self.by_status.get('EXPIRED', [])),
+            'with_telegram': len(self.with_telegram),
+        }
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+    @staticmethod
+    def page(items: List[Dict], page: int, per_page: int) -> Tuple[List[Dict], int]:
+        total_pages = max(1, (len(items) + per_page - 1) // per_page)
+        start = max(0, page) * per_page
+        return items[start:start + per_page], total_pages
+
+
+class PanelUsersStore:
+    """Общий для всех админов кэш пользователей панели RemnaWave.
+
+    Пока снимок моложе ttl, он отдается как есть. Устаревший снимок тоже
+    отдается сразу, а обновление запускается в фоне; одновременно идет не
+    больше одной загрузки, поэтому панель опрашивается не чаще раза за ttl.
+    """
+
+    def __init__(self, api: RemnaWaveAPI, ttl: int = 300):
+        self.api = api
+        self.ttl = ttl
+        self._snapshot: Optional[PanelUsersSnapshot] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._generation = 0
+
+    async def get_snapshot(self, force_refresh: bool = False) -> Optional[PanelUsersSnapshot]:
+        if force_refresh or self._snapshot is None:
+            return await self.refresh()
+
+        if self._snapshot.age > self.ttl:
+            self._start_refresh()
+
+        return self._snapshot
+
+    async def refresh(self) -> Optional[PanelUsersSnapshot]:
+        await asyncio.shield(self._start_refresh())
+        return self._snapshot
+
+    def invalidate(self):
+        """Помечает снимок устаревшим и сразу запускает обновление в фоне.
+
+        Загрузка, начатая до изменения, могла прочитать старые данные: такой
+        снимок тоже считается устаревшим и перечитывается при следующем запросе.
+        """
+        self._generation += 1
+        if self._snapshot:
+            self._snapshot.fetched_at = 0.0
+        if self._refresh_task is None or self._refresh_task.done():
+            self._start_refresh()
+
+    def _start_refresh(self) -> asyncio.Task:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._load())
+        return self._refresh_task
+
+    async def _load(self):
+        started = time.monotonic()
+        generation = self._generation
+        try:
+            users = [user async for user in self.api.iter_system_users(with_urls=False)]
+            self._snapshot = PanelUsersSnapshot(users)
+            if generation != self._generation:
+                self._snapshot.fetched_at = 0.0
+            logger.info(f"Panel users snapshot refreshed: {len(users)} users "
+                        f"in {time.monotonic() - started:.2f}s")
+        except Exception as e:
+            logger.error(f"Error refreshing panel users snapshot: {e}", exc_info=True)
+
+    async def stop(self):
+        if self._refresh_task and not self._refresh_task.done():
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+
+    def get_service_status(self) -> dict:
+        return {
+            'has_snapshot': self._snapshot is not None,
+            'snapshot_age': round(self._snapshot.age, 1) if self._snapshot else None,
+            'users': self._snapshot.counters['total'] if self._snapshot else 0,
+            'ttl': self.ttl,
+            'refreshing': bool(self._refresh_task and not self._refresh_task.done())
+        }
@@ -0,0 +1,104 @@
+import time
+import logging
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class PromocodeCache:
+    """In-process TTL/LRU кэш промокодов по нормализованному коду.
+
+    Помнит и отсутствие кода (negative_ttl, обычно короче ttl), чтобы перебор
+    несуществующих кодов не ходил в БД. Как и UserCache, хранит снимки колонок
+    и на каждый get() отдает новый отсоединенный Promocode. used_count в снимке
+    может отставать: для проверки лимита он годится только как быстрый отказ,
+    окончательно лимит проверяет Database.redeem_promocode.
+    """
+
+    def __init__(self, ttl: int = 60, negative_ttl: int = 10, max_size: int = 1000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max(1, max_size)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    @staticmethod
+    def normalize(code: str) -> str:
+        return code.strip().upper()
+
+    def get(self, code: str) -> Tuple[bool, Optional[Any]]:
+        """(найден ли код в кэше, Promocode или None для закэшированного отсутствия)"""
+        if not self.enabled:
+            return False, None
+
+        key = self.normalize(code)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return False, None
+
+        expires_at, values = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return False, None
+
+        self._entries.move_to_end(key)
+        if values is None:
+            self.negative_hits += 1
+            return True, None
+
+        self.hits += 1
+        return True, self._restore(values)
+
+    def set(self, code: str, promocode):
+        if not self.enabled:
+            return
+        if promocode is None and self.negative_ttl <= 0:
+            return
+
+        key = self.normalize(code)
+        if promocode is None:
+            self._entries[key] = (time.monotonic() + self.negative_ttl, None)
+        else:
+            self._entries[key] = (time.monotonic() + self.ttl, self._snapshot(promocode))
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, code: str):
+        self._entries.pop(self.normalize(code), None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self.hits + self.negative_hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'negative_ttl': self.negative_ttl,
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'hit_rate': round((self.hits + self.negative_hits) / total * 100, 1) if total else 0.0
+        }
+
+    @staticmethod
+    def _snapshot(promocode) -> Dict[str, Any]:
+        from database import Promocode
+        return {column.key: getattr(promocode, column.key) for column in Promocode.__table__.columns}
+
+    @staticmethod
+    def _restore(values: Dict[str, Any]):
+        from database import Promocode
+        return Promocode(**values)
@@ -0,0 +1,88 @@
+"""Нагрузочная проверка активации промокодов.
+
+Создает временную SQLite-базу, заводит пользователей и один промокод, затем
+одновременно отправляет attempts активаций от каждого пользователя и проверяет,
+что лимит не превышен, а использований, платежей и проводок ровно столько,
+сколько успешных активаций.
+
+    python promocode_load_test.py --users 300 --attempts 2 --limit 100
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from sqlalchemy import func, select
+
+from database import BalanceTransaction, Database, Payment, Promocode, PromocodeUsage, User
+
+
+async def run(users: int, attempts: int, limit: int, amount: float) -> int:
+    path = os.path.join(tempfile.mkdtemp(prefix='promocode_load_'), 'load.db')
+    db = Database(f'sqlite+aiosqlite:///{path}')
+    try:
+        await db.init_db()
+        await db.bulk_insert_users([
+            {'telegram_id': user_id, 'username': f'load{user_id}', 'first_name': 'Load', 'language': 'ru', 'balance': 0.0}
+            for user_id in range(1, users + 1)
+        ])
+        promocode = await db.create_promocode('LOADTEST', discount_amount=amount, usage_limit=limit)
+
+        requests = [user_id for user_id in range(1, users + 1) for _ in range(attempts)]
+        random.shuffle(requests)
+
+        started = time.monotonic()
+        results = await asyncio.gather(*(db.redeem_promocode(user_id, promocode.id) for user_id in requests))
+        elapsed = time.monotonic() - started
+
+        statuses = Counter(result['status'] for result in results)
+        redeemed = statuses['redeemed']
+        print(f"{len(requests)} attempts in {elapsed:.2f}s ({len(requests) / elapsed:.0f}/s): {dict(statuses)}")
+
+        async with db.session_factory() as session:
+            used_count = await session.scalar(select(Promocode.used_count).where(Promocode.id == promocode.id))
+            usages, usage_users = (await session.execute(
+                select(func.count(PromocodeUsage.id), func.count(func.distinct(PromocodeUsage.user_id)))
+                .where(PromocodeUsage.promocode_id == promocode.id)
+            )).one()
+            payments = await session.scalar(select(func.count(Payment.id)).where(Payment.payment_type == 'promocode'))
+            ledger = await session.scalar(
+                select(func.count(BalanceTransaction.id)).where(BalanceTransaction.kind == 'promocode')
+            )
+            credited = await session.scalar(select(func.coalesce(func.sum(User.balance), 0)))
+
+        expected = min(limit, users)
+        checks = {
+            'used_count == min(usage_limit, users)': used_count == expected,
+            'redeemed == used_count': redeemed == used_count,
+            'one usage per user': usages == usage_users == used_count,
+            'payments == used_count': payments == used_count,
+            'ledger entries == used_count': ledger == used_count,
+            'credited == used_count * amount': abs(credited - used_count * amount) < 1e-6,
+            'no errors': statuses['error'] == 0,
+        }
+        print(f"used_count={used_count} usages={usages} payments={payments} ledger={ledger} credited={credited}")
+        for name, passed in checks.items():
+            print(f"  {'✅' if passed else '❌'} {name}")
+        return 0 if all(checks.values()) else 1
+    finally:
+        await db.engine.dispose()
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Concurrent redemptions of one promocode against SQLite")
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--attempts', type=int, default=2, help="concurrent attempts per user")
+    parser.add_argument('--limit', type=int, default=100, help="promocode usage_limit")
+    parser.add_argument('--amount', type=float, default=50.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(asyncio.run(run(args.users, args.attempts, args.limit, args.amount)))
@@ -0,0 +1,174 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryRateLimitBackend:
+    """Token bucket'ы в памяти процесса.
+
+    Ведро, которое не трогали до полного восстановления, ничем не отличается
+    от нового, поэтому такие записи удаляются раз в cleanup_interval секунд.
+    max_size ограничивает память в худшем случае (вытесняются давно
+    не использованные ведра).
+    """
+
+    def __init__(self, max_size: int = 100000, cleanup_interval: float = 60.0):
+        self.max_size = max(1, max_size)
+        self.cleanup_interval = cleanup_interval
+        # key -> (tokens, updated_at, refilled_at)
+        self._buckets: "OrderedDict[str, Tuple[float, float, float]]" = OrderedDict()
+        self._next_cleanup = time.monotonic() + cleanup_interval
+
+    async def consume(self, key: str, rate: float, capacity: float) -> float:
+        """Забирает токен; возвращает 0 или через сколько секунд он появится."""
+        now = time.monotonic()
+        if now >= self._next_cleanup:
+            self._cleanup(now)
+
+        entry = self._buckets.pop(key, None)
+        tokens = capacity if entry is None else min(capacity, entry[0] + (now - entry[1]) * rate)
+
+        retry_after = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            retry_after = (1 - tokens) / rate
+
+        self._buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+        while len(self._buckets) > self.max_size:
+            self._buckets.popitem(last=False)
+
+        return retry_after
+
+    def _cleanup(self, now: float):
+        refilled = [key for key, (_, _, refilled_at) in self._buckets.items() if refilled_at <= now]
+        for key in refilled:
+            del self._buckets[key]
+        self._next_cleanup = now + self.cleanup_interval
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    async def close(self):
+        self._buckets.clear()
+
+
+class RedisRateLimitBackend:
+    """Token bucket'ы в Redis: лимиты общие для всех процессов бота.
+
+    Пополнение и списание выполняются одним Lua-скриптом по часам Redis,
+    ключ живет до полного восстановления ведра. Если Redis недоступен,
+    запросы пропускаются, чтобы бот не вставал вместе с ним.
+    """
+
+    SCRIPT = """
+local capacity = tonumber(ARGV[2])
+local rate = tonumber(ARGV[1])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1])
+local ts = tonumber(state[2])
+if tokens == nil or ts == nil then
+    tokens = capacity
+    ts = now
+end
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 1000)
+return tostring(retry_after)
+"""
+
+    def __init__(self, url: str, prefix: str = 'ratelimit:'):
+        import redis.asyncio as redis
+
+        self.prefix = prefix
+        self._client = redis.from_url(url)
+        self._script = self._client.register_script(self.SCRIPT)
+        self._last_error_log = 0.0
+
+    async def consume(self, key: str, rate: float, capacity: float) -> float:
+        try:
+            result = await self._script(keys=[self.prefix + key], args=[rate, capacity])
+            return float(result)
+        except Exception as e:
+            if time.monotonic() - self._last_error_log > 60:
+                self._last_error_log = time.monotonic()
+                logger.warning(f"⚠️ Redis rate limiter unavailable, requests are not limited: {e}")
+            return 0.0
+
+    async def close(self):
+        close = getattr(self._client, 'aclose', None) or self._client.close
+        await close()
+
+
+class RateLimiter:
+    """Лимиты на пользователя с отдельным бюджетом для каждого класса хендлеров.
+
+    rules: класс -> (rate токенов в секунду, burst). Неизвестный класс
+    считается по правилу default_class.
+    """
+
+    # Не чаще одного предупреждения о лимите в 10 секунд на пользователя
+    NOTICE_RULE = (0.1, 1)
+
+    def __init__(self, backend, rules: Dict[str, Tuple[float, float]], default_class: str = 'navigation'):
+        self.backend = backend
+        self.rules = {name: (max(rate, 0.01), max(burst, 1)) for name, (rate, burst) in rules.items()}
+        self.rules.setdefault('notice', self.NOTICE_RULE)
+        self.default_class = default_class
+        self.allowed: Dict[str, int] = {}
+        self.limited: Dict[str, int] = {}
+
+    async def hit(self, user_id: int, handler_class: str) -> float:
+        """0, если запрос укладывается в бюджет, иначе сколько секунд ждать."""
+        rate, burst = self.rules.get(handler_class) or self.rules[self.default_class]
+        retry_after = await self.backend.consume(f"{handler_class}:{user_id}", rate, burst)
+
+        counters = self.limited if retry_after > 0 else self.allowed
+        counters[handler_class] = counters.get(handler_class, 0) + 1
+        return retry_after
+
+    async def close(self):
+        await self.backend.close()
+
+    def get_stats(self) -> dict:
+        return {
+            'backend': type(self.backend).__name__,
+            'rules': dict(self.rules),
+            'allowed': dict(self.allowed),
+            'limited': dict(self.limited),
+            'buckets': len(self.backend) if isinstance(self.backend, MemoryRateLimitBackend) else None
+        }
+
+
+def create_rate_limiter(config) -> RateLimiter:
+    """Собирает RateLimiter по RATE_LIMIT_* из конфига: memory или redis."""
+    rules = {
+        'navigation': (config.RATE_LIMIT_NAVIGATION_RATE, config.RATE_LIMIT_NAVIGATION_BURST),
+        'payment': (config.RATE_LIMIT_PAYMENT_RATE, config.RATE_LIMIT_PAYMENT_BURST),
+        'admin': (config.RATE_LIMIT_ADMIN_RATE, config.RATE_LIMIT_ADMIN_BURST),
+    }
+    backend_name = (getattr(config, 'RATE_LIMIT_BACKEND', 'memory') or 'memory').lower()
+
+    if backend_name == 'redis':
+        try:
+            backend = RedisRateLimitBackend(config.RATE_LIMIT_REDIS_URL)
+            logger.info("✅ Rate limiter: Redis")
+            return RateLimiter(backend, rules)
+        except ImportError:
+            logger.warning("⚠️ redis package is not installed, falling back to in-memory rate limiter")
+        except Exception as e:
+            logger.error(f"❌ Failed to create Redis rate limiter: {e}, falling back to in-memory rate limiter")
+
+    logger.info("✅ Rate limiter: memory")
+    return RateLimiter(MemoryRateLimitBackend(), rules)
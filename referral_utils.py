@@ -38,17 +38,19 @@ async def process_referral_rewards(user_id: int, amount: float, payment_id: int,
         if not referral.first_reward_paid and user.balance >= threshold:
             logger.info(f"Processing first reward for referral {referral.id} (threshold: {threshold}, reward: {first_reward})")
             
-            await db.add_balance(referral.referrer_id, first_reward)
-            
-            await db.create_payment(
-                user_id=referral.referrer_id,
-                amount=first_reward,
-                payment_type='referral',
-                description=f'Первая награда за реферала ID:{user_id}',
-                status='completed'
+            reward = await db.post_balance_change(
+                referral.referrer_id,
+                first_reward,
+                'referral',
+                idempotency_key=f"referral_first:{user_id}",
+                description=f'Первая награда за реферала ID:{user_id}'
             )
             
-            success = await db.create_referral_earning(
+            if reward['status'] == 'duplicate':
+                logger.info(f"First reward for referral {referral.id} already paid")
+                return
+            
+            success = reward['success'] and await db.create_referral_earning(
                 referrer_id=referral.referrer_id,
                 referred_id=user_id,
                 amount=first_reward,
@@ -59,6 +61,14 @@ async def process_referral_rewards(user_id: int, amount: float, payment_id: int,
             if success:
                 logger.info(f"First reward paid: {first_reward}₽ to referrer {referral.referrer_id}")
                 
+                bonus = await db.post_balance_change(
+                    user_id,
+                    referred_bonus,
+                    'referral',
+                    idempotency_key=f"referral_bonus:{user_id}",
+                    description='Бонус за переход по реферальной ссылке'
+                )
+                
                 if bot:
                     try:
                         await bot.send_message(
@@ -68,41 +78,35 @@ async def process_referral_rewards(user_id: int, amount: float, payment_id: int,
                             f"Теперь вы будете получать {percentage*100:.0f}% с каждого его пополнения баланса."
                         )
                         
-                        await bot.send_message(
-                            user_id,
-                            f"🎁 Бонус активирован! Вам начислено {referred_bonus}₽ за переход по реферальной ссылке!"
-                        )
-                        
-                        await db.add_balance(user_id, referred_bonus)
-                        await db.create_payment(
-                            user_id=user_id,
-                            amount=referred_bonus,
-                            payment_type='referral',
-                            description='Бонус за переход по реферальной ссылке',
-                            status='completed'
-                        )
+                        if bonus['status'] == 'posted':
+                            await bot.send_message(
+                                user_id,
+                                f"🎁 Бонус активирован! Вам начислено {referred_bonus}₽ за переход по реферальной ссылке!"
+                            )
                         
-                        logger.info(f"Referral bonus notifications sent and balance updated")
+                        logger.info(f"Referral bonus notifications sent")
                         
                     except Exception as e:
                         logger.error(f"Failed to send referral notifications: {e}")
             else:
-                logger.error(f"Failed to create first reward earning")
+                logger.error(f"Failed to pay first referral reward: {reward['status']}")
         
         if referral.first_reward_paid:
             percentage_reward = amount * percentage
             
             if percentage_reward >= 0.01: 
-                await db.add_balance(referral.referrer_id, percentage_reward)
-                
-                await db.create_payment(
-                    user_id=referral.referrer_id,
-                    amount=percentage_reward,
-                    payment_type='referral',
-                    description=f'{percentage*100:.0f}% от пополнения реферала ID:{user_id}',
-                    status='completed'
+                reward = await db.post_balance_change(
+                    referral.referrer_id,
+                    percentage_reward,
+                    'referral',
+                    idempotency_key=f"referral_percent:{payment_id}" if payment_id else None,
+                    description=f'{percentage*100:.0f}% от пополнения реферала ID:{user_id}'
                 )
                 
+                if reward['status'] != 'posted':
+                    logger.info(f"Percentage reward for payment {payment_id} not posted: {reward['status']}")
+                    return
+                
                 success = await db.create_referral_earning(
                     referrer_id=referral.referrer_id,
                     referred_id=user_id,
@@ -1,18 +1,236 @@
 import aiohttp
 import asyncio
+import copy
 import logging
-from typing import Optional, Dict, Any, List
-from datetime import datetime, timedelta
+import time
+from typing import Optional, Dict, Any, List, Tuple, AsyncIterator
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
 import json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logger = logging.getLogger(__name__)
 
+
+def _loads(body: bytes):
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def parse_panel_datetime(value) -> Optional[datetime]:
+    """ISO-время панели (createdAt, updatedAt, expireAt) -> naive UTC datetime."""
+    if not value or not isinstance(value, str):
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+class ApiMetrics:
+    """Счетчики и гистограммы задержек запросов к панели по эндпоинтам.
+
+    Идентификаторы в пути заменяются на {id}, поэтому число ключей не
+    растет с числом пользователей.
+    """
+
+    BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    ID_PARENTS = {'users', 'nodes', 'sub', 'subscription', 'subscriptions', 'internal-squads',
+                  'by-short-uuid', 'by-telegram-id', 'by-username', 'by-email', 'by-tag'}
+    KEYWORDS = {'bulk', 'actions'}
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.endpoints: Dict[str, Dict[str, Any]] = {}
+
+    @classmethod
+    def normalize(cls, method: str, endpoint: str) -> str:
+        segments = endpoint.split('?', 1)[0].strip('/').split('/')
+        normalized = []
+        for i, segment in enumerate(segments):
+            previous = segments[i - 1] if i else None
+            if previous in cls.ID_PARENTS and not segment.startswith('by-') and segment not in cls.KEYWORDS:
+                segment = '{id}'
+            normalized.append(segment)
+        return f"{method.upper()} /{'/'.join(normalized)}"
+
+    def record(self, key: str, duration: float, status: Optional[int] = None, error: Optional[str] = None):
+        stats = self.endpoints.get(key)
+        if stats is None:
+            stats = self.endpoints[key] = {
+                'count': 0,
+                'errors': 0,
+                'total_time': 0.0,
+                'max_time': 0.0,
+                'buckets': [0] * (len(self.BUCKETS) + 1),
+                'statuses': {}
+            }
+
+        stats['count'] += 1
+        stats['total_time'] += duration
+        stats['max_time'] = max(stats['max_time'], duration)
+
+        for index, bound in enumerate(self.BUCKETS):
+            if duration <= bound:
+                stats['buckets'][index] += 1
+                break
+        else:
+            stats['buckets'][-1] += 1
+
+        reason = str(status) if status is not None else error
+        if reason:
+            stats['statuses'][reason] = stats['statuses'].get(reason, 0) + 1
+        if error or (status is not None and status >= 500) or status == 429:
+            stats['errors'] += 1
+
+    @staticmethod
+    def _percentile(stats: Dict[str, Any], fraction: float) -> float:
+        target = stats['count'] * fraction
+        seen = 0
+        for index, count in enumerate(stats['buckets']):
+            seen += count
+            if seen >= target:
+                return ApiMetrics.BUCKETS[index] if index < len(ApiMetrics.BUCKETS) else stats['max_time']
+        return stats['max_time']
+
+    def snapshot(self, sort_by: str = 'total_time') -> List[Dict[str, Any]]:
+        rows = []
+        for key, stats in self.endpoints.items():
+            rows.append({
+                'endpoint': key,
+                'count': stats['count'],
+                'errors': stats['errors'],
+                'total_time': round(stats['total_time'], 3),
+                'avg_time': round(stats['total_time'] / stats['count'], 3) if stats['count'] else 0.0,
+                'p95_time': self._percentile(stats, 0.95),
+                'max_time': round(stats['max_time'], 3),
+                'statuses': dict(stats['statuses'])
+            })
+        return sorted(rows, key=lambda row: row[sort_by], reverse=True)
+
+    def reset(self):
+        self.started_at = time.time()
+        self.endpoints.clear()
+
+
+class CircuitBreaker:
+    """Размыкатель цепи для запросов к панели.
+
+    После failure_threshold ошибок подряд запросы сразу получают отказ на
+    recovery_timeout секунд, затем пропускается один пробный запрос
+    (half-open): успех замыкает цепь, ошибка снова размыкает.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.failure_threshold = max(1, failure_threshold)
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self._probe_in_flight = False
+
+    def allow_request(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.recovery_timeout:
+            logger.info("Circuit breaker half-open: probing RemnaWave API")
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+
+        if self.state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info("Circuit breaker closed: RemnaWave API is responding again")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def release_probe(self):
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_in_flight = False
+
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"Circuit breaker opened after {self.failures} consecutive failures, "
+                               f"failing fast for {self.recovery_timeout}s")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            'state': self.state,
+            'consecutive_failures': self.failures,
+            'rejected': self.rejected
+        }
+
+
 class RemnaWaveAPI:
-    def __init__(self, base_url: str, token: str, subscription_base_url: str = None):
+    RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+    # PATCH у панели - частичное обновление, повтор после таймаута может применить его дважды
+    IDEMPOTENT_METHODS = {'GET', 'DELETE', 'PUT'}
+    BULK_CHUNK_SIZE = 500
+    UPDATED_DESC_SORTING = json.dumps([{'id': 'updatedAt', 'desc': True}])
+
+    SUBSCRIPTION_ENDPOINTS = [
+        '/api/subscriptions/{short_uuid}',
+        '/api/sub/{short_uuid}',
+        '/api/subscription/{short_uuid}'
+    ]
+
+    def __init__(self, base_url: str, token: str, subscription_base_url: str = None,
+                 subscription_url_ttl: int = 3600, subscription_url_cache_size: int = 10000,
+                 bulk_concurrency: int = 10, max_retries: int = 3,
+                 pool_size: int = 100, pool_per_host: int = 30, keepalive_timeout: float = 30.0,
+                 dns_cache_ttl: int = 300, connect_timeout: float = 5.0, read_timeout: float = 25.0,
+                 total_timeout: float = 30.0, breaker_threshold: int = 5, breaker_recovery: float = 30.0):
         self.base_url = base_url.rstrip('/')
         self.token = token
         self.subscription_base_url = subscription_base_url 
         self.session = None
+        self.subscription_url_ttl = subscription_url_ttl
+        self.subscription_url_cache_size = max(1, subscription_url_cache_size)
+        self._subscription_urls: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._subscription_endpoint: Optional[str] = None
+        self.bulk_concurrency = max(1, bulk_concurrency)
+        self.max_retries = max(0, max_retries)
+        self._native_bulk_supported: Dict[str, bool] = {}
+        self._updated_sorting_supported: Optional[bool] = None
+        self.pool_size = pool_size
+        self.pool_per_host = pool_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = aiohttp.ClientTimeout(
+            total=total_timeout,
+            connect=connect_timeout,
+            sock_read=read_timeout
+        )
+        self.metrics = ApiMetrics()
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_recovery)
+        self._inflight: Dict[Tuple, asyncio.Task] = {}
+        self.coalesced_requests = 0
         
     async def _get_session(self):
         if self.session is None or self.session.closed:
@@ -23,10 +241,16 @@ class RemnaWaveAPI:
                 'X-Forwarded-Proto': 'https',  # ← ДОБАВЬ ЭТО
                 'X-Forwarded-For': '127.0.0.1'  # ← И ЭТО
             }
-            timeout = aiohttp.ClientTimeout(total=30)
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.pool_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl
+            )
             self.session = aiohttp.ClientSession(
                 headers=headers,
-                timeout=timeout
+                timeout=self.timeout,
+                connector=connector
             )
         return self.session
     
@@ -34,47 +258,164 @@ class RemnaWaveAPI:
         if self.session and not self.session.closed:
             await self.session.close()
     
-    async def _make_request(self, method: str, endpoint: str, data: Optional[Dict] = None, params: Optional[Dict] = None) -> Optional[Dict]:
+    def get_metrics(self, limit: Optional[int] = None) -> Dict[str, Any]:
+        endpoints = self.metrics.snapshot()
+        return {
+            'since': datetime.fromtimestamp(self.metrics.started_at),
+            'requests': sum(row['count'] for row in endpoints),
+            'errors': sum(row['errors'] for row in endpoints),
+            'total_time': round(sum(row['total_time'] for row in endpoints), 3),
+            'coalesced': self.coalesced_requests,
+            'breaker': self.breaker.get_status(),
+            'endpoints': endpoints[:limit] if limit else endpoints
+        }
+    
+    def _get_cached_subscription_url(self, short_uuid: str) -> Optional[str]:
+        entry = self._subscription_urls.get(short_uuid)
+        if not entry:
+            return None
+        expires_at, url = entry
+        if expires_at < time.monotonic():
+            self._subscription_urls.pop(short_uuid, None)
+            return None
+        self._subscription_urls.move_to_end(short_uuid)
+        return url
+    
+    def _cache_subscription_url(self, short_uuid: str, url: str):
+        if short_uuid and url and self.subscription_url_ttl > 0:
+            self._subscription_urls[short_uuid] = (time.monotonic() + self.subscription_url_ttl, url)
+            self._subscription_urls.move_to_end(short_uuid)
+            while len(self._subscription_urls) > self.subscription_url_cache_size:
+                self._subscription_urls.popitem(last=False)
+    
+    def invalidate_subscription_url(self, short_uuid: str):
+        self._subscription_urls.pop(short_uuid, None)
+    
+    async def _enrich_with_subscription_url(self, user_data: Optional[Dict]) -> Optional[Dict]:
+        """Дополняет данные пользователя subscriptionUrl.
+
+        Если панель уже вернула ссылку, она только кэшируется; отдельный запрос
+        делается лишь когда ссылки в ответе нет.
+        """
+        if not isinstance(user_data, dict) or not user_data.get('shortUuid'):
+            return user_data
+        
+        short_uuid = user_data['shortUuid']
+        if user_data.get('subscriptionUrl'):
+            self._cache_subscription_url(short_uuid, user_data['subscriptionUrl'])
+            return user_data
+        
+        try:
+            user_data['subscriptionUrl'] = await self.get_subscription_url(short_uuid, user_data=user_data)
+        except Exception as e:
+            logger.warning(f"Could not get subscription URL for user {user_data.get('username', 'unknown')}: {e}")
+        return user_data
+    
+    @staticmethod
+    def _retry_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+        if retry_after:
+            try:
+                return min(float(retry_after), 60.0)
+            except ValueError:
+                pass
+        return min(0.5 * (2 ** attempt), 30.0)
+
+    async def _make_request(self, method: str, endpoint: str, data: Optional[Dict] = None, params: Optional[Dict] = None,
+                            retries: Optional[int] = None) -> Optional[Dict]:
         if not endpoint.startswith('/api/'):
             endpoint = '/api' + endpoint
-            
+        
+        if method.upper() != 'GET' or data is not None:
+            return await self._send_request(method, endpoint, data, params, retries)
+        
+        # Одинаковые одновременные GET делят один запрос к панели
+        key = (endpoint, tuple(sorted((params or {}).items())), retries)
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced_requests += 1
+        else:
+            task = asyncio.ensure_future(self._send_request(method, endpoint, data, params, retries))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        
+        # Каждый вызывающий, включая первого, получает свою копию: обработчики
+        # дописывают поля в ответ, а общий результат должен остаться нетронутым
+        return copy.deepcopy(await asyncio.shield(task))
+
+    async def _send_request(self, method: str, endpoint: str, data: Optional[Dict] = None, params: Optional[Dict] = None,
+                            retries: Optional[int] = None) -> Optional[Dict]:
         url = f"{self.base_url}{endpoint}"
-        session = await self._get_session()
         
-        try:
-            logger.debug(f"Making {method} request to {url}")
-            async with session.request(method, url, json=data, params=params) as response:
-                content_type = response.headers.get('Content-Type', '')
-                logger.debug(f"Response Content-Type: {content_type}, Status: {response.status}")
-                
-                response_text = await response.text()
-                
-                if 'text/html' in content_type:
-                    logger.error(f"Got HTML response instead of JSON from {url}")
-                    logger.debug(f"HTML Response (first 500 chars): {response_text[:500]}")
-                    return None
-                
-                if response.status in [200, 201, 204]:
-                    if response_text:
-                        try:
-                            return await response.json()
-                        except json.JSONDecodeError as e:
-                            logger.error(f"Failed to decode JSON from {url}: {e}")
-                            logger.debug(f"Raw response: {response_text[:500]}")
-                            return None
-                    return {'success': True}  # Для статуса 204 (No Content)
-                elif response.status == 404:
-                    logger.warning(f"API 404 for {endpoint}")
-                    return None
-                else:
-                    logger.error(f"API error: {response.status}, {response_text[:200]}")
+        # По умолчанию идемпотентные запросы повторяем при любом сбое, остальные -
+        # только если соединение не установилось и запрос точно не ушел
+        idempotent = method.upper() in self.IDEMPOTENT_METHODS
+        if retries is None:
+            retries = self.max_retries
+        else:
+            idempotent = True
+        
+        metrics_key = ApiMetrics.normalize(method, endpoint)
+        
+        for attempt in range(retries + 1):
+            if not self.breaker.allow_request():
+                logger.warning(f"Circuit breaker open, skipping {method} {endpoint}")
+                return None
+            
+            retry_after = None
+            session = await self._get_session()
+            started = time.perf_counter()
+            
+            try:
+                logger.debug(f"Making {method} request to {url}")
+                async with session.request(method, url, json=data, params=params) as response:
+                    content_type = response.headers.get('Content-Type', '')
+                    logger.debug(f"Response Content-Type: {content_type}, Status: {response.status}")
+                    
+                    # Тело читается один раз и разбирается без промежуточной строки
+                    body = await response.read()
+                    self.metrics.record(metrics_key, time.perf_counter() - started, status=response.status)
+                    
+                    if response.status >= 500 or response.status == 429:
+                        self.breaker.record_failure()
+                    else:
+                        self.breaker.record_success()
+                    
+                    if response.status in self.RETRYABLE_STATUSES and attempt < retries and idempotent:
+                        retry_after = response.headers.get('Retry-After')
+                        logger.warning(f"API {response.status} for {endpoint}, retry {attempt + 1}/{retries}")
+                    elif 'text/html' in content_type:
+                        logger.error(f"Got HTML response instead of JSON from {url}")
+                        logger.debug(f"HTML Response (first 500 chars): {body[:500].decode(errors='replace')}")
+                        return None
+                    elif response.status in [200, 201, 204]:
+                        if body:
+                            try:
+                                return _loads(body)
+                            except ValueError as e:
+                                logger.error(f"Failed to decode JSON from {url}: {e}")
+                                logger.debug(f"Raw response: {body[:500].decode(errors='replace')}")
+                                return None
+                        return {'success': True}  # Для статуса 204 (No Content)
+                    elif response.status == 404:
+                        logger.warning(f"API 404 for {endpoint}")
+                        return None
+                    else:
+                        logger.error(f"API error: {response.status}, {body[:200].decode(errors='replace')}")
+                        return None
+            except asyncio.CancelledError:
+                self.breaker.release_probe()
+                raise
+            except Exception as e:
+                self.metrics.record(metrics_key, time.perf_counter() - started, error=type(e).__name__)
+                self.breaker.record_failure()
+                if attempt >= retries or not (idempotent or isinstance(e, aiohttp.ClientConnectorError)):
+                    logger.error(f"Request error for {endpoint}: {e}")
                     return None
-        except aiohttp.ContentTypeError as e:
-            logger.error(f"Content type error for {endpoint}: {e}")
-            return None
-        except Exception as e:
-            logger.error(f"Request error for {endpoint}: {e}")
-            return None
+                logger.warning(f"Request error for {endpoint}: {e}, retry {attempt + 1}/{retries}")
+            
+            await asyncio.sleep(self._retry_delay(attempt, retry_after))
+        
+        return None
 
     async def delete_user(self, uuid: str) -> Optional[Dict]:
         """
@@ -103,7 +444,7 @@ class RemnaWaveAPI:
             logger.info(f"Deleting user by short UUID: {short_uuid}")
             
             # Сначала получаем полную информацию о пользователе
-            user_data = await self.get_user_by_short_uuid(short_uuid)
+            user_data = await self._fetch_user_by_short_uuid(short_uuid)
             
             if not user_data:
                 logger.warning(f"User with short_uuid {short_uuid} not found")
@@ -118,6 +459,7 @@ class RemnaWaveAPI:
             result = await self.delete_user(full_uuid)
             
             if result:
+                self.invalidate_subscription_url(short_uuid)
                 logger.info(f"Successfully deleted user {short_uuid} (UUID: {full_uuid})")
                 return {
                     'success': True,
@@ -133,6 +475,75 @@ class RemnaWaveAPI:
             logger.error(f"Error deleting user by short UUID {short_uuid}: {e}")
             return None
 
+    async def run_bulk(self, items: List[Any], operation, concurrency: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Выполняет operation(item) для каждого элемента, не больше concurrency
+        запросов одновременно. Повторы на 429/5xx делает сам _make_request.
+        Успехом считается любой непустой результат операции.
+        """
+        semaphore = asyncio.Semaphore(concurrency or self.bulk_concurrency)
+        
+        async def run_one(item) -> Dict[str, Any]:
+            async with semaphore:
+                try:
+                    result = await operation(item)
+                    return {'item': item, 'success': bool(result), 'result': result, 'error': None}
+                except Exception as e:
+                    logger.error(f"Bulk operation failed for {item}: {e}")
+                    return {'item': item, 'success': False, 'result': None, 'error': str(e)}
+        
+        results = await asyncio.gather(*(run_one(item) for item in items))
+        success = sum(1 for r in results if r['success'])
+        
+        return {
+            'total': len(items),
+            'success': success,
+            'failed': len(items) - success,
+            'results': list(results)
+        }
+
+    async def _run_native_bulk(self, name: str, uuids: List[str], native_call, fallback_operation) -> Dict[str, Any]:
+        """
+        Отправляет uuids пачками в bulk-эндпоинт панели. Если эндпоинт не
+        отвечает, пачка выполняется поштучно через run_bulk; если он ни разу
+        не сработал, дальше сразу используется поштучный режим.
+        """
+        results = []
+        
+        for i in range(0, len(uuids), self.BULK_CHUNK_SIZE):
+            chunk = uuids[i:i + self.BULK_CHUNK_SIZE]
+            
+            native_result = None
+            if self._native_bulk_supported.get(name, True):
+                native_result = await native_call(chunk)
+                if native_result:
+                    self._native_bulk_supported[name] = True
+                elif name not in self._native_bulk_supported:
+                    logger.warning(f"Native bulk endpoint '{name}' unavailable, falling back to per-user requests")
+                    self._native_bulk_supported[name] = False
+            
+            if native_result:
+                results.extend({'item': uuid, 'success': True, 'result': native_result, 'error': None} for uuid in chunk)
+            else:
+                fallback = await self.run_bulk(chunk, fallback_operation)
+                results.extend(fallback['results'])
+        
+        success = sum(1 for r in results if r['success'])
+        return {
+            'total': len(uuids),
+            'success': success,
+            'failed': len(uuids) - success,
+            'results': results
+        }
+
+    async def resolve_users_by_short_uuids(self, short_uuids: List[str]) -> Dict[str, Dict]:
+        """short_uuid -> данные пользователя панели (ненайденные пропускаются)"""
+        resolved = await self.run_bulk(list(dict.fromkeys(short_uuids)), self._fetch_user_by_short_uuid)
+        return {
+            r['item']: r['result'] for r in resolved['results']
+            if r['success'] and isinstance(r['result'], dict) and r['result'].get('uuid')
+        }
+
     async def bulk_delete_users_by_short_uuids(self, short_uuids: List[str]) -> Dict[str, Any]:
         """
         Массовое удаление пользователей по списку short_uuid
@@ -145,33 +556,43 @@ class RemnaWaveAPI:
                 'success': 0,
                 'failed': 0,
                 'errors': [],
-                'deleted_users': []
+                'deleted_users': [],
+                'results': {}
             }
             
+            users = await self.resolve_users_by_short_uuids(short_uuids)
+            
             for short_uuid in short_uuids:
-                try:
-                    result = await self.delete_user_by_short_uuid(short_uuid)
-                    
-                    if result and result.get('success'):
-                        results['success'] += 1
-                        results['deleted_users'].append({
-                            'short_uuid': short_uuid,
-                            'full_uuid': result.get('full_uuid'),
-                            'username': result.get('username')
-                        })
-                        logger.debug(f"Successfully deleted user {short_uuid}")
-                    else:
-                        results['failed'] += 1
-                        results['errors'].append(f"Failed to delete {short_uuid}")
-                        logger.warning(f"Failed to delete user {short_uuid}")
-                    
-                    # Небольшая пауза между запросами, чтобы не перегружать API
-                    await asyncio.sleep(0.1)
-                    
-                except Exception as e:
+                if short_uuid not in users:
                     results['failed'] += 1
-                    results['errors'].append(f"Error deleting {short_uuid}: {str(e)}")
-                    logger.error(f"Error deleting user {short_uuid}: {e}")
+                    results['errors'].append(f"Failed to delete {short_uuid}")
+                    results['results'][short_uuid] = False
+                    logger.warning(f"User with short_uuid {short_uuid} not found")
+            
+            uuid_to_short = {user['uuid']: short_uuid for short_uuid, user in users.items()}
+            deleted = await self._run_native_bulk(
+                'delete',
+                list(uuid_to_short),
+                lambda chunk: self.bulk_delete_users(chunk),
+                self.delete_user
+            )
+            
+            for item in deleted['results']:
+                short_uuid = uuid_to_short[item['item']]
+                results['results'][short_uuid] = item['success']
+                
+                if item['success']:
+                    self.invalidate_subscription_url(short_uuid)
+                    results['success'] += 1
+                    results['deleted_users'].append({
+                        'short_uuid': short_uuid,
+                        'full_uuid': item['item'],
+                        'username': users[short_uuid].get('username', 'unknown')
+                    })
+                else:
+                    results['failed'] += 1
+                    results['errors'].append(f"Failed to delete {short_uuid}" +
+                                             (f": {item['error']}" if item['error'] else ""))
             
             logger.info(f"Bulk deletion completed: {results['success']} success, {results['failed']} failed")
             return results
@@ -183,7 +604,46 @@ class RemnaWaveAPI:
                 'success': 0,
                 'failed': len(short_uuids),
                 'errors': [f"Critical error: {str(e)}"],
-                'deleted_users': []
+                'deleted_users': [],
+                'results': {short_uuid: False for short_uuid in short_uuids}
+            }
+
+    async def bulk_update_users_by_short_uuids(self, short_uuids: List[str], fields: Dict) -> Dict[str, Any]:
+        """
+        Массовое изменение полей (например, status) по списку short_uuid.
+        Возвращает {'total', 'success', 'failed', 'results': {short_uuid: bool}}
+        """
+        try:
+            users = await self.resolve_users_by_short_uuids(short_uuids)
+            uuid_to_short = {user['uuid']: short_uuid for short_uuid, user in users.items()}
+            
+            updated = await self._run_native_bulk(
+                'update',
+                list(uuid_to_short),
+                lambda chunk: self.bulk_update_users(chunk, fields),
+                lambda uuid: self.update_user(uuid, fields)
+            )
+            
+            per_item = {short_uuid: False for short_uuid in short_uuids}
+            for item in updated['results']:
+                per_item[uuid_to_short[item['item']]] = item['success']
+            
+            success = sum(1 for ok in per_item.values() if ok)
+            logger.info(f"Bulk update completed: {success} success, {len(per_item) - success} failed")
+            return {
+                'total': len(per_item),
+                'success': success,
+                'failed': len(per_item) - success,
+                'results': per_item
+            }
+            
+        except Exception as e:
+            logger.error(f"Error in bulk_update_users_by_short_uuids: {e}")
+            return {
+                'total': len(short_uuids),
+                'success': 0,
+                'failed': len(short_uuids),
+                'results': {short_uuid: False for short_uuid in short_uuids}
             }
 
     async def create_user(self, username: str, password: str = None, 
@@ -257,15 +717,7 @@ class RemnaWaveAPI:
             if user_data.get('telegramId') == telegram_id:
                 logger.info(f"Found user: {user_data.get('username')} for Telegram ID {telegram_id}")
                 
-                if user_data.get('shortUuid') and 'subscriptionUrl' not in user_data:
-                    try:
-                        subscription_url = await self.get_subscription_url(user_data['shortUuid'])
-                        user_data['subscriptionUrl'] = subscription_url
-                        logger.debug(f"Added subscription URL to user data: {subscription_url}")
-                    except Exception as e:
-                        logger.warning(f"Could not get subscription URL for user: {e}")
-                
-                return user_data
+                return await self._enrich_with_subscription_url(user_data)
             else:
                 logger.warning(f"Telegram ID mismatch: expected {telegram_id}, got {user_data.get('telegramId')}")
     
@@ -285,49 +737,48 @@ class RemnaWaveAPI:
             else:
                 user_data = result
                 
-            if user_data and user_data.get('shortUuid') and 'subscriptionUrl' not in user_data:
-                try:
-                    subscription_url = await self.get_subscription_url(user_data['shortUuid'])
-                    user_data['subscriptionUrl'] = subscription_url
-                except Exception as e:
-                    logger.warning(f"Could not get subscription URL for user: {e}")
-                    
-            return user_data
+            return await self._enrich_with_subscription_url(user_data)
+        return None
+
+    @staticmethod
+    def _extract_subscription_data(result: Dict) -> Optional[Dict]:
+        if 'response' in result:
+            subscription_data = result['response']
+        elif 'data' in result:
+            subscription_data = result['data']
+        elif 'subscription' in result:
+            subscription_data = result['subscription']
+        else:
+            subscription_data = result
+        
+        if isinstance(subscription_data, dict) and (
+            'subscriptionUrl' in subscription_data or 
+            'url' in subscription_data or 
+            'link' in subscription_data
+        ):
+            return subscription_data
         return None
 
     async def get_subscription_info(self, short_uuid: str) -> Optional[Dict]:
         try:
-            logger.info(f"Getting subscription info for short_uuid: {short_uuid}")
+            logger.debug(f"Getting subscription info for short_uuid: {short_uuid}")
             
-            endpoints_to_try = [
-                f'/api/subscriptions/{short_uuid}',
-                f'/api/sub/{short_uuid}',
-                f'/api/subscription/{short_uuid}'
-            ]
+            # После первого успешного ответа опрашиваем только рабочий эндпоинт
+            if self._subscription_endpoint:
+                endpoints_to_try = [self._subscription_endpoint]
+            else:
+                endpoints_to_try = self.SUBSCRIPTION_ENDPOINTS
             
             for endpoint in endpoints_to_try:
                 logger.debug(f"Trying endpoint: {endpoint}")
-                result = await self._make_request('GET', endpoint)
+                result = await self._make_request('GET', endpoint.format(short_uuid=short_uuid))
                 
                 if result:
-                    logger.info(f"Successfully got subscription info from {endpoint}")
-                    
-                    subscription_data = None
-                    
-                    if 'response' in result:
-                        subscription_data = result['response']
-                    elif 'data' in result:
-                        subscription_data = result['data']
-                    elif 'subscription' in result:
-                        subscription_data = result['subscription']
-                    else:
-                        subscription_data = result
-                    
-                    if subscription_data and (
-                        'subscriptionUrl' in subscription_data or 
-                        'url' in subscription_data or 
-                        'link' in subscription_data
-                    ):
+                    subscription_data = self._extract_subscription_data(result)
+                    if subscription_data:
+                        if self._subscription_endpoint != endpoint:
+                            logger.info(f"Subscription info endpoint discovered: {endpoint}")
+                            self._subscription_endpoint = endpoint
                         return subscription_data
             
             logger.warning(f"Could not get subscription info for {short_uuid} from any endpoint")
@@ -337,9 +788,26 @@ class RemnaWaveAPI:
             logger.error(f"Error getting subscription info for {short_uuid}: {e}")
             return None
 
-    async def get_subscription_url(self, short_uuid: str) -> str:
+    async def get_subscription_url(self, short_uuid: str, user_data: Optional[Dict] = None) -> str:
+        cached_url = self._get_cached_subscription_url(short_uuid)
+        if cached_url:
+            return cached_url
+        
+        subscription_url, from_panel = await self._resolve_subscription_url(short_uuid, user_data)
+        # Запасную ссылку не кэшируем: после сбоя панели ее надо спросить снова
+        if from_panel:
+            self._cache_subscription_url(short_uuid, subscription_url)
+        return subscription_url
+
+    async def get_subscription_urls(self, short_uuids: List[str]) -> Dict[str, str]:
+        """short_uuid -> ссылка подписки; ссылки разрешаются параллельно, неполученные пропускаются"""
+        resolved = await self.run_bulk(list(dict.fromkeys(u for u in short_uuids if u)), self.get_subscription_url)
+        return {r['item']: r['result'] for r in resolved['results'] if r['success']}
+
+    async def _resolve_subscription_url(self, short_uuid: str, user_data: Optional[Dict] = None) -> Tuple[str, bool]:
+        """(ссылка, получена ли она от панели); при неудаче - запасная ссылка и False"""
         try:
-            logger.info(f"Getting subscription URL for short_uuid: {short_uuid}")
+            logger.debug(f"Resolving subscription URL for short_uuid: {short_uuid}")
             
             subscription_info = await self.get_subscription_info(short_uuid)
             
@@ -352,51 +820,46 @@ class RemnaWaveAPI:
                 )
                 
                 if subscription_url:
-                    logger.info(f"Got subscription URL from API: {subscription_url}")
-                    return subscription_url
+                    logger.debug(f"Got subscription URL from API: {subscription_url}")
+                    return subscription_url, True
             
-            user_data = await self.get_user_by_short_uuid(short_uuid)
-            if user_data and 'subscriptionUrl' in user_data:
-                logger.info(f"Got subscription URL from user data: {user_data['subscriptionUrl']}")
-                return user_data['subscriptionUrl']
+            # Данные пользователя запрашиваем без обогащения, чтобы не уйти в рекурсию
+            if user_data is None:
+                user_data = await self._fetch_user_by_short_uuid(short_uuid)
+            if user_data and user_data.get('subscriptionUrl'):
+                logger.debug(f"Got subscription URL from user data: {user_data['subscriptionUrl']}")
+                return user_data['subscriptionUrl'], True
             
             if self.subscription_base_url:
                 fallback_url = f"{self.subscription_base_url.rstrip('/')}/sub/{short_uuid}"
                 logger.warning(f"Using fallback URL: {fallback_url}")
-                return fallback_url
+                return fallback_url, False
             else:
                 fallback_url = f"{self.base_url.rstrip('/')}/sub/{short_uuid}"
                 logger.warning(f"Using base_url fallback: {fallback_url}")
-                return fallback_url
+                return fallback_url, False
                 
         except Exception as e:
             logger.error(f"Failed to get subscription URL for {short_uuid}: {e}")
             fallback_url = f"{self.base_url.rstrip('/')}/sub/{short_uuid}"
-            return fallback_url
+            return fallback_url, False
 
-    async def get_user_by_short_uuid(self, short_uuid: str) -> Optional[Dict]:
-        logger.debug(f"Getting user by short UUID: {short_uuid}")
+    async def _fetch_user_by_short_uuid(self, short_uuid: str) -> Optional[Dict]:
         result = await self._make_request('GET', f'/api/users/by-short-uuid/{short_uuid}')
         
         if result:
-            user_data = None
             if 'response' in result:
-                user_data = result['response']
+                return result['response']
             elif 'data' in result:
-                user_data = result['data']
-            else:
-                user_data = result
-                
-            if user_data and 'subscriptionUrl' not in user_data:
-                try:
-                    subscription_url = await self.get_subscription_url(short_uuid)
-                    user_data['subscriptionUrl'] = subscription_url
-                except Exception as e:
-                    logger.warning(f"Could not get subscription URL: {e}")
-                    
-            return user_data
+                return result['data']
+            return result
         return None
 
+    async def get_user_by_short_uuid(self, short_uuid: str) -> Optional[Dict]:
+        logger.debug(f"Getting user by short UUID: {short_uuid}")
+        user_data = await self._fetch_user_by_short_uuid(short_uuid)
+        return await self._enrich_with_subscription_url(user_data)
+
     async def get_all_subscriptions_with_urls(self) -> Optional[List]:
         try:
             logger.info("Fetching all subscriptions with URLs from API")
@@ -422,8 +885,11 @@ class RemnaWaveAPI:
                 if subscription.get('isFound') and 'user' in subscription:
                     user_data = subscription['user']
                     
-                    if 'subscriptionUrl' not in subscription and user_data.get('shortUuid'):
-                        subscription['subscriptionUrl'] = await self.get_subscription_url(user_data['shortUuid'])
+                    if user_data.get('shortUuid'):
+                        if subscription.get('subscriptionUrl'):
+                            self._cache_subscription_url(user_data['shortUuid'], subscription['subscriptionUrl'])
+                        else:
+                            subscription['subscriptionUrl'] = await self.get_subscription_url(user_data['shortUuid'])
                     
                     processed_subscriptions.append(subscription)
             
@@ -772,84 +1238,161 @@ class RemnaWaveAPI:
             logger.error(f"Error getting detailed node info: {e}")
             return None
 
-    async def get_all_system_users_full(self) -> Optional[List]:
+    @staticmethod
+    def _parse_users_page(result) -> Tuple[List[Dict], Optional[int]]:
+        batch_users = []
+        total_count = None
+        
+        if isinstance(result, dict):
+            if 'total' in result:
+                total_count = result['total']
+            
+            if 'users' in result:
+                batch_users = result['users'] if isinstance(result['users'], list) else []
+            elif 'data' in result:
+                batch_users = result['data'] if isinstance(result['data'], list) else []
+            elif 'response' in result:
+                if isinstance(result['response'], dict):
+                    if total_count is None and 'total' in result['response']:
+                        total_count = result['response']['total']
+                    if 'users' in result['response']:
+                        batch_users = result['response']['users'] if isinstance(result['response']['users'], list) else []
+                    elif 'data' in result['response']:
+                        batch_users = result['response']['data'] if isinstance(result['response']['data'], list) else []
+                elif isinstance(result['response'], list):
+                    batch_users = result['response']
+            elif 'items' in result:
+                batch_users = result['items'] if isinstance(result['items'], list) else []
+        elif isinstance(result, list):
+            batch_users = result
+        
         try:
-            all_users = []
-            offset = 0
-            limit = 100
+            total_count = int(total_count) if total_count is not None else None
+        except (TypeError, ValueError):
+            total_count = None
         
-            logger.info("Starting to fetch all system users with URLs")
+        return batch_users, total_count
+
+    async def get_system_users_page(self, offset: int = 0, limit: int = 100,
+                                    newest_updated_first: bool = False) -> Tuple[List[Dict], Optional[int]]:
+        """Одна страница /api/users: (пользователи, total из ответа панели)"""
+        params = {'offset': offset, 'limit': limit}
+        if newest_updated_first:
+            params['sorting'] = self.UPDATED_DESC_SORTING
+        result = await self._make_request('GET', '/api/users', params=params)
+        if not result:
+            return [], None
+        return self._parse_users_page(result)
+
+    async def iter_system_users(self, page_size: int = 100, concurrency: int = 4,
+                                with_urls: bool = True) -> AsyncIterator[Dict]:
+        """Потоково отдает всех пользователей панели в порядке страниц.
+
+        Первая страница запрашивается отдельно; если в ответе есть total,
+        остальные страницы загружаются параллельно окном из concurrency
+        запросов. Без total страницы идут последовательно до неполной.
+        """
+        users, total_count = await self.get_system_users_page(0, page_size)
+        if not users:
+            return
+        
+        async def load_page(offset: int) -> List[Dict]:
+            batch, _ = await self.get_system_users_page(offset, page_size)
+            if with_urls:
+                for user in batch:
+                    await self._enrich_with_subscription_url(user)
+            return batch
+        
+        if with_urls:
+            for user in users:
+                await self._enrich_with_subscription_url(user)
+        for user in users:
+            yield user
+        
+        if len(users) < page_size:
+            return
         
+        if total_count is None:
+            offset = page_size
             while True:
-                logger.debug(f"Fetching users batch: offset={offset}, limit={limit}")
-                result = await self._make_request('GET', '/api/users', 
-                                                params={'offset': offset, 'limit': limit})
-            
-                if not result:
-                    logger.warning(f"Empty result at offset {offset}")
-                    break
-            
-                logger.debug(f"Raw API response structure: {list(result.keys()) if isinstance(result, dict) else 'not dict'}")
-            
-                batch_users = []
-                total_count = None
+                batch = await load_page(offset)
+                for user in batch:
+                    yield user
+                if len(batch) < page_size:
+                    return
+                offset += page_size
+        
+        offsets = list(range(page_size, total_count, page_size))
+        window = deque()
+        try:
+            for offset in offsets[:max(1, concurrency)]:
+                window.append(asyncio.create_task(load_page(offset)))
+            next_index = len(window)
             
-                if isinstance(result, dict):
-                    if 'total' in result:
-                        total_count = result['total']
-                        logger.info(f"Total users in system: {total_count}")
+            while window:
+                batch = await window.popleft()
+                if next_index < len(offsets):
+                    window.append(asyncio.create_task(load_page(offsets[next_index])))
+                    next_index += 1
                 
-                    if 'users' in result:
-                        batch_users = result['users'] if isinstance(result['users'], list) else []
-                    elif 'data' in result:
-                        batch_users = result['data'] if isinstance(result['data'], list) else []
-                    elif 'response' in result:
-                        if isinstance(result['response'], dict):
-                            if 'users' in result['response']:
-                                batch_users = result['response']['users'] if isinstance(result['response']['users'], list) else []
-                            elif 'data' in result['response']:
-                                batch_users = result['response']['data'] if isinstance(result['response']['data'], list) else []
-                        elif isinstance(result['response'], list):
-                            batch_users = result['response']
-                    elif 'items' in result:
-                        batch_users = result['items'] if isinstance(result['items'], list) else []
-                elif isinstance(result, list):
-                    batch_users = result
-            
-                logger.info(f"Found {len(batch_users)} users in batch at offset {offset}")
-            
-                if not batch_users:
-                    logger.info(f"No users in batch at offset {offset}, stopping")
-                    break
+                if not batch:
+                    logger.warning("Empty users page before reaching total, stopping")
+                    return
+                for user in batch:
+                    yield user
+        finally:
+            for task in window:
+                task.cancel()
+
+    async def iter_users_updated_since(self, since: Optional[datetime], page_size: int = 100) -> AsyncIterator[Dict]:
+        """Пользователи панели, измененные позже since (без since - все).
+
+        Страницы запрашиваются отсортированными по updatedAt, новые первыми, и
+        обход останавливается на первой записи не новее since. Если панель
+        сортировку игнорирует (первая страница не упорядочена), просматриваются
+        все страницы с фильтрацией на стороне бота; это запоминается до рестарта.
+        """
+        if since is None:
+            async for user in self.iter_system_users(page_size, with_urls=False):
+                yield user
+            return
+        
+        if self._updated_sorting_supported is not False:
+            offset = 0
+            while True:
+                users, _ = await self.get_system_users_page(offset, page_size, newest_updated_first=True)
+                if not users:
+                    return
                 
-                enriched_users = []
-                for user in batch_users:
-                    try:
-                        if user.get('shortUuid') and 'subscriptionUrl' not in user:
-                            subscription_url = await self.get_subscription_url(user['shortUuid'])
-                            user['subscriptionUrl'] = subscription_url
-                            logger.debug(f"Added subscription URL for user {user.get('username', 'unknown')}")
-                        
-                        enriched_users.append(user)
-                    except Exception as e:
-                        logger.warning(f"Could not enrich user {user.get('username', 'unknown')} with URL: {e}")
-                        enriched_users.append(user)
+                stamps = [parse_panel_datetime(user.get('updatedAt')) for user in users]
+                if self._updated_sorting_supported is None:
+                    known = [stamp for stamp in stamps if stamp is not None]
+                    if len(known) != len(stamps) or any(a < b for a, b in zip(known, known[1:])):
+                        logger.info("Panel does not sort users by updatedAt, delta sync will scan all pages")
+                        self._updated_sorting_supported = False
+                        break
+                    if len(set(known)) > 1:
+                        self._updated_sorting_supported = True
                 
-                all_users.extend(enriched_users)
-            
-                if len(batch_users) < limit:
-                    logger.info(f"Last batch (got {len(batch_users)} < {limit})")
-                    break
-            
-                if total_count and len(all_users) >= total_count:
-                    logger.info(f"Reached total count: {total_count}")
-                    break
-            
-                offset += limit
+                for user, stamp in zip(users, stamps):
+                    if stamp is not None and stamp <= since:
+                        return
+                    yield user
+                
+                if len(users) < page_size:
+                    return
+                offset += page_size
+        
+        async for user in self.iter_system_users(page_size, with_urls=False):
+            stamp = parse_panel_datetime(user.get('updatedAt'))
+            if stamp is None or stamp > since:
+                yield user
+
+    async def get_all_system_users_full(self) -> Optional[List]:
+        try:
+            logger.info("Starting to fetch all system users with URLs")
             
-                if offset > 10000:
-                    logger.warning("Offset limit reached, stopping")
-                    break
+            all_users = [user async for user in self.iter_system_users()]
         
             if all_users:
                 active_users = len([u for u in all_users if str(u.get('status', '')).upper() == 'ACTIVE'])
@@ -891,8 +1434,10 @@ class RemnaWaveAPI:
                 elif 'count' in result:
                     return result['count']
         
-            all_users = await self.get_all_system_users_full()
-            return len(all_users) if all_users else 0
+            count = 0
+            async for _ in self.iter_system_users(with_urls=False):
+                count += 1
+            return count
         
         except Exception as e:
             logger.error(f"Error getting users count: {e}")
@@ -971,14 +1516,7 @@ class RemnaWaveAPI:
             else:
                 user_data = result
                 
-            if user_data and user_data.get('shortUuid') and 'subscriptionUrl' not in user_data:
-                try:
-                    subscription_url = await self.get_subscription_url(user_data['shortUuid'])
-                    user_data['subscriptionUrl'] = subscription_url
-                except Exception as e:
-                    logger.warning(f"Could not get subscription URL: {e}")
-                    
-            return user_data
+            return await self._enrich_with_subscription_url(user_data)
         return None
     
     async def get_user_by_email(self, email: str) -> Optional[Dict]:
@@ -992,14 +1530,7 @@ class RemnaWaveAPI:
             else:
                 user_data = result
                 
-            if user_data and user_data.get('shortUuid') and 'subscriptionUrl' not in user_data:
-                try:
-                    subscription_url = await self.get_subscription_url(user_data['shortUuid'])
-                    user_data['subscriptionUrl'] = subscription_url
-                except Exception as e:
-                    logger.warning(f"Could not get subscription URL: {e}")
-                    
-            return user_data
+            return await self._enrich_with_subscription_url(user_data)
         return None
     
     async def get_user_by_tag(self, tag: str) -> Optional[Dict]:
@@ -1013,14 +1544,7 @@ class RemnaWaveAPI:
             else:
                 user_data = result
                 
-            if user_data and user_data.get('shortUuid') and 'subscriptionUrl' not in user_data:
-                try:
-                    subscription_url = await self.get_subscription_url(user_data['shortUuid'])
-                    user_data['subscriptionUrl'] = subscription_url
-                except Exception as e:
-                    logger.warning(f"Could not get subscription URL: {e}")
-                    
-            return user_data
+            return await self._enrich_with_subscription_url(user_data)
         return None
 
     async def disable_user(self, uuid: str) -> Optional[Dict]:
@@ -1043,18 +1567,18 @@ class RemnaWaveAPI:
 
     async def bulk_reset_traffic(self, user_uuids: List[str]) -> Optional[Dict]:
         data = {'uuids': user_uuids}
-        return await self._make_request('POST', '/api/users/bulk/reset-traffic', data)
+        return await self._make_request('POST', '/api/users/bulk/reset-traffic', data, retries=self.max_retries)
     
     async def bulk_update_users(self, user_uuids: List[str], fields: Dict) -> Optional[Dict]:
         data = {
             'uuids': user_uuids,
             'fields': fields
         }
-        return await self._make_request('POST', '/api/users/bulk/update', data)
+        return await self._make_request('POST', '/api/users/bulk/update', data, retries=self.max_retries)
     
     async def bulk_delete_users(self, user_uuids: List[str]) -> Optional[Dict]:
         data = {'uuids': user_uuids}
-        return await self._make_request('POST', '/api/users/bulk/delete', data)
+        return await self._make_request('POST', '/api/users/bulk/delete', data, retries=self.max_retries)
     
     async def debug_api_response(self, endpoint: str, method: str = 'GET', data: Optional[Dict] = None) -> Dict:
         try:
@@ -1203,12 +1727,7 @@ class RemnaWaveAPI:
                         'links': subscription.get('links', [])
                     }
                     
-                    if not processed_user.get('subscriptionUrl') and processed_user.get('shortUuid'):
-                        try:
-                            subscription_url = await self.get_subscription_url(processed_user['shortUuid'])
-                            processed_user['subscriptionUrl'] = subscription_url
-                        except Exception as e:
-                            logger.warning(f"Could not get subscription URL for {processed_user.get('username')}: {e}")
+                    await self._enrich_with_subscription_url(processed_user)
                     
                     processed_users.append(processed_user)
             
@@ -1223,7 +1742,7 @@ class RemnaWaveAPI:
         try:
             logger.info("Attempting bulk traffic reset for all users")
             
-            all_users = await self.get_all_system_users_full()
+            all_users = [u async for u in self.iter_system_users(with_urls=False)]
             if not all_users:
                 logger.warning("No users found for bulk traffic reset")
                 return {'success': False, 'message': 'No users found'}
@@ -0,0 +1,221 @@
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from database import Database, AUTOPAY_DAYS_OPTIONS
+
+logger = logging.getLogger(__name__)
+
+
+class DueEventScheduler:
+    """Планировщик событий подписок по точному времени вместо опроса раз в час.
+
+    Событие - момент expires_at минус упреждение потока:
+    warning:<d> - предупреждение за d дней (срабатывает за d + 1 суток),
+    trial - уведомление через TRIAL_NOTIFICATION_HOURS_AFTER часов после
+    окончания триала. Для каждого потока из БД берутся ближайшие batch_size
+    подписок после курсора (expires_at, id), события складываются в кучу,
+    и цикл спит ровно до первого из них.
+
+    Автоплатежи не разбираются поштучно: как только подходит срок
+    ближайшей подписки, запускается обычный прогон AutoPayService. Если
+    после прогона остались подписки без средств, следующий прогон будет
+    через retry_interval.
+
+    Любое изменение user_subscriptions будит планировщик через
+    Database.subscription_listeners, а max_sleep ограничивает сон на случай
+    правок в обход Database. После старта события за последние CATCHUP
+    досылаются: уже отправленное отсеивает журнал notification_log.
+    """
+
+    CATCHUP = timedelta(hours=24)
+
+    def __init__(self, db: Database, config, autopay_service=None, monitor_service=None,
+                 batch_size: int = 200, retry_interval: float = 1800, max_sleep: float = 3600):
+        self.db = db
+        self.config = config
+        self.autopay_service = autopay_service
+        self.monitor_service = monitor_service
+        self.batch_size = max(1, batch_size)
+        self.retry_interval = retry_interval
+        self.max_sleep = max_sleep
+        self.is_running = False
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        # (due_at, stream, user_subscription_id, expires_at)
+        self._heap: List[Tuple[datetime, str, int, datetime]] = []
+        # stream -> (expires_at, id) последнего отработанного события
+        self._cursors: Dict[str, Tuple[datetime, int]] = {}
+        self.last_autopay_run: Optional[datetime] = None
+        self.next_wakeup: Optional[datetime] = None
+        self.fired: Dict[str, int] = {}
+
+    def _streams(self) -> Dict[str, Tuple[timedelta, dict]]:
+        """stream -> (упреждение относительно expires_at, фильтры выборки)."""
+        streams = {}
+        if self.monitor_service:
+            for days_left in range(self.config.MONITOR_WARNING_DAYS + 1):
+                streams[f"warning:{days_left}"] = (
+                    timedelta(days=days_left + 1),
+                    {'is_trial': False, 'is_imported': False}
+                )
+            if getattr(self.config, 'TRIAL_NOTIFICATION_ENABLED', True):
+                streams['trial'] = (
+                    -timedelta(hours=self.config.TRIAL_NOTIFICATION_HOURS_AFTER),
+                    {'is_trial': True}
+                )
+        return streams
+
+    async def start(self):
+        if self.is_running:
+            return
+
+        start_from = datetime.utcnow() - self.CATCHUP
+        self._cursors = {stream: (start_from + lead, 0) for stream, (lead, _) in self._streams().items()}
+        self.is_running = True
+        self.db.subscription_listeners.append(self.wake)
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"⏰ Due-time scheduler started: {len(self._cursors)} event streams"
+                    f"{', autopay' if self.autopay_service else ''}")
+
+    async def stop(self):
+        if not self.is_running:
+            return
+
+        self.is_running = False
+        if self.wake in self.db.subscription_listeners:
+            self.db.subscription_listeners.remove(self.wake)
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def wake(self):
+        """Перечитать расписание: подписка создана, продлена, удалена и т.п."""
+        self._wakeup.set()
+
+    async def _run(self):
+        while self.is_running:
+            try:
+                self._wakeup.clear()
+                next_at = await self._arm()
+
+                now = datetime.utcnow()
+                if next_at <= now:
+                    await self._fire(now)
+                    continue
+
+                self.next_wakeup = next_at
+                timeout = min((next_at - now).total_seconds(), self.max_sleep)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"❌ Error in due-time scheduler: {e}", exc_info=True)
+                await asyncio.sleep(60)
+
+    async def _arm(self) -> datetime:
+        """Заново набирает кучу ближайших событий и возвращает время первого."""
+        heap = []
+        for stream, (lead, filters) in self._streams().items():
+            after, after_id = self._cursors.get(stream, (datetime.utcnow() + lead, 0))
+            for user_sub_id, expires_at in await self.db.get_upcoming_expirations(
+                after, after_id, limit=self.batch_size, **filters
+            ):
+                heap.append((expires_at - lead, stream, user_sub_id, expires_at))
+        heapq.heapify(heap)
+        self._heap = heap
+
+        next_at = datetime.utcnow() + timedelta(seconds=self.max_sleep)
+        if heap:
+            next_at = min(next_at, heap[0][0])
+
+        autopay_at = await self._next_autopay_at()
+        if autopay_at:
+            next_at = min(next_at, autopay_at)
+        return next_at
+
+    async def _next_autopay_at(self) -> Optional[datetime]:
+        if not self.autopay_service:
+            return None
+
+        now = datetime.utcnow()
+        next_at = None
+        for days in AUTOPAY_DAYS_OPTIONS:
+            lead = timedelta(days=days)
+            upcoming = await self.db.get_upcoming_expirations(now, limit=1, auto_pay_days_before=days)
+            if not upcoming:
+                continue
+
+            due_at = upcoming[0][1] - lead
+            if due_at <= now:
+                # Срок уже наступил: сразу или повтор после прогона без средств
+                if self.last_autopay_run:
+                    due_at = max(due_at, self.last_autopay_run + timedelta(seconds=self.retry_interval))
+                if due_at > now:
+                    future = await self.db.get_upcoming_expirations(now + lead, limit=1, auto_pay_days_before=days)
+                    if future:
+                        due_at = min(due_at, future[0][1] - lead)
+
+            next_at = due_at if next_at is None else min(next_at, due_at)
+        return next_at
+
+    async def _fire(self, now: datetime):
+        due: Dict[str, List[Tuple[int, datetime]]] = {}
+        while self._heap and self._heap[0][0] <= now:
+            _, stream, user_sub_id, expires_at = heapq.heappop(self._heap)
+            due.setdefault(stream, []).append((user_sub_id, expires_at))
+            self._cursors[stream] = (expires_at, user_sub_id)
+
+        # Автоплатеж раньше предупреждений: продленным подпискам они уже не нужны
+        autopay_at = await self._next_autopay_at()
+        if autopay_at and autopay_at <= now:
+            self.last_autopay_run = now
+            try:
+                await self.autopay_service.process_autopayments()
+            except Exception as e:
+                logger.error(f"❌ Error in scheduled autopay run: {e}", exc_info=True)
+            self.fired['autopay'] = self.fired.get('autopay', 0) + 1
+
+        for stream, events in due.items():
+            try:
+                await self._fire_stream(stream, events)
+            except Exception as e:
+                logger.error(f"❌ Error firing {len(events)} {stream} events: {e}", exc_info=True)
+
+    async def _fire_stream(self, stream: str, events: List[Tuple[int, datetime]]):
+        scheduled = dict(events)
+        rows = [
+            (user_sub, subscription, user)
+            for user_sub, subscription, user in await self.db.get_user_subscription_details(list(scheduled))
+            # подписку могли продлить или отключить после выборки
+            if user_sub.is_active and user_sub.expires_at == scheduled[user_sub.id]
+        ]
+        if not rows:
+            return
+
+        if stream == 'trial':
+            sent = await self.monitor_service.send_trial_expiry_notifications(rows)
+        else:
+            sent = await self.monitor_service.send_expiry_warnings(rows)
+
+        self.fired[stream] = self.fired.get(stream, 0) + sent
+        logger.info(f"⏰ {stream}: {sent} of {len(events)} due notifications sent")
+
+    def get_status(self) -> dict:
+        return {
+            'is_running': self.is_running,
+            'streams': list(self._cursors),
+            'queued_events': len(self._heap),
+            'next_wakeup': self.next_wakeup,
+            'last_autopay_run': self.last_autopay_run,
+            'fired': dict(self.fired)
+        }
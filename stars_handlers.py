@@ -67,7 +67,7 @@ async def topup_stars_callback(callback: CallbackQuery, **kwargs):
         parse_mode='Markdown'
     )
 
-@stars_router.callback_query(F.data.startswith("buy_stars_"))
+@stars_router.callback_query(F.data.startswith("buy_stars_"), flags={'rate_limit': 'payment'})
 async def buy_stars_callback(callback: CallbackQuery, db: Database, **kwargs):
     user = kwargs.get('user')
     config = kwargs.get('config')
@@ -189,7 +189,7 @@ async def pre_checkout_query_handler(pre_checkout_query: PreCheckoutQuery, db: D
         logger.error(f"Error in pre_checkout_query_handler: {e}")
         await pre_checkout_query.answer(ok=False, error_message="Внутренняя ошибка")
 
-@stars_router.message(F.successful_payment)
+@stars_router.message(F.successful_payment, flags={'rate_limit': 'exempt'})
 async def successful_payment_handler(message: Message, db: Database, **kwargs):
     user = kwargs.get('user')
     bot = kwargs.get('bot')
@@ -231,18 +231,14 @@ async def successful_payment_handler(message: Message, db: Database, **kwargs):
                 
                 if bot:
                     try:
-                        regular_payment = await db.create_payment(
-                            user_id=user.telegram_id,
-                            amount=star_payment.rub_amount,
-                            payment_type='stars',
-                            description=f'Пополнение через Telegram Stars ({star_payment.stars_amount} ⭐)',
-                            status='completed'
+                        ledger_entry = await db.get_balance_transaction(
+                            f"stars:{payment_info.telegram_payment_charge_id}"
                         )
                         
                         await process_referral_rewards(
                             user.telegram_id,
                             star_payment.rub_amount,
-                            regular_payment.id,
+                            ledger_entry.payment_id if ledger_entry else None,
                             db,
                             bot,
                             payment_type='stars'
@@ -0,0 +1,74 @@
+import asyncio
+import copy
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class StatsCache:
+    """In-process TTL кэш агрегированной статистики для админки.
+
+    Каждый срез (overview, promocodes, autopay, ...) считается одним
+    агрегирующим запросом и хранится до истечения ttl или до invalidate()
+    из методов Database, которые меняют соответствующие таблицы.
+    Параллельные промахи по одному срезу ждут один общий пересчет, а
+    наружу отдается копия, чтобы хендлеры не портили закэшированное значение.
+    """
+
+    def __init__(self, ttl: int = 60):
+        self.ttl = ttl
+        self._entries: Dict[str, Tuple[float, Any]] = {}
+        self._loading: Dict[str, asyncio.Future] = {}
+        self._generation: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    async def get_or_load(self, name: str, loader: Callable[[], Awaitable[Any]]) -> Any:
+        if not self.enabled:
+            return await loader()
+
+        entry = self._entries.get(name)
+        if entry is not None and entry[0] >= time.monotonic():
+            self.hits += 1
+            return copy.deepcopy(entry[1])
+
+        self.misses += 1
+        pending = self._loading.get(name)
+        if pending is None:
+            pending = asyncio.ensure_future(self._load(name, loader))
+            self._loading[name] = pending
+            pending.add_done_callback(lambda _: self._loading.pop(name, None))
+
+        return copy.deepcopy(await asyncio.shield(pending))
+
+    async def _load(self, name: str, loader: Callable[[], Awaitable[Any]]) -> Any:
+        generation = self._generation.get(name, 0)
+        value = await loader()
+        # Пока считали, срез могли инвалидировать: такое значение не кэшируем
+        if self._generation.get(name, 0) == generation:
+            self._entries[name] = (time.monotonic() + self.ttl, value)
+        return value
+
+    def invalidate(self, *names: str):
+        for name in names:
+            self._entries.pop(name, None)
+            self._generation[name] = self._generation.get(name, 0) + 1
+
+    def clear(self):
+        self.invalidate(*self._entries)
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'entries': sorted(self._entries),
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total * 100, 1) if total else 0.0
+        }
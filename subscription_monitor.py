@@ -33,15 +33,18 @@ class SubscriptionMonitorService:
         try:
             self.is_running = True
             
-            self._monitor_task = asyncio.create_task(self._monitor_loop())
-            logger.info(f"Started monitoring loop with interval {self.config.MONITOR_CHECK_INTERVAL}s")
+            if getattr(self.config, 'SCHEDULER_ENABLED', False):
+                logger.info("Expiry warnings and trial notifications are sent by the due-time scheduler")
+            else:
+                self._monitor_task = asyncio.create_task(self._monitor_loop())
+                logger.info(f"Started monitoring loop with interval {self.config.MONITOR_CHECK_INTERVAL}s")
             
             self._daily_task = asyncio.create_task(self._daily_loop())
             logger.info(f"Started daily cleanup task for {self.config.MONITOR_DAILY_CHECK_HOUR}:00")
             
             await asyncio.sleep(0.1)
             
-            monitor_running = self._monitor_task and not self._monitor_task.done()
+            monitor_running = self._monitor_task is None or not self._monitor_task.done()
             daily_running = self._daily_task and not self._daily_task.done()
             
             if monitor_running and daily_running:
@@ -85,6 +88,12 @@ class SubscriptionMonitorService:
         
         logger.info("Subscription monitor service stopped")
         
+    @staticmethod
+    def _to_naive_utc(value: datetime) -> datetime:
+        if value.tzinfo is None:
+            return value
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+
     async def _monitor_loop(self):
         logger.info("🔥 Starting monitor loop")
         
@@ -155,49 +164,23 @@ class SubscriptionMonitorService:
         try:
             logger.info("🆓 Checking for expired trial subscriptions...")
             
-            notifications_sent = 0
             now_utc = datetime.utcnow()
-            
-            all_users = await self.db.get_all_users()
-            
-            for user in all_users:
-                try:
-                    user_subs = await self.db.get_user_subscriptions(user.telegram_id)
-                    
-                    for user_sub in user_subs:
-                        try:
-                            subscription = await self.db.get_subscription_by_id(user_sub.subscription_id)
-                            if not subscription:
-                                continue
-                            
-                            if not subscription.is_trial:
-                                continue
-                            
-                            expires_at_utc = user_sub.expires_at
-                            if expires_at_utc.tzinfo is None:
-                                expires_at_utc = expires_at_utc.replace(tzinfo=None)
-                            else:
-                                expires_at_utc = expires_at_utc.astimezone(timezone.utc).replace(tzinfo=None)
-                            
-                            time_diff = expires_at_utc - now_utc
-                            hours_since_expiry = -time_diff.total_seconds() / 3600
-                            
-                            if 1 <= hours_since_expiry <= 24 and user_sub.is_active:
-                                logger.info(f"🆓 Sending trial expiry notification to user {user.telegram_id}: "
-                                          f"trial '{subscription.name}' expired {hours_since_expiry:.1f} hours ago")
-                                
-                                try:
-                                    await self._send_trial_expiry_notification(user, subscription)
-                                    notifications_sent += 1
-                                    logger.info(f"✅ Trial expiry notification sent to user {user.telegram_id}")
-                                except Exception as notification_error:
-                                    logger.error(f"❌ Failed to send trial notification to user {user.telegram_id}: {notification_error}")
-                        
-                        except Exception as sub_error:
-                            logger.error(f"❌ Error checking trial subscription {user_sub.id}: {sub_error}")
-                
-                except Exception as user_error:
-                    logger.error(f"❌ Error checking trial subscriptions for user {user.telegram_id}: {user_error}")
+            hours_after = getattr(self.config, 'TRIAL_NOTIFICATION_HOURS_AFTER', 1)
+            hours_window = getattr(self.config, 'TRIAL_NOTIFICATION_HOURS_WINDOW', 23)
+            
+            candidates = []
+            async for user_sub, subscription, user in self.db.iter_due_user_subscriptions(
+                expires_after=now_utc - timedelta(hours=hours_after + hours_window),
+                expires_before=now_utc - timedelta(hours=hours_after),
+                is_active=True,
+                is_trial=True
+            ):
+                candidates.append((0, user_sub, subscription, user))
+            
+            notifications_sent = await self._send_once(
+                'trial_expired', candidates,
+                lambda user_sub, subscription, user: self._send_trial_expiry_notification(user, subscription)
+            )
             
             if notifications_sent > 0:
                 logger.info(f"🆓 Trial expiry check completed: {notifications_sent} notifications sent")
@@ -208,11 +191,65 @@ class SubscriptionMonitorService:
             logger.error(f"❌ Critical error in check_expired_trial_subscriptions: {e}", exc_info=True)
             return 0
 
-    async def _send_trial_expiry_notification(self, user, subscription):
+    async def _send_once(self, kind: str, candidates: List[tuple], send) -> int:
+        """Отправляет уведомления, которых еще нет в notification_log.
+
+        candidates - (threshold, UserSubscription, Subscription, User); ключ
+        уведомления - подписка, порог и текущий expires_at. Уже отправленные
+        отсеиваются одним запросом, успешные отправки пишутся в журнал пачкой,
+        так что повторный проход или рестарт не шлет то же самое еще раз.
+        send возвращает True, только если сообщение действительно ушло;
+        остальные ключи в журнал не попадают и будут повторены.
+        """
+        if not candidates:
+            return 0
+        
+        keys = [(user_sub.id, threshold, user_sub.expires_at) for threshold, user_sub, _, _ in candidates]
+        already_sent = await self.db.get_sent_notifications(kind, keys)
+        
+        sent_keys = []
+        for key, (threshold, user_sub, subscription, user) in zip(keys, candidates):
+            if key in already_sent:
+                continue
+            try:
+                if await send(user_sub, subscription, user):
+                    sent_keys.append(key)
+            except Exception as e:
+                logger.error(f"❌ Failed to send {kind} notification to user {user.telegram_id}: {e}")
+        
+        await self.db.log_notifications(kind, sent_keys)
+        
+        if already_sent:
+            logger.info(f"📭 Skipped {len(already_sent)} already sent {kind} notifications")
+        return len(sent_keys)
+
+    def _days_left(self, user_sub) -> int:
+        hours_left = (self._to_naive_utc(user_sub.expires_at) - datetime.utcnow()).total_seconds() / 3600
+        return int(hours_left / 24)
+
+    async def send_expiry_warnings(self, rows: List[tuple]) -> int:
+        """Предупреждения по событиям планировщика, rows - (UserSubscription, Subscription, User)."""
+        candidates = [
+            (self._days_left(user_sub), user_sub, subscription, user)
+            for user_sub, subscription, user in rows
+            if not subscription.is_imported and subscription.name != "Старая подписка"
+        ]
+        return await self._send_once(
+            'expiry_warning', candidates,
+            lambda user_sub, subscription, user: self._send_expiry_warning(user, user_sub, subscription)
+        )
+
+    async def send_trial_expiry_notifications(self, rows: List[tuple]) -> int:
+        return await self._send_once(
+            'trial_expired', [(0, user_sub, subscription, user) for user_sub, subscription, user in rows],
+            lambda user_sub, subscription, user: self._send_trial_expiry_notification(user, subscription)
+        )
+
+    async def _send_trial_expiry_notification(self, user, subscription) -> bool:
         try:
             if not self.bot:
                 logger.error("❌ Bot instance is None, cannot send trial notification")
-                return
+                return False
             
             from translations import t
             from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
@@ -233,6 +270,7 @@ class SubscriptionMonitorService:
             await self.bot.send_message(user.telegram_id, message, reply_markup=keyboard)
             
             logger.info(f"✅ Trial expiry notification sent to user {user.telegram_id} for subscription '{subscription.name}'")
+            return True
         
         except Exception as e:
             logger.error(f"❌ Error sending trial expiry notification to user {user.telegram_id}: {e}", exc_info=True)
@@ -248,76 +286,15 @@ class SubscriptionMonitorService:
             
             logger.info(f"🗑️ Deleting trial subscriptions expired before: {cutoff_date} (older than {delete_threshold_days} days)")
             
-            results = {
-                'total_checked': 0,
-                'deleted_from_db': 0,
-                'deleted_from_api': 0,
-                'errors': [],
-                'deleted_subscriptions': []
-            }
+            candidates = [
+                (user_sub, subscription, user)
+                async for user_sub, subscription, user in self.db.iter_due_user_subscriptions(
+                    expires_before=None if force else cutoff_date,
+                    is_trial=True
+                )
+            ]
             
-            all_users = await self.db.get_all_users()
-            
-            for user in all_users:
-                try:
-                    user_subs = await self.db.get_user_subscriptions(user.telegram_id)
-                    
-                    for user_sub in user_subs:
-                        results['total_checked'] += 1
-                        
-                        subscription = await self.db.get_subscription_by_id(user_sub.subscription_id)
-                        if not subscription or not subscription.is_trial:
-                            continue
-                        
-                        expires_at_utc = user_sub.expires_at
-                        if expires_at_utc.tzinfo is None:
-                            expires_at_utc = expires_at_utc.replace(tzinfo=None)
-                        else:
-                            expires_at_utc = expires_at_utc.astimezone(timezone.utc).replace(tzinfo=None)
-                        
-                        if expires_at_utc > cutoff_date and not force:
-                            continue  
-                        
-                        logger.info(f"🗑️ Deleting expired trial subscription '{subscription.name}' for user {user.telegram_id} "
-                                  f"(expired: {expires_at_utc}, cutoff: {cutoff_date})")
-                        
-                        api_deleted = False
-                        if self.api and user_sub.short_uuid:
-                            try:
-                                api_result = await self.api.delete_user_by_short_uuid(user_sub.short_uuid)
-                                if api_result and api_result.get('success'):
-                                    api_deleted = True
-                                    results['deleted_from_api'] += 1
-                                    logger.info(f"✅ Deleted from RemnaWave API: {user_sub.short_uuid}")
-                                else:
-                                    results['errors'].append(f"Failed to delete {user_sub.short_uuid} from API")
-                                    logger.warning(f"⚠️ Failed to delete {user_sub.short_uuid} from API")
-                            except Exception as api_error:
-                                results['errors'].append(f"API error for {user_sub.short_uuid}: {str(api_error)}")
-                                logger.error(f"❌ API error deleting {user_sub.short_uuid}: {api_error}")
-                        
-                        db_deleted = await self.db.delete_user_subscription(user_sub.id)
-                        if db_deleted:
-                            results['deleted_from_db'] += 1
-                            results['deleted_subscriptions'].append({
-                                'user_id': user.telegram_id,
-                                'subscription_name': subscription.name,
-                                'short_uuid': user_sub.short_uuid,
-                                'expired_at': expires_at_utc.isoformat(),
-                                'deleted_from_api': api_deleted,
-                                'deleted_from_db': True
-                            })
-                            logger.info(f"✅ Deleted from database: subscription ID {user_sub.id}")
-                        else:
-                            results['errors'].append(f"Failed to delete subscription ID {user_sub.id} from database")
-                            logger.error(f"❌ Failed to delete subscription ID {user_sub.id} from database")
-                        
-                except Exception as user_error:
-                    results['errors'].append(f"Error processing user {user.telegram_id}: {str(user_error)}")
-                    logger.error(f"❌ Error processing user {user.telegram_id}: {user_error}")
-            
-            logger.info(f"🗑️ Trial deletion completed: {results['deleted_from_db']} from DB, {results['deleted_from_api']} from API")
-            return results
+            return await self._delete_user_subscriptions(candidates, 'trial')
             
         except Exception as e:
             logger.error(f"❌ Error in delete_expired_trial_subscriptions: {e}", exc_info=True)
@@ -339,79 +316,17 @@ class SubscriptionMonitorService:
             
             logger.info(f"🗑️ Deleting regular subscriptions expired before: {cutoff_date} (older than {delete_threshold_days} days)")
             
-            results = {
-                'total_checked': 0,
-                'deleted_from_db': 0,
-                'deleted_from_api': 0,
-                'errors': [],
-                'deleted_subscriptions': []
-            }
+            candidates = [
+                (user_sub, subscription, user)
+                async for user_sub, subscription, user in self.db.iter_due_user_subscriptions(
+                    expires_before=None if force else cutoff_date,
+                    is_trial=False,
+                    is_imported=False
+                )
+                if subscription.name != "Старая подписка"
+            ]
             
-            all_users = await self.db.get_all_users()
-            
-            for user in all_users:
-                try:
-                    user_subs = await self.db.get_user_subscriptions(user.telegram_id)
-                    
-                    for user_sub in user_subs:
-                        results['total_checked'] += 1
-                        
-                        subscription = await self.db.get_subscription_by_id(user_sub.subscription_id)
-                        if not subscription or subscription.is_trial:
-                            continue
-                        
-                        if getattr(subscription, 'is_imported', False) or subscription.name == "Старая подписка":
-                            continue
-                        
-                        expires_at_utc = user_sub.expires_at
-                        if expires_at_utc.tzinfo is None:
-                            expires_at_utc = expires_at_utc.replace(tzinfo=None)
-                        else:
-                            expires_at_utc = expires_at_utc.astimezone(timezone.utc).replace(tzinfo=None)
-                        
-                        if expires_at_utc > cutoff_date and not force:
-                            continue 
-                        
-                        logger.info(f"🗑️ Deleting expired regular subscription '{subscription.name}' for user {user.telegram_id} "
-                                  f"(expired: {expires_at_utc}, cutoff: {cutoff_date})")
-                        
-                        api_deleted = False
-                        if self.api and user_sub.short_uuid:
-                            try:
-                                api_result = await self.api.delete_user_by_short_uuid(user_sub.short_uuid)
-                                if api_result and api_result.get('success'):
-                                    api_deleted = True
-                                    results['deleted_from_api'] += 1
-                                    logger.info(f"✅ Deleted from RemnaWave API: {user_sub.short_uuid}")
-                                else:
-                                    results['errors'].append(f"Failed to delete {user_sub.short_uuid} from API")
-                                    logger.warning(f"⚠️ Failed to delete {user_sub.short_uuid} from API")
-                            except Exception as api_error:
-                                results['errors'].append(f"API error for {user_sub.short_uuid}: {str(api_error)}")
-                                logger.error(f"❌ API error deleting {user_sub.short_uuid}: {api_error}")
-                        
-                        db_deleted = await self.db.delete_user_subscription(user_sub.id)
-                        if db_deleted:
-                            results['deleted_from_db'] += 1
-                            results['deleted_subscriptions'].append({
-                                'user_id': user.telegram_id,
-                                'subscription_name': subscription.name,
-                                'short_uuid': user_sub.short_uuid,
-                                'expired_at': expires_at_utc.isoformat(),
-                                'deleted_from_api': api_deleted,
-                                'deleted_from_db': True
-                            })
-                            logger.info(f"✅ Deleted from database: subscription ID {user_sub.id}")
-                        else:
-                            results['errors'].append(f"Failed to delete subscription ID {user_sub.id} from database")
-                            logger.error(f"❌ Failed to delete subscription ID {user_sub.id} from database")
-                        
-                except Exception as user_error:
-                    results['errors'].append(f"Error processing user {user.telegram_id}: {str(user_error)}")
-                    logger.error(f"❌ Error processing user {user.telegram_id}: {user_error}")
-            
-            logger.info(f"🗑️ Regular deletion completed: {results['deleted_from_db']} from DB, {results['deleted_from_api']} from API")
-            return results
+            return await self._delete_user_subscriptions(candidates, 'regular')
             
         except Exception as e:
             logger.error(f"❌ Error in delete_expired_regular_subscriptions: {e}", exc_info=True)
@@ -422,111 +337,105 @@ class SubscriptionMonitorService:
                 'errors': [f"Critical error: {str(e)}"],
                 'deleted_subscriptions': []
             }
+
+    async def _delete_user_subscriptions(self, candidates: List[tuple], kind: str) -> Dict[str, Any]:
+        results = {
+            'total_checked': len(candidates),
+            'deleted_from_db': 0,
+            'deleted_from_api': 0,
+            'errors': [],
+            'deleted_subscriptions': []
+        }
+        
+        if not candidates:
+            logger.info(f"🗑️ {kind.capitalize()} deletion completed: nothing to delete")
+            return results
+        
+        for user_sub, subscription, user in candidates:
+            logger.info(f"🗑️ Deleting expired {kind} subscription '{subscription.name}' for user {user.telegram_id} "
+                      f"(expired: {self._to_naive_utc(user_sub.expires_at)})")
+        
+        api_results = {}
+        short_uuids = [user_sub.short_uuid for user_sub, _, _ in candidates if user_sub.short_uuid]
+        if self.api and short_uuids:
+            try:
+                api_response = await self.api.bulk_delete_users_by_short_uuids(short_uuids)
+                api_results = api_response.get('results', {})
+                results['deleted_from_api'] = api_response.get('success', 0)
+                for short_uuid, deleted in api_results.items():
+                    if not deleted:
+                        results['errors'].append(f"Failed to delete {short_uuid} from API")
+                logger.info(f"✅ Deleted from RemnaWave API: {results['deleted_from_api']}/{len(short_uuids)}")
+            except Exception as api_error:
+                results['errors'].append(f"API error during bulk deletion: {str(api_error)}")
+                logger.error(f"❌ API error during bulk deletion: {api_error}")
+        
+        deleted_count = await self.db.delete_user_subscriptions([user_sub.id for user_sub, _, _ in candidates])
+        if deleted_count == 0:
+            results['errors'].append(f"Failed to delete {len(candidates)} subscriptions from database")
+            logger.error(f"❌ Failed to delete {len(candidates)} {kind} subscriptions from database")
+        else:
+            results['deleted_from_db'] = deleted_count
+            for user_sub, subscription, user in candidates:
+                results['deleted_subscriptions'].append({
+                    'user_id': user.telegram_id,
+                    'subscription_name': subscription.name,
+                    'short_uuid': user_sub.short_uuid,
+                    'expired_at': self._to_naive_utc(user_sub.expires_at).isoformat(),
+                    'deleted_from_api': api_results.get(user_sub.short_uuid, False),
+                    'deleted_from_db': True
+                })
+        
+        logger.info(f"🗑️ {kind.capitalize()} deletion completed: {results['deleted_from_db']} from DB, {results['deleted_from_api']} from API")
+        return results
                 
     async def _check_expiring_subscriptions(self):
         try:
             logger.info("🔍 Checking for expiring subscriptions...")
         
-            all_users = await self.db.get_all_users()
-            logger.info(f"👥 Found {len(all_users)} total users in database")
-        
-            if not all_users:
-                logger.warning("⚠️ No users found in database")
-                return 0
-        
-            warnings_sent = 0
-            errors_count = 0
             total_subscriptions = 0
         
             now_utc = datetime.utcnow()
             logger.info(f"🕐 Current UTC time: {now_utc}")
-        
-            for user in all_users:
-                try:
-                    user_subs = await self.db.get_user_subscriptions(user.telegram_id)
-                    total_subscriptions += len(user_subs)
-                
-                    if not user_subs:
-                        logger.debug(f"👤 User {user.telegram_id} has no subscriptions")
-                        continue
-                
-                    logger.debug(f"👤 User {user.telegram_id}: checking {len(user_subs)} subscriptions")
+            
+            # days_left = int(hours_left / 24) <= MONITOR_WARNING_DAYS  <=>  hours_left < (MONITOR_WARNING_DAYS + 1) * 24
+            warning_horizon = now_utc + timedelta(days=self.config.MONITOR_WARNING_DAYS + 1)
+        
+            candidates = []
+            async for user_sub, subscription, user in self.db.iter_due_user_subscriptions(
+                expires_after=now_utc,
+                expires_before=warning_horizon,
+                is_active=True,
+                is_trial=False,
+                is_imported=False
+            ):
+                total_subscriptions += 1
+                if subscription.name == "Старая подписка":
+                    logger.debug(f"⭐️ Skipping imported subscription '{subscription.name}'")
+                    continue
                 
-                    for user_sub in user_subs:
-                        try:
-                            subscription = await self.db.get_subscription_by_id(user_sub.subscription_id)
-                            if not subscription:
-                                logger.warning(f"⚠️ Subscription plan {user_sub.subscription_id} not found")
-                                continue
-                        
-                            expires_at_utc = user_sub.expires_at
-                            if expires_at_utc.tzinfo is None:
-                                expires_at_utc = expires_at_utc.replace(tzinfo=None)
-                            else:
-                                expires_at_utc = expires_at_utc.astimezone(timezone.utc).replace(tzinfo=None)
-                        
-                            time_diff = expires_at_utc - now_utc
-                            hours_left = time_diff.total_seconds() / 3600
-                            days_left = int(hours_left / 24)
-                            
-                            logger.debug(f"📋 Subscription '{subscription.name}': "
-                                       f"expires_at={expires_at_utc}, "
-                                       f"now_utc={now_utc}, "
-                                       f"hours_left={hours_left:.1f}, "
-                                       f"days_left={days_left}, "
-                                       f"threshold={self.config.MONITOR_WARNING_DAYS}")
-                        
-                            if subscription.is_trial:
-                                logger.debug(f"⭐️ Skipping trial subscription '{subscription.name}'")
-                                continue
-                        
-                            if getattr(subscription, 'is_imported', False) or subscription.name == "Старая подписка":
-                                logger.debug(f"⭐️ Skipping imported subscription '{subscription.name}'")
-                                continue
-                        
-                            should_warn = (
-                                user_sub.is_active and 
-                                days_left <= self.config.MONITOR_WARNING_DAYS and 
-                                hours_left > 0
-                            )
-                        
-                            if should_warn:
-                                logger.info(f"⚠️ Sending warning to user {user.telegram_id}: "
-                                          f"subscription '{subscription.name}' expires in {days_left} days "
-                                          f"({hours_left:.1f} hours)")
-                            
-                                try:
-                                    await self._send_expiry_warning(user, user_sub)
-                                    warnings_sent += 1
-                                    logger.info(f"✅ Warning sent successfully to user {user.telegram_id}")
-                                except Exception as warning_error:
-                                    logger.error(f"❌ Failed to send warning to user {user.telegram_id}: {warning_error}")
-                                    errors_count += 1
-                            elif hours_left <= 0:
-                                logger.debug(f"❌ Subscription '{subscription.name}' already expired {abs(hours_left):.1f} hours ago")
-                            else:
-                                logger.debug(f"✅ Subscription '{subscription.name}' is OK (expires in {days_left} days)")
-                    
-                        except Exception as sub_error:
-                            logger.error(f"❌ Error checking subscription {user_sub.id}: {sub_error}")
-                            errors_count += 1
-                    
-                except Exception as user_error:
-                    logger.error(f"❌ Error checking subscriptions for user {user.telegram_id}: {user_error}")
-                    errors_count += 1
+                days_left = self._days_left(user_sub)
+                if days_left > self.config.MONITOR_WARNING_DAYS:
+                    continue
+                candidates.append((days_left, user_sub, subscription, user))
+            
+            warnings_sent = await self._send_once(
+                'expiry_warning', candidates,
+                lambda user_sub, subscription, user: self._send_expiry_warning(user, user_sub, subscription)
+            )
         
-            logger.info(f"📊 Check completed: {total_subscriptions} subscriptions checked, {warnings_sent} warnings sent, {errors_count} errors")
+            logger.info(f"📊 Check completed: {total_subscriptions} subscriptions checked, {len(candidates)} due, {warnings_sent} warnings sent")
             return warnings_sent
                 
         except Exception as e:
             logger.error(f"❌ Critical error in check_expiring_subscriptions: {e}", exc_info=True)
             return 0
             
-    async def _send_expiry_warning(self, user, user_subscription):
+    async def _send_expiry_warning(self, user, user_subscription, subscription=None) -> bool:
         try:
             if not self.bot:
                 logger.error("❌ Bot instance is None, cannot send warning")
-                return
+                return False
             
             now_utc = datetime.utcnow()
             expires_at_utc = user_subscription.expires_at
@@ -539,10 +448,11 @@ class SubscriptionMonitorService:
             hours_left = time_diff.total_seconds() / 3600
             days_left = int(hours_left / 24)
         
-            subscription = await self.db.get_subscription_by_id(user_subscription.subscription_id)
+            if subscription is None:
+                subscription = await self.db.get_subscription_by_id(user_subscription.subscription_id)
             if not subscription:
                 logger.warning(f"Subscription {user_subscription.subscription_id} not found")
-                return
+                return False
         
             message = self._format_expiry_message_with_action(subscription.name, days_left, user.language)
         
@@ -579,6 +489,7 @@ class SubscriptionMonitorService:
                 logger.info(f"✅ Expiry warning sent to user {user.telegram_id} for subscription '{subscription.name}' (expires in {days_left} days)")
             else:
                 logger.info(f"✅ Expiry notification sent to user {user.telegram_id} for subscription '{subscription.name}' (already expired)")
+            return True
         
         except Exception as e:
             logger.error(f"❌ Error sending expiry warning to user {user.telegram_id}: {e}", exc_info=True)
@@ -631,6 +542,10 @@ class SubscriptionMonitorService:
             await self._send_final_expiry_notifications()
             logger.info("📩 Final notifications sent")
             
+            purged = await self.db.cleanup_notification_log()
+            if purged:
+                logger.info(f"🧹 Removed {purged} old notification log entries")
+            
             logger.info(f"✅ Daily check completed successfully. Warnings: {warnings_sent}, Trial notifications: {trial_notifications}, Deactivated: {deactivated_count}, "
                        f"Deleted trials: {deleted_trials}, Deleted regular: {deleted_regular}")
             return deactivated_count
@@ -641,57 +556,38 @@ class SubscriptionMonitorService:
             
     async def deactivate_expired_subscriptions(self) -> int:
         try:
-            count = 0
             now_utc = datetime.utcnow()
             logger.info(f"🔍 Checking for expired subscriptions (current UTC: {now_utc})")
         
-            all_users = await self.db.get_all_users()
-        
-            logger.info(f"🔍 Checking {len(all_users)} users for expired subscriptions")
-        
-            for user in all_users:
+            expired = [
+                (user_sub, subscription, user)
+                async for user_sub, subscription, user in self.db.iter_due_user_subscriptions(
+                    expires_before=now_utc - timedelta(hours=1),
+                    is_active=True
+                )
+            ]
+            
+            if not expired:
+                logger.info("✅ Deactivation completed: 0 subscriptions deactivated")
+                return 0
+            
+            count = await self.db.deactivate_user_subscriptions([user_sub.id for user_sub, _, _ in expired])
+            if count == 0:
+                logger.error(f"❌ Failed to deactivate {len(expired)} expired subscriptions in database")
+                return 0
+            
+            for user_sub, subscription, user in expired:
+                hours_since_expiry = (now_utc - self._to_naive_utc(user_sub.expires_at)).total_seconds() / 3600
+                logger.info(f"❌ Deactivated truly expired subscription '{subscription.name}' "
+                          f"for user {user.telegram_id} (expired {hours_since_expiry:.1f} hours ago)")
+            
+            short_uuids = [user_sub.short_uuid for user_sub, _, _ in expired if user_sub.short_uuid]
+            if self.api and short_uuids:
                 try:
-                    user_subs = await self.db.get_user_subscriptions(user.telegram_id)
-                
-                    for user_sub in user_subs:
-                        if user_sub.is_active:
-                            expires_at_utc = user_sub.expires_at
-                            if expires_at_utc.tzinfo is None:
-                                expires_at_utc = expires_at_utc.replace(tzinfo=None)
-                            else:
-                                expires_at_utc = expires_at_utc.astimezone(timezone.utc).replace(tzinfo=None)
-                        
-                            time_diff = expires_at_utc - now_utc
-                            hours_until_expiry = time_diff.total_seconds() / 3600
-                        
-                            if hours_until_expiry < -1.0:
-                                subscription = await self.db.get_subscription_by_id(user_sub.subscription_id)
-                                subscription_name = subscription.name if subscription else f"ID:{user_sub.subscription_id}"
-                            
-                                logger.info(f"❌ Deactivating truly expired subscription '{subscription_name}' "
-                                          f"for user {user.telegram_id} (expired {abs(hours_until_expiry):.1f} hours ago)")
-                            
-                                user_sub.is_active = False
-                                success = await self.db.update_user_subscription(user_sub)
-                            
-                                if success:
-                                    count += 1
-                                    logger.info(f"✅ Successfully deactivated subscription '{subscription_name}' for user {user.telegram_id}")
-                                
-                                    if self.api and user_sub.short_uuid:
-                                        try:
-                                            user_data = await self.api.get_user_by_short_uuid(user_sub.short_uuid)
-                                            if user_data and user_data.get('uuid'):
-                                                await self.api.update_user(user_data['uuid'], {'status': 'EXPIRED'})
-                                                logger.debug(f"🔥 Also deactivated user {user_data['uuid']} in RemnaWave")
-                                        except Exception as api_error:
-                                            logger.warning(f"⚠️ Could not deactivate user in RemnaWave: {api_error}")
-                                else:
-                                    logger.error(f"❌ Failed to deactivate subscription {user_sub.id} in database")
-                            else:
-                                logger.debug(f"✅ Subscription expires in {hours_until_expiry:.1f} hours - not deactivating yet")
-                except Exception as user_error:
-                    logger.error(f"❌ Error processing user {user.telegram_id}: {user_error}")
+                    api_result = await self.api.bulk_update_users_by_short_uuids(short_uuids, {'status': 'EXPIRED'})
+                    logger.debug(f"🔥 Also deactivated {api_result['success']}/{len(short_uuids)} users in RemnaWave")
+                except Exception as api_error:
+                    logger.warning(f"⚠️ Could not deactivate users in RemnaWave: {api_error}")
         
             logger.info(f"✅ Deactivation completed: {count} subscriptions deactivated")
             return count
@@ -702,42 +598,35 @@ class SubscriptionMonitorService:
             
     async def _send_final_expiry_notifications(self):
         try:
-            all_users = await self.db.get_all_users()
-            notifications_sent = 0
             now_utc = datetime.utcnow()
         
             logger.info(f"📩 Checking for subscriptions that expired recently (current UTC: {now_utc})")
         
-            for user in all_users:
-                try:
-                    user_subs = await self.db.get_user_subscriptions(user.telegram_id)
-                
-                    for user_sub in user_subs:
-                        expires_at_utc = user_sub.expires_at
-                        if expires_at_utc.tzinfo is None:
-                            expires_at_utc = expires_at_utc.replace(tzinfo=None)
-                        else:
-                            expires_at_utc = expires_at_utc.astimezone(timezone.utc).replace(tzinfo=None)
-                    
-                        time_since_expiry = now_utc - expires_at_utc
-                        hours_since_expiry = time_since_expiry.total_seconds() / 3600
-                    
-                        if 2 <= hours_since_expiry <= 24:
-                            subscription = await self.db.get_subscription_by_id(user_sub.subscription_id)
-                            if subscription and not subscription.is_trial and not getattr(subscription, 'is_imported', False):
-                                message = self._format_expiry_message_with_action(subscription.name, 0, user.language)
-                            
-                                from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-                                keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                                    [InlineKeyboardButton(text="🔄 Восстановить подписку", callback_data=f"extend_sub_{user_sub.id}")],
-                                    [InlineKeyboardButton(text="📋 Мои подписки", callback_data="my_subscriptions")]
-                                ])
-                            
-                                await self.bot.send_message(user.telegram_id, message, reply_markup=keyboard)
-                                notifications_sent += 1
-                                logger.info(f"📩 Sent final expiry notification for subscription '{subscription.name}' to user {user.telegram_id} (expired {hours_since_expiry:.1f} hours ago)")
-                except Exception as e:
-                    logger.error(f"❌ Error sending final notification to user {user.telegram_id}: {e}")
+            from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+            
+            candidates = []
+            async for user_sub, subscription, user in self.db.iter_due_user_subscriptions(
+                expires_after=now_utc - timedelta(hours=24),
+                expires_before=now_utc - timedelta(hours=2),
+                is_trial=False,
+                is_imported=False
+            ):
+                candidates.append((0, user_sub, subscription, user))
+            
+            async def send(user_sub, subscription, user) -> bool:
+                if not self.bot:
+                    logger.error("❌ Bot instance is None, cannot send final expiry notification")
+                    return False
+                message = self._format_expiry_message_with_action(subscription.name, 0, user.language)
+                keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="🔄 Восстановить подписку", callback_data=f"extend_sub_{user_sub.id}")],
+                    [InlineKeyboardButton(text="📋 Мои подписки", callback_data="my_subscriptions")]
+                ])
+                await self.bot.send_message(user.telegram_id, message, reply_markup=keyboard)
+                logger.info(f"📩 Sent final expiry notification for subscription '{subscription.name}' to user {user.telegram_id}")
+                return True
+            
+            notifications_sent = await self._send_once('expired', candidates, send)
         
             if notifications_sent > 0:
                 logger.info(f"📩 Sent {notifications_sent} final expiry notifications")
@@ -898,6 +787,7 @@ class SubscriptionMonitorService:
             'is_running': self.is_running and (monitor_running or daily_running),
             'monitor_enabled': getattr(self.config, 'MONITOR_ENABLED', True),
             'check_interval': self.config.MONITOR_CHECK_INTERVAL,
+            'scheduled': getattr(self.config, 'SCHEDULER_ENABLED', False),
             'daily_check_hour': self.config.MONITOR_DAILY_CHECK_HOUR,
             'warning_days': self.config.MONITOR_WARNING_DAYS,
             'delete_trial_days': getattr(self.config, 'DELETE_EXPIRED_TRIAL_DAYS', 1),
@@ -0,0 +1,588 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from database import Database
+from remnawave_api import RemnaWaveAPI, parse_panel_datetime
+
+logger = logging.getLogger(__name__)
+
+STAGE_LABELS = {
+    'fetch': 'Получение пользователей из RemnaWave',
+    'prefetch': 'Загрузка данных бота',
+    'users': 'Синхронизация пользователей',
+    'plans': 'Создание планов подписок',
+    'subscriptions': 'Синхронизация подписок',
+    'statuses': 'Обновление статусов',
+}
+
+
+class SyncJob:
+    """Состояние одного прогона синхронизации: этап, прогресс и счетчики."""
+
+    def __init__(self, mode: str, chat_id: Optional[int] = None, message_id: Optional[int] = None,
+                 reply_markup=None):
+        self.mode = mode
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.reply_markup = reply_markup
+        self.status = 'running'
+        self.stage: Optional[str] = None
+        self.stages: List[str] = []
+        self.processed = 0
+        self.total = 0
+        self.counters: Dict[str, int] = {
+            'panel_records': 0,
+            'telegram_users': 0,
+            'users_created': 0,
+            'users_updated': 0,
+            'plans_created': 0,
+            'subs_created': 0,
+            'subs_updated': 0,
+            'subs_unchanged': 0,
+            'subs_skipped': 0,
+            'statuses_updated': 0,
+            'errors': 0,
+        }
+        self.totals: Dict[str, int] = {}
+        self.error: Optional[str] = None
+        self.started_at = datetime.utcnow()
+        self.finished_at: Optional[datetime] = None
+
+    @property
+    def duration(self) -> float:
+        return ((self.finished_at or datetime.utcnow()) - self.started_at).total_seconds()
+
+
+class RemnaWaveSyncService:
+    """Пакетная синхронизация пользователей и подписок RemnaWave -> бот.
+
+    Вместо запросов к БД на каждого пользователя панели сервис один раз
+    загружает индексы бота (users по telegram_id, подписки по
+    (telegram_id, short_uuid)), считает разницу в памяти и записывает ее
+    многострочными INSERT/UPDATE пачками по batch_size строк, каждая пачка в
+    своей транзакции. Одновременно выполняется не больше одной синхронизации,
+    сообщение с прогрессом обновляется не чаще progress_interval секунд.
+
+    Раз в delta_interval секунд в фоне идет инкрементальный прогон: из панели
+    берутся только записи с updatedAt новее сохраненной в sync_state метки,
+    а индексы бота загружаются только для их telegram_id.
+    """
+
+    MODES = {
+        'users': {
+            'title': 'Синхронизация пользователей',
+            'subscriptions': False,
+            'overwrite_uuid': False,
+            'imported_plans': False,
+            'expire_stale': False,
+            'incremental': False,
+        },
+        'full': {
+            'title': 'Полная синхронизация RemnaWave',
+            'subscriptions': True,
+            'overwrite_uuid': False,
+            'imported_plans': False,
+            'expire_stale': True,
+            'incremental': False,
+        },
+        'import': {
+            'title': 'Массовый импорт подписок по Telegram ID',
+            'subscriptions': True,
+            'overwrite_uuid': True,
+            'imported_plans': True,
+            'expire_stale': False,
+            'incremental': False,
+        },
+        'delta': {
+            'title': 'Инкрементальная синхронизация',
+            'subscriptions': True,
+            'overwrite_uuid': False,
+            'imported_plans': False,
+            'expire_stale': False,
+            'incremental': True,
+        },
+    }
+
+    WATERMARK_NAME = 'remnawave_users'
+    # Запас при сравнении с меткой: записи, измененные во время прошлого
+    # обхода или с тем же updatedAt, обрабатываются повторно (запись идемпотентна)
+    WATERMARK_OVERLAP = timedelta(seconds=60)
+
+    def __init__(self, db: Database, api: RemnaWaveAPI, bot=None, admin_ids: Optional[List[int]] = None,
+                 batch_size: int = 500, progress_interval: int = 5, delta_interval: int = 300):
+        self.db = db
+        self.api = api
+        self.bot = bot
+        self.admin_ids = set(admin_ids or [])
+        self.batch_size = max(1, batch_size)
+        self.progress_interval = max(1, progress_interval)
+        self.delta_interval = delta_interval
+        self.is_running = False
+        self.current_job: Optional[SyncJob] = None
+        self.last_job: Optional[SyncJob] = None
+        self._task: Optional[asyncio.Task] = None
+        self._delta_task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self._last_report = 0.0
+
+    @property
+    def is_busy(self) -> bool:
+        return self._lock.locked()
+
+    async def start(self):
+        if self.is_running:
+            logger.warning("Sync service is already running")
+            return
+
+        self.is_running = True
+        if self.delta_interval > 0:
+            self._delta_task = asyncio.create_task(self._delta_loop())
+            logger.info(f"🔄 Incremental RemnaWave sync every {self.delta_interval}s")
+
+    async def stop(self):
+        self.is_running = False
+        for task in (self._delta_task, self._task):
+            if task and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+
+    async def _delta_loop(self):
+        while self.is_running:
+            await asyncio.sleep(self.delta_interval)
+            if self.is_busy:
+                logger.debug("Skipping incremental sync: another sync is running")
+                continue
+            try:
+                await self.run('delta')
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error in incremental sync loop: {e}", exc_info=True)
+
+    def start_sync(self, mode: str, chat_id: Optional[int] = None, message_id: Optional[int] = None,
+                   reply_markup=None) -> Optional[SyncJob]:
+        """Запускает синхронизацию в фоне; None, если другая уже идет."""
+        if self.is_busy or (self._task and not self._task.done()):
+            return None
+
+        job = SyncJob(mode, chat_id, message_id, reply_markup)
+        self._task = asyncio.create_task(self.run(mode, job))
+        return job
+
+    async def run(self, mode: str, job: Optional[SyncJob] = None) -> SyncJob:
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown sync mode: {mode}")
+
+        job = job or SyncJob(mode)
+        options = self.MODES[mode]
+        job.stages = ['fetch', 'prefetch', 'users']
+        if options['subscriptions']:
+            job.stages += ['plans', 'subscriptions']
+        if options['expire_stale']:
+            job.stages.append('statuses')
+
+        async with self._lock:
+            self.current_job = job
+            self._last_report = 0.0
+            try:
+                logger.debug(f"🔄 Sync '{mode}' started")
+                await self._sync(job, options)
+                job.status = 'completed'
+            except asyncio.CancelledError:
+                job.status = 'cancelled'
+                raise
+            except Exception as e:
+                logger.error(f"Error in sync '{mode}': {e}", exc_info=True)
+                job.status = 'failed'
+                job.error = str(e)
+            finally:
+                job.finished_at = datetime.utcnow()
+                self.current_job = None
+                self.last_job = job
+                if not options['incremental'] or job.counters['panel_records'] or job.status != 'completed':
+                    logger.info(f"🔄 Sync '{mode}' {job.status} in {job.duration:.1f}s: {job.counters}")
+                await self._report(job, force=True)
+
+        return job
+
+    async def _sync(self, job: SyncJob, options: Dict[str, Any]):
+        await self._set_stage(job, 'fetch')
+        since = None
+        if options['incremental']:
+            since = await self.db.get_sync_watermark(self.WATERMARK_NAME)
+            if since is not None:
+                records = self.api.iter_users_updated_since(since - self.WATERMARK_OVERLAP)
+            else:
+                records = self.api.iter_system_users(with_urls=False)
+        else:
+            records = self.api.iter_system_users(with_urls=False)
+
+        records_by_telegram: Dict[int, List[Dict]] = {}
+        newest_update: Optional[datetime] = None
+        async for record in records:
+            job.counters['panel_records'] += 1
+            updated_at = parse_panel_datetime(record.get('updatedAt'))
+            if updated_at and (newest_update is None or updated_at > newest_update):
+                newest_update = updated_at
+            if record.get('telegramId'):
+                records_by_telegram.setdefault(record['telegramId'], []).append(record)
+            job.processed = job.counters['panel_records']
+            await self._report(job)
+
+        job.counters['telegram_users'] = len(records_by_telegram)
+        if not job.counters['panel_records']:
+            if since is not None:
+                return
+            raise RuntimeError("Не удалось получить пользователей из RemnaWave")
+
+        telegram_ids = list(records_by_telegram) if since is not None else None
+
+        await self._set_stage(job, 'prefetch')
+        users_index = await self.db.get_user_sync_index(telegram_ids)
+        subs_index = await self.db.get_user_subscription_sync_index(telegram_ids) if options['subscriptions'] else {}
+
+        await self._set_stage(job, 'users')
+        await self._sync_users(job, options, records_by_telegram, users_index)
+
+        if not options['subscriptions']:
+            job.totals = await self.db.get_sync_totals()
+            return
+
+        records = [record for user_records in records_by_telegram.values() for record in user_records]
+
+        await self._set_stage(job, 'plans')
+        plans_by_squad, plan_ids = await self._ensure_plans(job, options, records)
+
+        await self._set_stage(job, 'subscriptions')
+        await self._sync_subscriptions(job, records, subs_index, plans_by_squad, plan_ids)
+
+        if options['expire_stale']:
+            await self._set_stage(job, 'statuses')
+            await self._expire_stale(job)
+
+        # Метка двигается только после полностью записанного прогона, иначе
+        # упавшие пачки будут подобраны следующим инкрементальным запуском
+        if newest_update and not job.counters['errors']:
+            await self.db.set_sync_watermark(self.WATERMARK_NAME, newest_update)
+
+        if not options['incremental']:
+            job.totals = await self.db.get_sync_totals()
+
+    async def _sync_users(self, job: SyncJob, options: Dict[str, Any],
+                          records_by_telegram: Dict[int, List[Dict]], users_index: Dict[int, Dict]):
+        to_insert = []
+        to_update = []
+
+        for telegram_id, user_records in records_by_telegram.items():
+            latest = max(user_records, key=lambda r: r.get('updatedAt') or r.get('createdAt') or '')
+            existing = users_index.get(telegram_id)
+
+            if existing is None:
+                username = self._pick_username(user_records, latest, telegram_id)
+                to_insert.append({
+                    'telegram_id': telegram_id,
+                    'username': username,
+                    'first_name': username,
+                    'language': 'ru',
+                    'is_admin': telegram_id in self.admin_ids,
+                    'remnawave_uuid': latest.get('uuid'),
+                })
+                continue
+
+            uuid = latest.get('uuid')
+            if not uuid or existing['remnawave_uuid'] == uuid:
+                continue
+            if existing['remnawave_uuid'] and not options['overwrite_uuid']:
+                continue
+            to_update.append({'id': existing['id'], 'telegram_id': telegram_id, 'remnawave_uuid': uuid})
+
+        job.total = len(to_insert) + len(to_update)
+        job.counters['users_created'] = await self._write_batches(job, self.db.bulk_insert_users, to_insert)
+        job.counters['users_updated'] = await self._write_batches(job, self.db.bulk_update_users, to_update)
+
+    async def _ensure_plans(self, job: SyncJob, options: Dict[str, Any],
+                            records: List[Dict]) -> Tuple[Dict[str, Any], Set[int]]:
+        squad_names = {}
+        for record in records:
+            for squad in record.get('activeInternalSquads') or []:
+                squad_uuid = self._squad_uuid(squad)
+                if squad_uuid:
+                    squad_names.setdefault(squad_uuid, squad.get('name') if isinstance(squad, dict) else None)
+
+        plans_by_squad = {}
+        plan_ids = set()
+        for plan in await self.db.get_all_subscriptions_admin():
+            plan_ids.add(plan.id)
+            if plan.squad_uuid:
+                plans_by_squad.setdefault(plan.squad_uuid, plan)
+
+        for squad_uuid, squad_name in squad_names.items():
+            if squad_uuid in plans_by_squad:
+                continue
+            try:
+                if options['imported_plans']:
+                    plan = await self.db.create_subscription(
+                        name="Старая подписка",
+                        description=f"Импортированная подписка из RemnaWave (squad: {squad_name or 'Unknown Squad'})",
+                        price=0,
+                        duration_days=30,
+                        traffic_limit_gb=0,
+                        squad_uuid=squad_uuid,
+                        is_imported=True
+                    )
+                else:
+                    plan = await self.db.create_subscription(
+                        name=f"Auto_Squad_{squad_uuid[:8]}",
+                        description=f"Автоматически созданный план для squad {squad_uuid}",
+                        price=0,
+                        duration_days=30,
+                        traffic_limit_gb=0,
+                        squad_uuid=squad_uuid
+                    )
+                plans_by_squad[squad_uuid] = plan
+                plan_ids.add(plan.id)
+                job.counters['plans_created'] += 1
+                logger.info(f"Created subscription plan for squad {squad_uuid}")
+            except Exception as e:
+                logger.error(f"Error creating plan for squad {squad_uuid}: {e}")
+                job.counters['errors'] += 1
+
+        return plans_by_squad, plan_ids
+
+    async def _sync_subscriptions(self, job: SyncJob, records: List[Dict], subs_index: Dict,
+                                  plans_by_squad: Dict[str, Any], plan_ids: Set[int]):
+        to_insert = []
+        to_update = []
+        orphaned = []
+        seen = set()
+
+        for record in records:
+            telegram_id = record['telegramId']
+            short_uuid = record.get('shortUuid')
+            key = (telegram_id, short_uuid)
+            if not short_uuid or key in seen:
+                job.counters['subs_skipped'] += 1
+                continue
+            seen.add(key)
+
+            expires_at = self._parse_expire_at(record.get('expireAt'))
+            is_active = record.get('status') == 'ACTIVE'
+            traffic_gb = self._traffic_gb(record.get('trafficLimitBytes'))
+
+            existing = subs_index.get(key)
+            if existing and existing['subscription_id'] not in plan_ids:
+                logger.warning(f"Found orphaned subscription {existing['id']} for user {telegram_id}, recreating")
+                orphaned.append(existing['id'])
+                existing = None
+
+            if existing:
+                changes = {}
+                if expires_at and existing['expires_at'] != expires_at:
+                    changes['expires_at'] = expires_at
+                if existing['is_active'] != is_active:
+                    changes['is_active'] = is_active
+                if traffic_gb is not None and existing['traffic_limit_gb'] != traffic_gb:
+                    changes['traffic_limit_gb'] = traffic_gb
+
+                if changes:
+                    to_update.append({
+                        'id': existing['id'],
+                        'expires_at': changes.get('expires_at', existing['expires_at']),
+                        'is_active': changes.get('is_active', existing['is_active']),
+                        'traffic_limit_gb': changes.get('traffic_limit_gb', existing['traffic_limit_gb']),
+                    })
+                else:
+                    job.counters['subs_unchanged'] += 1
+                continue
+
+            if not is_active and not expires_at:
+                job.counters['subs_skipped'] += 1
+                continue
+
+            squads = record.get('activeInternalSquads') or []
+            plan = plans_by_squad.get(self._squad_uuid(squads[0])) if squads else None
+            if not plan:
+                logger.warning(f"No subscription plan for record {record.get('username')} (TG {telegram_id})")
+                job.counters['errors'] += 1
+                continue
+
+            to_insert.append({
+                'user_id': telegram_id,
+                'subscription_id': plan.id,
+                'short_uuid': short_uuid,
+                'expires_at': expires_at or datetime.utcnow() + timedelta(days=30),
+                'is_active': is_active,
+                'traffic_limit_gb': traffic_gb or 0,
+            })
+
+        if orphaned:
+            await self.db.delete_user_subscriptions(orphaned)
+
+        job.total = len(to_insert) + len(to_update)
+        job.counters['subs_updated'] = await self._write_batches(
+            job, self.db.bulk_update_user_subscriptions, to_update
+        )
+        job.counters['subs_created'] = await self._write_batches(
+            job, self.db.bulk_insert_user_subscriptions, to_insert
+        )
+
+    async def _write_batches(self, job: SyncJob, write, rows: List[Dict]) -> int:
+        """Пишет rows пачками через write(chunk, chunk_size), обновляя прогресс между пачками."""
+        written = 0
+        for start in range(0, len(rows), self.batch_size):
+            chunk = rows[start:start + self.batch_size]
+            saved = await write(chunk, self.batch_size)
+            written += saved
+            job.counters['errors'] += len(chunk) - saved
+            job.processed += len(chunk)
+            await self._report(job)
+        return written
+
+    async def _expire_stale(self, job: SyncJob):
+        expired = []
+        async for user_sub, _, _ in self.db.iter_due_user_subscriptions(
+            expires_before=datetime.utcnow(), is_active=True, batch_size=self.batch_size
+        ):
+            expired.append(user_sub)
+
+        if not expired:
+            return
+
+        job.counters['statuses_updated'] = await self.db.deactivate_user_subscriptions([s.id for s in expired])
+
+        short_uuids = [s.short_uuid for s in expired if s.short_uuid]
+        if short_uuids:
+            result = await self.api.bulk_update_users_by_short_uuids(short_uuids, {'status': 'EXPIRED'})
+            if result['failed']:
+                logger.warning(f"Failed to mark {result['failed']} panel users as EXPIRED")
+
+    @staticmethod
+    def _pick_username(user_records: List[Dict], latest: Dict, telegram_id: int) -> str:
+        for record in user_records:
+            username = record.get('username') or ''
+            if username and not username.startswith('user_'):
+                return username
+        return latest.get('username') or f"User_{telegram_id}"
+
+    @staticmethod
+    def _squad_uuid(squad) -> Optional[str]:
+        if isinstance(squad, dict):
+            return squad.get('uuid') or squad.get('id')
+        return str(squad) if squad else None
+
+    @staticmethod
+    def _parse_expire_at(value: Optional[str]) -> Optional[datetime]:
+        parsed = parse_panel_datetime(value)
+        if value and parsed is None:
+            logger.error(f"Error parsing expiry date: {value}")
+        return parsed
+
+    @staticmethod
+    def _traffic_gb(limit_bytes) -> Optional[int]:
+        if limit_bytes is None:
+            return None
+        return limit_bytes // (1024 * 1024 * 1024) if limit_bytes > 0 else 0
+
+    async def _set_stage(self, job: SyncJob, stage: str):
+        job.stage = stage
+        job.processed = 0
+        job.total = 0
+        await self._report(job, force=True)
+
+    async def _report(self, job: SyncJob, force: bool = False):
+        if not self.bot or not job.chat_id or not job.message_id:
+            return
+        if not force and time.monotonic() - self._last_report < self.progress_interval:
+            return
+
+        self._last_report = time.monotonic()
+        finished = job.status != 'running'
+        try:
+            await self.bot.edit_message_text(
+                self.format_report(job) if finished else self.format_progress(job),
+                chat_id=job.chat_id,
+                message_id=job.message_id,
+                reply_markup=job.reply_markup if finished else None
+            )
+        except TelegramRetryAfter as e:
+            self._last_report = time.monotonic() + e.retry_after
+        except TelegramBadRequest as e:
+            if 'message is not modified' not in str(e):
+                logger.warning(f"Could not update sync progress: {e}")
+        except Exception as e:
+            logger.warning(f"Could not update sync progress: {e}")
+
+    def format_progress(self, job: SyncJob) -> str:
+        title = self.MODES[job.mode]['title']
+        stage_number = job.stages.index(job.stage) + 1 if job.stage in job.stages else 0
+
+        text = f"⏳ {title}\n\n"
+        text += f"Этап {stage_number}/{len(job.stages)}: {STAGE_LABELS.get(job.stage, job.stage)}...\n"
+        if job.total:
+            percent = min(job.processed / job.total * 100, 100.0)
+            text += f"Записано: {job.processed}/{job.total} ({percent:.0f}%)\n"
+        elif job.processed:
+            text += f"Получено записей: {job.processed}\n"
+        text += f"\n⏱ Прошло: {job.duration:.0f} сек."
+        return text
+
+    def format_report(self, job: SyncJob) -> str:
+        title = self.MODES[job.mode]['title']
+        c = job.counters
+
+        if job.status == 'failed':
+            return f"❌ {title}: ошибка\n\nДетали: {(job.error or '')[:200]}"
+        if job.status == 'cancelled':
+            return f"⏹ {title}: прервана"
+
+        text = f"✅ {title} завершена!\n\n"
+        text += "📊 Результаты:\n\n"
+        text += "👥 Пользователи:\n"
+        text += f"• Записей в RemnaWave: {c['panel_records']}\n"
+        text += f"• С Telegram ID: {c['telegram_users']}\n"
+        text += f"• Создано в боте: {c['users_created']}\n"
+        text += f"• Обновлено UUID: {c['users_updated']}\n"
+
+        if self.MODES[job.mode]['subscriptions']:
+            text += "\n📋 Планы подписок:\n"
+            text += f"• Создано новых планов: {c['plans_created']}\n\n"
+            text += "🎫 Подписки:\n"
+            text += f"• Создано: {c['subs_created']}\n"
+            text += f"• Обновлено: {c['subs_updated']}\n"
+            text += f"• Без изменений: {c['subs_unchanged']}\n"
+            text += f"• Пропущено: {c['subs_skipped']}\n"
+
+        if self.MODES[job.mode]['expire_stale']:
+            text += f"\n🔄 Истекших подписок деактивировано: {c['statuses_updated']}\n"
+
+        text += f"\n❌ Ошибок: {c['errors']}\n"
+
+        if job.totals:
+            text += "\n📈 Текущее состояние:\n"
+            text += f"• Пользователей в боте: {job.totals['users']}\n"
+            text += f"• Всего подписок: {job.totals['subscriptions']}\n"
+            text += f"• Активных подписок: {job.totals['active_subscriptions']}\n"
+
+        text += f"\n⏱ Длительность: {job.duration:.1f} сек."
+        return text
+
+    async def get_service_status(self) -> dict:
+        job = self.current_job or self.last_job
+        return {
+            'is_busy': self.is_busy,
+            'mode': job.mode if job else None,
+            'status': job.status if job else None,
+            'stage': job.stage if job else None,
+            'batch_size': self.batch_size,
+            'progress_interval': self.progress_interval,
+            'delta_interval': self.delta_interval,
+            'is_running': self.is_running
+        }
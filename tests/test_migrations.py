@@ -0,0 +1,35 @@
+import asyncio
+
+from database import Database
+from migrations import LATEST_VERSION, MIGRATIONS, get_schema_version, run_migrations
+
+
+def test_fresh_database_reaches_latest_version(tmp_path):
+    async def main():
+        db = Database(f"sqlite+aiosqlite:///{tmp_path / 'bot.db'}")
+        try:
+            await db.init_db()
+            version = await get_schema_version(db.engine)
+            applied_again = await run_migrations(db.engine)
+            return version, applied_again
+        finally:
+            await db.engine.dispose()
+
+    version, applied_again = asyncio.run(main())
+    assert version == LATEST_VERSION
+    assert applied_again == []
+
+
+def test_migrations_skip_existing_objects(tmp_path):
+    """На новой базе baseline уже создал объекты поздних миграций - каждая обязана это пережить."""
+    async def main():
+        db = Database(f"sqlite+aiosqlite:///{tmp_path / 'bot.db'}")
+        try:
+            await db.init_db()
+            for _, _, migration in MIGRATIONS:
+                async with db.engine.begin() as conn:
+                    await conn.run_sync(migration)
+        finally:
+            await db.engine.dispose()
+
+    asyncio.run(main())
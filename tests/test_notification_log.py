@@ -0,0 +1,42 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from database import Database
+from subscription_monitor import SubscriptionMonitorService
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        self.sent.append(chat_id)
+
+
+def test_undelivered_notifications_are_not_logged(tmp_path):
+    async def main():
+        db = Database(f"sqlite+aiosqlite:///{tmp_path / 'bot.db'}")
+        try:
+            await db.init_db()
+            user = SimpleNamespace(telegram_id=1, language='ru')
+            subscription = SimpleNamespace(name='Plan', is_imported=False, description='')
+            user_sub = SimpleNamespace(id=10, subscription_id=1, expires_at=datetime.utcnow() + timedelta(days=2))
+            rows = [(user_sub, subscription, user)]
+
+            monitor = SubscriptionMonitorService(None, db, SimpleNamespace())
+            without_bot = await monitor.send_expiry_warnings(rows)
+            trial_without_bot = await monitor.send_trial_expiry_notifications(rows)
+
+            monitor.bot = FakeBot()
+            delivered = await monitor.send_expiry_warnings(rows)
+            repeated = await monitor.send_expiry_warnings(rows)
+            return without_bot, trial_without_bot, delivered, repeated, monitor.bot.sent
+        finally:
+            await db.engine.dispose()
+
+    without_bot, trial_without_bot, delivered, repeated, sent = asyncio.run(main())
+    assert (without_bot, trial_without_bot) == (0, 0)
+    assert delivered == 1
+    assert repeated == 0
+    assert sent == [1]
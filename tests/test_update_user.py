@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+from database import Database
+
+
+def run_with_db(tmp_path, scenario):
+    async def main():
+        db = Database(f"sqlite+aiosqlite:///{tmp_path / 'bot.db'}")
+        try:
+            await db.init_db()
+            await db.create_user(telegram_id=1, username='user', first_name='User', language='ru')
+            return await scenario(db)
+        finally:
+            await db.engine.dispose()
+
+    return asyncio.run(main())
+
+
+def test_update_user_keeps_ledger_balance(tmp_path):
+    async def scenario(db):
+        stale = await db.get_cached_user(1)
+        posted = await db.post_balance_change(1, 100.0, 'topup', idempotency_key='test:credit')
+        assert posted['status'] == 'posted'
+
+        stale.language = 'en'
+        await db.update_user(stale)
+        return await db.get_user_by_telegram_id(1)
+
+    user = run_with_db(tmp_path, scenario)
+    assert user.balance == 100.0
+    assert user.language == 'en'
+
+
+def test_update_user_fields_writes_only_given_columns(tmp_path):
+    async def scenario(db):
+        await db.post_balance_change(1, 50.0, 'topup', idempotency_key='test:credit')
+        await db.mark_trial_used(1)
+        assert await db.update_user_fields(1, remnawave_uuid='uuid-1')
+        with pytest.raises(ValueError):
+            await db.update_user_fields(1, balance=0)
+        return await db.get_user_by_telegram_id(1)
+
+    user = run_with_db(tmp_path, scenario)
+    assert user.remnawave_uuid == 'uuid-1'
+    assert user.balance == 50.0
+    assert user.is_trial_used
@@ -87,58 +87,73 @@ class TributeService:
         amount_float = round(amount_value / 100.0, 2) 
 
         if event_name == "new_donation": 
-            await self._handle_new_donation(user_id, amount_float, currency, data)
+            await self._handle_new_donation(user_id, amount_float, currency, data,
+                                            self._donation_key(payload, data, raw_body))
         elif event_name == "cancelled_subscription":
             await self._handle_cancellation(user_id)
     
         return ok({"event": event_name or "unknown"})
 
-    async def _handle_new_donation(self, user_id: int, amount: float, currency: str, data: dict):
+    async def _handle_new_donation(self, user_id: int, amount: float, currency: str, data: dict,
+                                   idempotency_key: Optional[str] = None):
         try:
             if not user_id:
                 logger.warning(f"No telegram_user_id in webhook data")
                 return
         
-            async with self.db.session_factory() as session:
-                payment = await self.db.create_payment(
-                    user_id=int(user_id),
-                    amount=amount,
-                    payment_type='tribute',
-                    description=f'Пополнение через Tribute: {amount} {currency}',
-                    status='completed'
+            result = await self.db.post_balance_change(
+                int(user_id),
+                amount,
+                'tribute',
+                idempotency_key=idempotency_key,
+                description=f'Пополнение через Tribute: {amount} {currency}'
+            )
+            
+            if result['status'] == 'duplicate':
+                logger.info(f"Tribute donation {idempotency_key} already processed, skipping")
+                return
+            
+            if not result['success']:
+                logger.error(f"Failed to credit Tribute donation for user {user_id}: {result['status']}")
+                return
+            
+            try:
+                success_msg = (
+                    f"✅ **Платеж через Tribute получен!**\n\n"
+                    f"💰 Сумма: {amount} {currency}\n"
+                    f"🎉 Средства зачислены на баланс!\n\n"
+                    f"💳 Ваш текущий баланс можно посмотреть в главном меню."
                 )
             
-                await self.db.add_balance(int(user_id), amount)
+                from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+                keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="💰 Мой баланс", callback_data="balance")],
+                    [InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")]
+                ])
             
-                try:
-                    success_msg = (
-                        f"✅ **Платеж через Tribute получен!**\n\n"
-                        f"💰 Сумма: {amount} {currency}\n"
-                        f"🎉 Средства зачислены на баланс!\n\n"
-                        f"💳 Ваш текущий баланс можно посмотреть в главном меню."
-                    )
-                
-                    from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-                    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text="💰 Мой баланс", callback_data="balance")],
-                        [InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")]
-                    ])
-                
-                    await self.bot.send_message(
-                        int(user_id),
-                        success_msg,
-                        reply_markup=keyboard,
-                        parse_mode="Markdown"
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to send Tribute payment success message to user {user_id}: {e}")
-
-                await session.commit()
-                logger.info(f"Successfully processed Tribute donation: {amount} {currency} for user {user_id}")
+                await self.bot.send_message(
+                    int(user_id),
+                    success_msg,
+                    reply_markup=keyboard,
+                    parse_mode="Markdown"
+                )
+            except Exception as e:
+                logger.error(f"Failed to send Tribute payment success message to user {user_id}: {e}")
+
+            logger.info(f"Successfully processed Tribute donation: {amount} {currency} for user {user_id}")
                 
         except Exception as e:
             logger.error(f"Error handling tribute donation: {e}")
 
+    @staticmethod
+    def _donation_key(payload: dict, data: dict, raw_body: bytes) -> str:
+        """Ключ идемпотентности события: id доната и время события, иначе хеш тела."""
+        donation_id = data.get("donation_request_id") or data.get("donation_id")
+        event_time = payload.get("created_at")
+        if donation_id and event_time:
+            return f"tribute:{donation_id}:{event_time}"
+        return f"tribute:{hashlib.sha256(raw_body).hexdigest()}"
+
     async def _handle_cancellation(self, user_id: int):
         try:
             cancellation_msg = (
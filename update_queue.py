@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import time
+from typing import List
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateQueue:
+    """Очередь входящих апдейтов webhook-режима с пулом воркеров.
+
+    Апдейты раскладываются по workers шардам по id чата (или пользователя),
+    каждый шард разбирает свой воркер строго по порядку, поэтому апдейты
+    одного чата обрабатываются последовательно, а разные чаты - параллельно.
+    Емкость шарда ограничена: если место не освободилось за put_timeout
+    секунд, put() возвращает False, и webhook отвечает ошибкой, чтобы
+    Telegram повторил доставку позже.
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, workers: int = 8, max_size: int = 1000,
+                 put_timeout: float = 5.0):
+        self.dp = dp
+        self.bot = bot
+        self.workers = max(1, workers)
+        self.max_size = max(self.workers, max_size)
+        self.put_timeout = put_timeout
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        self.is_running = False
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    async def start(self):
+        if self.is_running:
+            return
+
+        shard_size = self.max_size // self.workers
+        self._queues = [asyncio.Queue(maxsize=shard_size) for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+        self.is_running = True
+        logger.info(f"📥 Update queue started: {self.workers} workers, capacity {shard_size * self.workers}")
+
+    async def stop(self, drain_timeout: float = 10.0):
+        """Перестает принимать апдейты и дает воркерам дообработать очередь."""
+        if not self.is_running:
+            return
+
+        self.is_running = False
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(queue.join() for queue in self._queues)),
+                timeout=drain_timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"Update queue not drained in {drain_timeout}s, "
+                           f"dropping {sum(q.qsize() for q in self._queues)} updates")
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def put(self, update: Update) -> bool:
+        if not self.is_running:
+            return False
+
+        queue = self._queues[self._ordering_key(update) % self.workers]
+        try:
+            await asyncio.wait_for(queue.put((time.monotonic(), update)), timeout=self.put_timeout)
+            return True
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            logger.warning(f"Update queue shard is full, rejecting update {update.update_id}")
+            return False
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            queued_at, update = await queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Error processing update {update.update_id}: {e}", exc_info=True)
+            finally:
+                queue.task_done()
+
+            wait = time.monotonic() - queued_at
+            if wait > 5:
+                logger.warning(f"Update {update.update_id} waited {wait:.1f}s in queue")
+
+    @staticmethod
+    def _ordering_key(update: Update) -> int:
+        try:
+            event = update.event
+        except Exception:
+            return update.update_id
+
+        chat = getattr(event, 'chat', None) or getattr(getattr(event, 'message', None), 'chat', None)
+        if chat is not None:
+            return chat.id
+
+        user = getattr(event, 'from_user', None) or getattr(event, 'user', None)
+        if user is not None:
+            return user.id
+        return update.update_id
+
+    def get_stats(self) -> dict:
+        return {
+            'is_running': self.is_running,
+            'workers': self.workers,
+            'queued': sum(queue.qsize() for queue in self._queues),
+            'capacity': sum(queue.maxsize for queue in self._queues),
+            'processed': self.processed,
+            'failed': self.failed,
+            'rejected': self.rejected
+        }
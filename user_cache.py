@@ -0,0 +1,88 @@
+import time
+import logging
+from collections import OrderedDict
+from typing import Dict, Any
+
+logger = logging.getLogger(__name__)
+
+
+class UserCache:
+    """In-process TTL/LRU кэш строк users по telegram_id.
+
+    Хранятся не ORM-объекты, а снимки значений колонок: каждый get() отдает
+    новый отсоединенный User, поэтому изменения, сделанные хендлером, не
+    попадают в кэш и в объекты параллельных апдейтов, пока не пройдут через БД.
+    """
+
+    def __init__(self, ttl: int = 60, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max(1, max_size)
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def get(self, telegram_id: int):
+        if not self.enabled:
+            return None
+
+        entry = self._entries.get(telegram_id)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, values = entry
+        if expires_at < time.monotonic():
+            del self._entries[telegram_id]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(telegram_id)
+        self.hits += 1
+        return self._restore(values)
+
+    def set(self, user):
+        if not self.enabled or user is None or getattr(user, 'telegram_id', None) is None:
+            return
+
+        self._entries[user.telegram_id] = (time.monotonic() + self.ttl, self._snapshot(user))
+        self._entries.move_to_end(user.telegram_id)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def update_fields(self, telegram_id: int, **values):
+        """Правит закэшированный снимок, не продлевая TTL."""
+        entry = self._entries.get(telegram_id)
+        if entry is not None:
+            entry[1].update(values)
+
+    def invalidate(self, telegram_id: int):
+        self._entries.pop(telegram_id, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total * 100, 1) if total else 0.0
+        }
+
+    @staticmethod
+    def _snapshot(user) -> Dict[str, Any]:
+        from database import User
+        return {column.key: getattr(user, column.key) for column in User.__table__.columns}
+
+    @staticmethod
+    def _restore(values: Dict[str, Any]):
+        from database import User
+        return User(**values)
@@ -1,6 +1,7 @@
 import logging
 from aiohttp import web, ClientSession
 from aiogram import Bot
+from aiogram.types import Update
 from database import Database
 from config import Config
 from tribute_service import TributeService, tribute_webhook_route
@@ -8,10 +9,11 @@ from tribute_service import TributeService, tribute_webhook_route
 logger = logging.getLogger(__name__)
 
 class WebhookServer:
-    def __init__(self, bot: Bot, db: Database, config: Config):
+    def __init__(self, bot: Bot, db: Database, config: Config, update_queue=None):
         self.bot = bot
         self.db = db
         self.config = config
+        self.update_queue = update_queue
         self.app = None
         self.runner = None
         self.site = None
@@ -25,14 +27,40 @@ class WebhookServer:
         
         self.app.router.add_post(self.config.TRIBUTE_WEBHOOK_PATH, tribute_webhook_route)
         
+        if self.update_queue:
+            self.app.router.add_post(self.config.TELEGRAM_WEBHOOK_PATH, self.telegram_webhook_route)
+            logger.info(f"Telegram webhook route: {self.config.TELEGRAM_WEBHOOK_PATH}")
+        
         async def health_check(request):
-            return web.json_response({"status": "ok", "service": "tribute-webhooks"})
+            response = {"status": "ok", "service": "tribute-webhooks"}
+            if self.update_queue:
+                response["update_queue"] = self.update_queue.get_stats()
+            return web.json_response(response)
         
         self.app.router.add_get('/health', health_check)
         
         logger.info(f"Webhook server configured with route: {self.config.TRIBUTE_WEBHOOK_PATH}")
         return self.app
     
+    async def telegram_webhook_route(self, request: web.Request) -> web.Response:
+        # Без секрета любой, кто знает путь, мог бы прислать апдейт от имени админа
+        secret = self.config.TELEGRAM_WEBHOOK_SECRET
+        if not secret or request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+            logger.warning(f"Telegram webhook request with invalid secret from {request.remote}")
+            return web.Response(status=401)
+        
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception as e:
+            logger.error(f"Invalid Telegram update payload: {e}")
+            return web.Response(status=400)
+        
+        if not await self.update_queue.put(update):
+            # Telegram повторит доставку, пока очередь не освободится
+            return web.Response(status=503)
+        
+        return web.Response(status=200)
+    
     async def start(self):
         try:
             if not self.app: